@@ -0,0 +1,255 @@
+from __future__ import unicode_literals, print_function
+import asyncio
+import signal
+from . import executor
+
+
+class AsyncServiceExecutor(executor.ServiceExecutor):
+    """Service executor with asyncio hooks.
+
+    The hooks on_start(), on_wake(), on_hup(), on_term() and on_shutdown() are coroutines run on
+    an event loop owned by the executor. Work started from on_wake() with spawn() runs concurrently
+    with later wakes, bounded by `max_concurrency`. run() is inherited so the lifecycle and
+    daemonize semantics are the same as ServiceExecutor.
+    """
+
+    def __init__(self, wakeup, state_or_logger=None, max_concurrency=100, schedule=None):
+        """Constructor
+
+        Args:
+            wakeup: Max time to sleep, in seconds, before calling on_wake(). Fractions are allowed.
+            state_or_logger: A ServiceState, Logger, or LoggerAdaptor.
+            max_concurrency: Max number of tasks started by spawn() that can be in flight.
+            schedule: A WakeSchedule, defaults to FIXED_DELAY with a period of `wakeup`.
+        """
+        super(AsyncServiceExecutor, self).__init__(wakeup, state_or_logger, schedule)
+        self.max_concurrency = max_concurrency
+        self._loop = None
+        self._wake_event = None
+        self._notified = False
+        self._slots = None
+        self._tasks = set()
+
+    @property
+    def loop(self):
+        """The event loop, None until run() has been called."""
+        return self._loop
+
+    @property
+    def pending(self):
+        """Number of spawned tasks in flight."""
+        return len(self._tasks)
+
+    def _run(self, coro):
+        if self._loop is None:
+            # Created here, after daemonizing, because DaemonContext closes open file descriptors.
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+        return self._loop.run_until_complete(coro)
+
+    def _start(self, workdir):
+        self._run(self._async_start(workdir))
+
+    def _run_loop(self):
+        self.health.running = True
+        watch = self._watch_terminate()
+        try:
+            self._run(self._async_run_loop())
+        finally:
+            watch.set()
+            self.health.running = False
+        self.logger.info('TERM received, exited daemon run loop')
+        self._terminate(True)
+
+    def _term(self, graceful):
+        self.shutdown_budget.start()
+        self._run(self._async_term(graceful))
+
+    def _shutdown(self):
+        try:
+            self._run(self.on_shutdown())
+        finally:
+            if self._loop is not None:
+                try:
+                    self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+                finally:
+                    asyncio.set_event_loop(None)
+                    self._loop.close()
+                    self._loop = None
+
+    async def _async_start(self, workdir):
+        self._wake_event = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        with self.start_duration.time():
+            await self.on_start(workdir)
+        self.health.started = True
+
+    def _signal_term(self):
+        executor.term_handler(signal.SIGTERM, None)
+        self._wake_event.set()
+
+    def _signal_hup(self):
+        executor.hup_handler(signal.SIGHUP, None)
+        self._wake_event.set()
+
+    async def _async_run_loop(self):
+        loop = self._loop
+        loop.add_signal_handler(signal.SIGTERM, self._signal_term)
+        loop.add_signal_handler(signal.SIGHUP, self._signal_hup)
+        try:
+            count = 0
+            schedule = self.schedule
+            schedule.start(executor.monotonic())
+            self._notified = False
+            wake_now = False
+            while not self.state.terminate:
+                self.health.tick()
+                self._wake_event.clear()
+                hup_recv_local = executor.hup_recv
+                hup_signaled = hup_recv_local != count  # test
+                count = hup_recv_local                  # set
+
+                if hup_signaled:
+                    self.logger.info('HUP received, refreshing')
+                    with self.hup_duration.time():
+                        await self.on_hup()
+                    wake_now = True
+                    continue
+
+                start = executor.monotonic()
+                scheduled = schedule.delay(start) <= 0
+                if scheduled or wake_now or self._notified:
+                    wake_now = self._notified = False
+                    self.health.wake_begin(start)
+                    await self.on_wake()
+                    finished = executor.monotonic()
+                    elapsed = finished - start
+                    self.health.wake_end(finished, elapsed)
+                    self.wake_duration.record(elapsed)
+                    if elapsed > schedule.period:
+                        self.wake_overruns.inc()
+                    if scheduled:
+                        missed = schedule.complete(start, finished)
+                        if missed:
+                            self.wakes_missed.inc(missed)
+                    if self.state.terminate:
+                        break
+                delay = schedule.delay(executor.monotonic())
+                if self._jobs is not None:
+                    # Jobs are synchronous functions, use_pool keeps slow jobs off the event loop.
+                    self._jobs.run_due(executor.monotonic())
+                    job_delay = self._jobs.delay(executor.monotonic())
+                    if job_delay is not None:
+                        delay = min(delay, job_delay)
+                if delay > 0 and not self._notified:
+                    try:
+                        await asyncio.wait_for(self._wake_event.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            if self._jobs is not None:
+                self._jobs.shutdown()
+            # remove_signal_handler() resets to SIG_DFL so restore the executor handlers for the
+            # remainder of the shutdown sequence.
+            loop.remove_signal_handler(signal.SIGTERM)
+            loop.remove_signal_handler(signal.SIGHUP)
+            signal.signal(signal.SIGTERM, executor.term_handler)
+            signal.signal(signal.SIGHUP, executor.hup_handler)
+
+    async def _async_term(self, graceful):
+        budget = self.shutdown_budget
+        with budget.phase('drain'):
+            # Spawned tasks may submit to batchers, so close the batchers once the tasks are done.
+            tasks = list(self._tasks)
+            if tasks:
+                if graceful:
+                    self.logger.info('Waiting for %d spawned tasks', len(tasks))
+                    pending = (await asyncio.wait(tasks, timeout=budget.remaining('drain')))[1]
+                    if pending:
+                        self.logger.warning('Cancelling %d spawned tasks still running', len(pending))
+                else:
+                    pending = tasks
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+            await self._loop.run_in_executor(None, self._drain_batchers, graceful)
+        with budget.phase('term'):
+            with self.term_duration.time():
+                await self.on_term(graceful)
+
+    def notify(self):
+        """Wake the run loop so on_wake() is called without waiting for the wakeup period to
+        expire. Safe to call from any thread."""
+        loop = self._loop
+        if loop is not None and self._wake_event is not None:
+            loop.call_soon_threadsafe(self._notify)
+
+    def _notify(self):
+        self._notified = True
+        self._wake_event.set()
+
+    def _interrupt(self):
+        loop = self._loop
+        if loop is not None and self._wake_event is not None:
+            loop.call_soon_threadsafe(self._wake_event.set)
+
+    async def spawn(self, coro):
+        """Run a coroutine as a task concurrently with the run loop. If `max_concurrency` tasks are
+        in flight this waits for one to finish, providing backpressure to on_wake().
+
+        Args:
+            coro: The coroutine.
+
+        Returns:
+            The asyncio.Task.
+        """
+        started = self._loop.create_future()
+        task = self._loop.create_task(self._run_task(coro, started))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        # Closes the coroutine if the task was cancelled before awaiting it.
+        task.add_done_callback(lambda _: coro.close())
+        try:
+            # The task takes its own slot, wait until it has one or is done.
+            await asyncio.wait((started, task), return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        return task
+
+    async def _run_task(self, coro, started):
+        # The slot is taken and released by the task, so a task cancelled before its first step,
+        # or while waiting for a slot, never holds one.
+        try:
+            async with self._slots:
+                started.set_result(None)
+                return await coro
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.logger.exception('Exception caught in spawned task', exc_info=e)
+
+    async def on_hup(self):
+        """Called when SIGHUP is received."""
+        pass
+
+    async def on_term(self, graceful):
+        """Called when SIGTERM is received, after spawned tasks are drained (graceful) or
+        cancelled."""
+        pass
+
+    async def on_wake(self):
+        """Called regularly in run loop."""
+        pass
+
+    async def on_start(self, workdir):
+        """Called just before entering the run-loop. Dependent services should be started here.
+
+        Args:
+            workdir: The working directory.
+        """
+        pass
+
+    async def on_shutdown(self):
+        """Called after on_term, just before logging shutdown. Dependent services should be stopped here."""
+        pass
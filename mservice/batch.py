@@ -0,0 +1,230 @@
+from __future__ import unicode_literals, print_function
+import time
+import threading
+import collections
+import logging
+from concurrent import futures
+from . import metrics
+
+
+_logger = logging.getLogger(__name__)
+
+# Python 2 has no monotonic clock.
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class BatcherFull(Exception):
+    """The batcher queue is full, raised by submit() with the REJECT policy or when a BLOCK wait times out."""
+    pass
+
+
+class BatcherClosed(Exception):
+    """The batcher was closed. Set on futures of items not processed by a non-graceful close."""
+    pass
+
+
+class MicroBatcher(object):
+    """Groups items submitted by many producers into batches for a single call.
+
+    submit() queues an item and returns a concurrent.futures.Future. A worker thread passes queued
+    items to `on_batch(items)` when `max_batch_size` items are queued or the oldest has waited
+    `max_latency_ms`, whichever comes first. on_batch() returns one result per item, in order, which
+    resolve the futures. If it raises, every future of the batch gets the exception. Use
+    asyncio.wrap_future() to await a future from a coroutine.
+
+    When `capacity` items are queued the overflow policy applies to submit():
+        BLOCK: wait for room, up to `timeout` seconds if given, then raise BatcherFull.
+        REJECT: raise BatcherFull.
+    """
+    BLOCK = 'block'
+    REJECT = 'reject'
+    POLICIES = (BLOCK, REJECT)
+
+    def __init__(self, on_batch, max_batch_size=32, max_latency_ms=10.0, capacity=1024, overflow=BLOCK,
+                 workers=1, name='batch', registry=None):
+        """Constructor
+
+        Args:
+            on_batch: Function taking a list of items and returning a list of results of the same length.
+            max_batch_size: Max items per call to on_batch().
+            max_latency_ms: Max milliseconds an item waits for its batch to fill.
+            capacity: Max items queued, not counting batches being processed.
+            overflow: BLOCK or REJECT.
+            workers: Number of threads calling on_batch(), more than one lets a batch fill while the
+                previous one is processed.
+            name: Label of the batcher metrics.
+            registry: The MetricsRegistry, defaults to metrics.default_registry.
+        """
+        if overflow not in self.POLICIES:
+            raise ValueError('overflow must be one of %s' % ', '.join(self.POLICIES))
+        self.on_batch = on_batch
+        self.max_batch_size = max(max_batch_size, 1)
+        self.max_latency = max_latency_ms / 1000.0
+        self.capacity = max(capacity, 1)
+        self.overflow = overflow
+        self.workers = max(workers, 1)
+        self.name = name
+        registry = registry if registry is not None else metrics.default_registry
+        labels = {'batcher': name}
+        self.batch_size = registry.histogram('mservice_batch_size', 'Items per batch', labels=labels)
+        self.queue_latency = registry.histogram('mservice_batch_wait_seconds',
+                                                'Time items waited for their batch', labels=labels)
+        self.batch_duration = registry.histogram('mservice_batch_seconds', 'Duration of on_batch()', labels=labels)
+        self.rejected = registry.counter('mservice_batch_rejected_total', 'Items rejected by a full queue',
+                                         labels=labels)
+        registry.gauge('mservice_batch_queued', 'Items queued', labels=labels, fn=lambda: len(self))
+        self._items = collections.deque()   # (queued time, item, future)
+        self._cond = threading.Condition(threading.Lock())
+        self._in_flight = 0
+        self._closed = False
+        self._threads = []
+
+    def __len__(self):
+        return len(self._items)
+
+    def start(self):
+        """Start the worker threads. Called by submit() if needed."""
+        with self._cond:
+            self._start()
+        return self
+
+    def _start(self):
+        # Caller holds the lock.
+        if self._threads or self._closed:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name='mservice-%s-%d' % (self.name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, item, timeout=None):
+        """Queue an item.
+
+        Args:
+            item: Passed to on_batch().
+            timeout: Max seconds to wait for room with the BLOCK policy, None waits forever.
+
+        Returns:
+            A concurrent.futures.Future resolved with the result for the item.
+
+        Raises:
+            BatcherFull: if there is no room, see the overflow policy.
+            BatcherClosed: if the batcher is closed.
+        """
+        future = futures.Future()
+        with self._cond:
+            if not self._threads:
+                self._start()
+            if len(self._items) >= self.capacity:
+                if self.overflow == self.REJECT:
+                    self.rejected.inc()
+                    raise BatcherFull(self.name)
+                deadline = None if timeout is None else monotonic() + timeout
+                while len(self._items) >= self.capacity and not self._closed:
+                    remaining = None if deadline is None else deadline - monotonic()
+                    if remaining is not None and remaining <= 0:
+                        self.rejected.inc()
+                        raise BatcherFull(self.name)
+                    self._cond.wait(remaining)
+            if self._closed:
+                raise BatcherClosed(self.name)
+            self._items.append((monotonic(), item, future))
+            if len(self._items) == 1 or len(self._items) >= self.max_batch_size:
+                self._cond.notify_all()
+        return future
+
+    def _get_batch(self):
+        with self._cond:
+            while True:
+                n = len(self._items)
+                if n >= self.max_batch_size or (n and self._closed):
+                    break
+                if self._closed:
+                    return None
+                if n == 0:
+                    self._cond.wait()
+                    continue
+                remaining = self._items[0][0] + self.max_latency - monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = [self._items.popleft() for _ in range(min(n, self.max_batch_size))]
+            self._in_flight += 1
+            # Wake blocked producers, and other workers if a full batch is still queued.
+            self._cond.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._get_batch()
+            if batch is None:
+                return
+            try:
+                self._process(batch)
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+                    self._cond.notify_all()
+
+    def _process(self, batch):
+        start = monotonic()
+        live = []
+        for queued, item, future in batch:
+            self.queue_latency.record(start - queued)
+            if future.set_running_or_notify_cancel():
+                live.append((item, future))
+        if not live:
+            return
+        self.batch_size.record(len(live))
+        try:
+            results = self.on_batch([item for item, _ in live])
+            if results is None or len(results) != len(live):
+                raise ValueError('on_batch() returned %s results for %d items' %
+                                 ('no' if results is None else len(results), len(live)))
+        except Exception as e:
+            _logger.exception('Exception caught in batcher %s', self.name, exc_info=e)
+            for _, future in live:
+                future.set_exception(e)
+        else:
+            for (_, future), result in zip(live, results):
+                future.set_result(result)
+        finally:
+            self.batch_duration.record(monotonic() - start)
+
+    def close(self, graceful=True, timeout=None):
+        """Stop accepting items. If graceful queued items are processed, else their futures fail with
+        BatcherClosed. Waits for batches being processed.
+
+        Args:
+            graceful: Process or fail queued items.
+            timeout: Max seconds to wait, None waits until done.
+
+        Returns:
+            True if everything finished before the timeout.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._cond:
+            self._closed = True
+            if not graceful:
+                dropped = list(self._items)
+                self._items.clear()
+            else:
+                dropped = []
+                if self._items:
+                    _logger.info('Flushing %d items queued in batcher %s', len(self._items), self.name)
+            self._cond.notify_all()
+            while self._items or self._in_flight:
+                remaining = None if deadline is None else deadline - monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            done = not self._items and not self._in_flight
+        for _, _, future in dropped:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(BatcherClosed(self.name))
+        if dropped:
+            _logger.info('Failed %d items queued in batcher %s', len(dropped), self.name)
+        if not done:
+            _logger.warning('Batcher %s still busy after %s seconds', self.name, timeout)
+        return done
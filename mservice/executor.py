@@ -2,17 +2,33 @@ from __future__ import unicode_literals, print_function
 import logging
 import os
 import signal
+import select
+import fcntl
+import errno
+import random
+import heapq
+import collections
+import threading
 import time
 import sys
-import daemon.pidfile
-import watchtower
+import struct
 import pwd
 import grp
 from .log import ExceptionRateLimitedLogAdaptor, set_log_format
+from .log import BatchingLogHandler, HandlerSink, LogRecordBuffer, LogRateLimiter, close_background_handlers
+from .log import discard_inherited_records
+from .log import RotatingFileLogHandler
+from . import metrics
+from .health import HealthState, HealthServer
+from .profiler import Diagnostics
+from .watchdog import Watchdog, RECYCLE_EXIT_CODE
 
 
 _module_logger = logging.getLogger(__name__)
 
+# Python 2 has no monotonic clock.
+monotonic = getattr(time, 'monotonic', time.time)
+
 
 class ServiceState(object):
     def __init__(self, logger=None):
@@ -30,8 +46,21 @@ class ServiceState(object):
         time.sleep(seconds)
 
     def time(self):
+        """Wall clock time in seconds."""
         return time.time()
 
+    def clock(self):
+        """Monotonic time in seconds. Use for intervals, it does not jump when the system clock changes."""
+        return monotonic()
+
+    def close_log_handlers(self, timeout=None):
+        """Flush and stop background log handlers. Called by the executor before logging.shutdown()."""
+        pass
+
+    def after_fork(self):
+        """Called in a worker forked by WorkerSupervisor, which keeps running in the parent."""
+        pass
+
 
 # Signal handlers
 hup_recv = 0
@@ -42,20 +71,827 @@ def hup_handler(signum, frame):
 
 terminate = False
 def term_handler(signum, frame):
-    global terminate, logger
+    global terminate
     terminate = True
     _module_logger.info('SIGTERM')
 
 
-def alarm_handler(signum, frame):
+diagnostics = Diagnostics()
+def usr1_handler(signum, frame):
+    diagnostics.request_dump()
+
+def usr2_handler(signum, frame):
+    diagnostics.request_profile()
+
+
+def chld_handler(signum, frame):
+    # Installed by the worker supervisor so SIGCHLD is written to the wakeup pipe.
     pass
 
 
+class SignalWaker(object):
+    """Self-pipe used to wake the run loop.
+
+    Signals are written to the pipe by the interpreter via signal.set_wakeup_fd(), so a signal
+    arriving between the terminate test and the wait cannot be missed. Other threads can wake
+    the run loop by calling notify().
+    """
+
+    def __init__(self):
+        self._rfd = None
+        self._wfd = None
+        self._prev_wakeup_fd = None
+        self.notified = False
+
+    @property
+    def is_open(self):
+        return self._rfd is not None
+
+    def open(self):
+        """Create the pipe and register it as the signal wakeup fd. If not called from the main
+        thread only notify() can wake a waiter."""
+        if self._rfd is not None:
+            return
+        rfd, wfd = os.pipe()
+        for fd in (rfd, wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        self._rfd, self._wfd = rfd, wfd
+        try:
+            self._prev_wakeup_fd = signal.set_wakeup_fd(wfd)
+        except ValueError:
+            self._prev_wakeup_fd = None
+
+    def close(self):
+        """Unregister and close the pipe."""
+        if self._rfd is None:
+            return
+        if self._prev_wakeup_fd is not None:
+            try:
+                signal.set_wakeup_fd(self._prev_wakeup_fd)
+            except ValueError:
+                pass
+            self._prev_wakeup_fd = None
+        rfd, wfd = self._rfd, self._wfd
+        self._rfd = self._wfd = None
+        os.close(rfd)
+        os.close(wfd)
+
+    def notify(self):
+        """Wake the waiter and set `notified`. Safe to call from any thread."""
+        self.notified = True
+        self.interrupt()
+
+    def interrupt(self):
+        """Wake the waiter without setting `notified`. Safe to call from any thread."""
+        wfd = self._wfd
+        if wfd is None:
+            return
+        try:
+            os.write(wfd, b'\0')
+        except OSError:
+            # EAGAIN means the pipe is full so a wakeup is already pending.
+            pass
+
+    def wait(self, seconds, fds=()):
+        """Wait for a signal, a notify(), or a timeout.
+
+        Args:
+            seconds: The timeout in seconds, fractions are allowed.
+            fds: Other file descriptors that end the wait when readable. The caller reads them.
+
+        Returns:
+            True if woken before the timeout expired.
+        """
+        rfd = self._rfd
+        if rfd is None:
+            time.sleep(seconds)
+            return False
+        try:
+            readable = select.select([rfd] + list(fds), [], [], max(seconds, 0))[0]
+        except (select.error, OSError) as e:
+            # Python 2 does not retry on EINTR.
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = True
+        if readable:
+            if readable is True or rfd in readable:
+                self._drain()
+            return True
+        return False
+
+    def take_notified(self):
+        """Test and clear the notified flag."""
+        notified = self.notified
+        self.notified = False
+        return notified
+
+    def _drain(self):
+        try:
+            while os.read(self._rfd, 512):
+                pass
+        except OSError:
+            pass
+
+
+# Process wide because signal delivery is process wide.
+waker = SignalWaker()
+
+
+class WakeSchedule(object):
+    """Schedule of on_wake() calls on the monotonic clock.
+
+    Modes:
+        FIXED_DELAY: wake `period` seconds after the previous on_wake() finished.
+        FIXED_RATE: wake every `period` seconds measured from the first wake, so the cadence does not
+            drift with the duration of on_wake().
+
+    Overrun policies, for FIXED_RATE when on_wake() runs past one or more scheduled wakes:
+        SKIP: drop the missed wakes and continue on the next slot.
+        CATCH_UP: run every missed wake back to back.
+        COALESCE: run one wake immediately for all missed wakes, then continue on the next slot.
+
+    `jitter` is a fraction of the period. A random phase of up to jitter * period is added to the first
+    wake, and in FIXED_DELAY mode to every wake, so a fleet started together does not wake in step.
+    """
+    FIXED_DELAY = 'fixed-delay'
+    FIXED_RATE = 'fixed-rate'
+    MODES = (FIXED_DELAY, FIXED_RATE)
+    SKIP = 'skip'
+    CATCH_UP = 'catch-up'
+    COALESCE = 'coalesce'
+    OVERRUN_POLICIES = (SKIP, CATCH_UP, COALESCE)
+
+    def __init__(self, period, mode=FIXED_DELAY, overrun=SKIP, jitter=0.0):
+        if mode not in self.MODES:
+            raise ValueError('mode must be one of %s' % ', '.join(self.MODES))
+        if overrun not in self.OVERRUN_POLICIES:
+            raise ValueError('overrun must be one of %s' % ', '.join(self.OVERRUN_POLICIES))
+        self.period = period
+        self.mode = mode
+        self.overrun = overrun
+        self.jitter = jitter
+        self.slot = None
+        self.due = None
+        self.overruns = 0
+        self.missed = 0
+
+    def _jitter(self):
+        return random.uniform(0, self.jitter * self.period) if self.jitter > 0 else 0.0
+
+    def start(self, now, immediate=True):
+        """Start the schedule.
+
+        Args:
+            now: The current monotonic time.
+            immediate: If True the first wake is due now, plus the jitter phase.
+        """
+        first = now if immediate else now + self.period
+        self.slot = first + self._jitter()
+        self.due = self.slot
+
+    def delay(self, now):
+        """Seconds until the next wake is due, zero or less if due."""
+        return self.due - now
+
+    def complete(self, started, finished):
+        """Advance the schedule after a scheduled on_wake().
+
+        Args:
+            started: Monotonic time on_wake() started.
+            finished: Monotonic time on_wake() finished.
+
+        Returns:
+            The number of scheduled wakes dropped by the overrun policy.
+        """
+        missed = 0
+        if (finished - started) > self.period:
+            self.overruns += 1
+        if self.mode == self.FIXED_DELAY:
+            self.slot = finished + self.period + self._jitter()
+            self.due = self.slot
+            return 0
+
+        slot = self.slot + self.period
+        due = slot
+        if slot <= finished:
+            # Slots elapsed while on_wake() was running.
+            elapsed = int((finished - slot) // self.period) + 1
+            if self.overrun == self.SKIP:
+                slot += elapsed * self.period
+                due = slot
+                missed = elapsed
+            elif self.overrun == self.COALESCE:
+                slot += (elapsed - 1) * self.period
+                due = finished
+                missed = elapsed - 1
+        self.slot = slot
+        self.due = due
+        self.missed += missed
+        return missed
+
+
+class PeriodicJob(object):
+    """A named function run periodically by the executor, see ServiceExecutor.add_periodic()."""
+
+    def __init__(self, name, fn, schedule, use_pool=False):
+        self.name = name
+        self.fn = fn
+        self.schedule = schedule
+        self.use_pool = use_pool
+        self.cancelled = False
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.last_duration = 0.0
+        self.last_lateness = 0.0
+        self.duration = None
+        self.lateness = None
+
+
+class JobScheduler(object):
+    """Heap of periodic jobs ordered by due time. Adding, removing and running a job are O(log n).
+    Removed jobs are discarded lazily when they reach the top of the heap.
+    """
+
+    def __init__(self, logger, registry, interrupt, max_workers=4):
+        """Constructor
+
+        Args:
+            logger: The service logger.
+            registry: The MetricsRegistry for job durations and lateness.
+            interrupt: Function waking the run loop so it recomputes its sleep, safe to call from any thread.
+            max_workers: Size of the thread pool for jobs with use_pool set.
+        """
+        self.logger = logger
+        self.registry = registry
+        self.interrupt = interrupt
+        self.max_workers = max_workers
+        self.jobs = {}
+        self._heap = []     # (due, sequence, job)
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def _push(self, job):
+        # Caller holds the lock.
+        self._seq += 1
+        heapq.heappush(self._heap, (job.schedule.due, self._seq, job))
+
+    def add(self, job, now):
+        job.duration = self.registry.histogram('mservice_job_seconds', 'Duration of periodic jobs',
+                                               labels={'job': job.name})
+        job.lateness = self.registry.histogram('mservice_job_lateness_seconds', 'Delay of periodic jobs past due',
+                                               labels={'job': job.name})
+        job.schedule.start(now, immediate=False)
+        with self._lock:
+            old = self.jobs.get(job.name)
+            if old is not None:
+                old.cancelled = True
+            self.jobs[job.name] = job
+            self._push(job)
+
+    def remove(self, name):
+        with self._lock:
+            job = self.jobs.pop(name, None)
+        if job is not None:
+            job.cancelled = True
+        return job
+
+    def delay(self, now):
+        """Seconds until the next job is due, None if there are no jobs."""
+        with self._lock:
+            while self._heap and self._heap[0][2].cancelled:
+                heapq.heappop(self._heap)
+            if not self._heap:
+                return None
+            return self._heap[0][0] - now
+
+    def run_due(self, now):
+        """Run all jobs due at `now`. Jobs using the pool are submitted and rescheduled when they finish."""
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                job = heapq.heappop(self._heap)[2]
+                if not job.cancelled:
+                    due.append(job)
+        for job in due:
+            if job.use_pool:
+                job.running = True
+                self._get_pool().submit(self._run, job)
+            else:
+                self._run(job)
+
+    def _get_pool(self):
+        if self._pool is None:
+            from concurrent import futures
+            self._pool = futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._pool
+
+    def _run(self, job):
+        start = monotonic()
+        job.last_lateness = max(start - job.schedule.due, 0.0)
+        job.lateness.record(job.last_lateness)
+        try:
+            job.fn()
+        except Exception as e:
+            job.failures += 1
+            self.logger.exception('Exception caught in periodic job %s', job.name, exc_info=e, rlimitby=job.name)
+        finished = monotonic()
+        job.runs += 1
+        job.last_duration = finished - start
+        job.duration.record(job.last_duration)
+        missed = job.schedule.complete(start, finished)
+        if missed:
+            self.logger.debug('Periodic job %s missed %d runs', job.name, missed)
+        job.running = False
+        with self._lock:
+            if not job.cancelled:
+                self._push(job)
+        if job.use_pool:
+            # The run loop may be sleeping past the new due time.
+            self.interrupt()
+
+    def shutdown(self, wait=True):
+        """Stop the thread pool, waiting for running jobs if `wait`."""
+        pool = self._pool
+        self._pool = None
+        if pool is not None:
+            pool.shutdown(wait=wait)
+
+
+# Process pool workers are forked with the executor in this global, so on_wake() can be run in a
+# worker without pickling the executor.
+_wake_target = None
+
+
+def _offloaded_wake(target=None):
+    # Timed in the pool so the duration is that of on_wake(), not of its dispatch.
+    if target is None:
+        target = _wake_target
+    start = monotonic()
+    target.on_wake()
+    return monotonic() - start
+
+
+class WakeDispatcher(object):
+    """Bounded dispatch of work to a thread or process pool, so slow work does not stop the run loop
+    from noticing control signals.
+
+    Submitted work counts as pending until it finishes. When `max_pending` is reached the overflow
+    policy decides what happens to new work:
+        BLOCK: wait for pending work to finish. The wait is abandoned when the service terminates.
+        DROP_OLDEST: cancel the oldest work not yet started. If all pending work has started the new
+            work is skipped.
+        SKIP: discard the new work.
+
+    Process workers are forked from the service so they see its state at the time of the fork.
+    Changes made in a worker are not seen by the service.
+    """
+    THREAD = 'thread'
+    PROCESS = 'process'
+    KINDS = (THREAD, PROCESS)
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop-oldest'
+    SKIP = 'skip'
+    POLICIES = (BLOCK, DROP_OLDEST, SKIP)
+
+    def __init__(self, kind=THREAD, max_workers=4, max_pending=None, overflow=SKIP):
+        """Constructor
+
+        Args:
+            kind: THREAD or PROCESS.
+            max_workers: Size of the pool.
+            max_pending: Max work submitted and not finished, defaults to `max_workers`.
+            overflow: What to do when `max_pending` is reached.
+        """
+        if kind not in self.KINDS:
+            raise ValueError('kind must be one of %s' % ', '.join(self.KINDS))
+        if overflow not in self.POLICIES:
+            raise ValueError('overflow must be one of %s' % ', '.join(self.POLICIES))
+        self.kind = kind
+        self.max_workers = max(max_workers, 1)
+        self.max_pending = max(max_pending if max_pending is not None else self.max_workers, 1)
+        self.overflow = overflow
+        self.logger = _module_logger
+        self.submitted = 0
+        self.dropped = 0
+        self.failures = 0
+        self.latency = None
+        self._pending = collections.deque()  # (submit time, future)
+        # Reentrant because Future.cancel() runs the done callback in the calling thread.
+        self._cond = threading.Condition(threading.RLock())
+        self._pool = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def bind(self, logger, registry):
+        """Called by the executor to set the logger and register metrics."""
+        self.logger = logger
+        self.latency = registry.histogram('mservice_dispatch_seconds', 'Time from dispatch to completion of work')
+        registry.gauge('mservice_dispatch_pending', 'Dispatched work not finished', fn=lambda: len(self))
+        registry.counter('mservice_dispatch_dropped_total', 'Dispatched work dropped by the overflow policy or cancelled',
+                         fn=lambda: self.dropped)
+
+    def _get_pool(self):
+        if self._pool is None:
+            from concurrent import futures
+            if self.kind == self.PROCESS:
+                import multiprocessing
+                self._pool = futures.ProcessPoolExecutor(max_workers=self.max_workers,
+                                                         mp_context=multiprocessing.get_context('fork'))
+            else:
+                self._pool = futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._pool
+
+    def _make_room(self, abort):
+        # Caller holds the lock. Returns True if the new work can be submitted.
+        while len(self._pending) >= self.max_pending:
+            if self.overflow == self.SKIP:
+                return False
+            elif self.overflow == self.DROP_OLDEST:
+                for _, future in self._pending:
+                    # cancel() runs the done callback, which removes the future from the deque.
+                    if future.cancel():
+                        break
+                else:
+                    return False
+            else:
+                if abort is not None and abort():
+                    return False
+                # Short waits so signal handlers run and `abort` is tested promptly.
+                self._cond.wait(0.1)
+        return True
+
+    def submit(self, fn, *args, **kwargs):
+        """Submit work, applying the overflow policy when `max_pending` is reached.
+
+        Args:
+            fn: The function. It must be picklable for a PROCESS pool.
+            args: Positional arguments passed to fn.
+            kwargs: Keyword arguments passed to fn.
+
+        Returns:
+            A concurrent.futures.Future, or None if the work was dropped.
+        """
+        return self.submit_unless(None, fn, *args, **kwargs)
+
+    def submit_unless(self, abort, fn, *args, **kwargs):
+        """As submit(), a BLOCK wait is abandoned and the work dropped when `abort()` returns True."""
+        with self._cond:
+            if not self._make_room(abort):
+                self.dropped += 1
+                return None
+            future = self._get_pool().submit(fn, *args, **kwargs)
+            self.submitted += 1
+            self._pending.append((monotonic(), future))
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        finished = monotonic()
+        with self._cond:
+            for item in self._pending:
+                if item[1] is future:
+                    self._pending.remove(item)
+                    break
+            else:
+                return
+            self._cond.notify_all()
+        if future.cancelled():
+            self.dropped += 1
+            return
+        if self.latency is not None:
+            self.latency.record(finished - item[0])
+        e = future.exception()
+        if e is not None:
+            self.failures += 1
+            self.logger.exception('Exception caught in dispatched work', exc_info=e)
+
+    def shutdown(self, graceful=True, timeout=None):
+        """Stop the pool. Pending work is drained if `graceful`, else work not yet started is cancelled.
+
+        Args:
+            graceful: Drain or cancel pending work.
+            timeout: Max seconds to wait for pending work, None waits until it finishes.
+
+        Returns:
+            True if no work is pending.
+        """
+        with self._cond:
+            pending = len(self._pending)
+            if not graceful:
+                cancelled = [f for _, f in list(self._pending) if f.cancel()]
+                if cancelled:
+                    self.logger.info('Cancelled %d dispatched calls', len(cancelled))
+            elif pending:
+                self.logger.info('Waiting for %d dispatched calls', pending)
+            deadline = None if timeout is None else monotonic() + timeout
+            while self._pending:
+                remaining = None if deadline is None else deadline - monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._cond.wait(0.1 if remaining is None else min(remaining, 0.1))
+            drained = not self._pending
+            pool = self._pool
+            self._pool = None
+        if pool is not None:
+            pool.shutdown(wait=drained)
+        if not drained:
+            self.logger.warning('%d dispatched calls still running after %s seconds', len(self), timeout)
+        return drained
+
+
+def warmup(loaders, max_workers=None):
+    """Run loader functions concurrently in threads, typically from prepare_reload() to load
+    configuration and models in parallel.
+
+    Args:
+        loaders: A dict of name to a function taking no arguments.
+        max_workers: Max threads, defaults to one per loader.
+
+    Returns:
+        A dict of name to the value returned by its loader.
+
+    Raises:
+        The first exception raised by a loader, after all loaders finish.
+    """
+    from concurrent import futures
+    if not loaders:
+        return {}
+    with futures.ThreadPoolExecutor(max_workers=max_workers or len(loaders)) as pool:
+        pending = dict((name, pool.submit(fn)) for name, fn in loaders.items())
+    return dict((name, future.result()) for name, future in pending.items())
+
+
+class Reloader(object):
+    """Runs the reload protocol of a ServiceExecutor without stopping the run loop.
+
+    prepare_reload() runs in a background thread while on_wake() keeps serving the current
+    resources. When it finishes the run loop calls commit_reload() between wakes to swap the new
+    resources in, then release_reload() frees the old resources in a background thread. If prepare
+    or commit fails rollback_reload() is called and the current resources stay in service. A HUP
+    received while a reload is in progress starts another reload once it completes.
+    """
+
+    def __init__(self, svc):
+        self.svc = svc
+        self.reloads = 0
+        self.failures = 0
+        self.duration = svc.metrics.histogram('mservice_reload_seconds', 'Duration of prepare_reload()')
+        self.failed = svc.metrics.counter('mservice_reload_failures_total', 'Reloads rolled back')
+        self._lock = threading.Lock()
+        self._thread = None
+        self._requested = False
+        self._prepared = None   # (resources,) once prepare_reload() succeeded
+        self._closed = False
+
+    @property
+    def logger(self):
+        return self.svc.logger
+
+    @property
+    def in_progress(self):
+        return self._thread is not None
+
+    def request(self):
+        """Start a reload, or queue one if a reload is in progress."""
+        with self._lock:
+            if self._closed:
+                return
+            if self._thread is not None:
+                self._requested = True
+                return
+            self._start()
+
+    def _start(self):
+        # Caller holds the lock.
+        self.svc.health.reloading = True
+        self._thread = threading.Thread(target=self._prepare, name='mservice-reload')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _spawn(self, fn, *args):
+        thread = threading.Thread(target=fn, args=args, name='mservice-reload')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _prepare(self):
+        start = monotonic()
+        try:
+            resources = self.svc.prepare_reload()
+        except Exception as e:
+            self.duration.record(monotonic() - start)
+            self.logger.exception('prepare_reload() failed, keeping current resources', exc_info=e)
+            self._rollback(e, None)
+            self._finish()
+            return
+        self.duration.record(monotonic() - start)
+        if resources is None:
+            self._finish()
+            return
+        with self._lock:
+            closed = self._closed
+            if not closed:
+                self._prepared = (resources,)
+        if closed:
+            # The service stopped while preparing, the new resources will never be used.
+            self._rollback(None, resources)
+            self._finish()
+        else:
+            self.svc._interrupt()
+
+    def _rollback(self, error, resources):
+        if error is not None:
+            self.failures += 1
+            self.failed.inc()
+        try:
+            self.svc.rollback_reload(error, resources)
+        except Exception as e:
+            self.logger.exception('Exception caught in rollback_reload()', exc_info=e)
+
+    def _finish(self):
+        with self._lock:
+            self._thread = None
+            if self._requested and not self._closed:
+                self._requested = False
+                self._start()
+            else:
+                self.svc.health.reloading = False
+
+    def poll(self):
+        """Commit prepared resources. Called by the run loop between wakes."""
+        with self._lock:
+            prepared = self._prepared
+            self._prepared = None
+        if prepared is None:
+            return False
+        resources = prepared[0]
+        try:
+            old = self.svc.commit_reload(resources)
+        except Exception as e:
+            self.logger.exception('commit_reload() failed, keeping current resources', exc_info=e)
+            self._spawn(self._rollback, e, resources)
+            self._finish()
+            return False
+        self.reloads += 1
+        self.logger.info('Reload committed')
+        if old is not None:
+            self._spawn(self._release, old)
+        self._finish()
+        return True
+
+    def _release(self, resources):
+        try:
+            self.svc.release_reload(resources)
+        except Exception as e:
+            self.logger.exception('Exception caught in release_reload()', exc_info=e)
+
+    def shutdown(self, timeout=None):
+        """Stop starting reloads. Resources prepared and not yet committed are rolled back in a
+        background thread, a reload being prepared is rolled back when it finishes.
+
+        Args:
+            timeout: Max seconds to wait for the rollback or the reload being prepared, None or zero
+                does not wait.
+        """
+        with self._lock:
+            self._closed = True
+            self._requested = False
+            prepared = self._prepared
+            self._prepared = None
+            thread = self._thread
+        if prepared is not None:
+            thread = self._spawn(self._rollback, None, prepared[0])
+            self._finish()
+        if thread is not None and timeout:
+            thread.join(timeout)
+
+
+class ShutdownBudget(object):
+    """Time budget for stopping a service, split across phases run in order:
+
+        drain: finish or cancel in-flight work, dispatched calls, periodic jobs and reloads.
+        term: on_term().
+        shutdown: on_shutdown() and dependent services such as gRPC channels and exporters.
+        logs: flush background log handlers.
+
+    Each phase ends at a fixed share of the budget measured from the start, so time left by a phase
+    passes to the next. A phase running past its end is logged. When the whole budget runs out a
+    watchdog thread ends the process with os._exit().
+    """
+    PHASES = (('drain', 0.4), ('term', 0.2), ('shutdown', 0.2), ('logs', 0.2))
+
+    def __init__(self, timeout, logger=None, registry=None, cleanup=None, exit_code=1):
+        """Constructor
+
+        Args:
+            timeout: The budget in seconds, None for no limit.
+            logger: The service logger.
+            registry: The MetricsRegistry for phase durations.
+            cleanup: Function called by the watchdog before it ends the process.
+            exit_code: The process exit code used by the watchdog.
+        """
+        self.timeout = timeout
+        self.logger = logger if logger is not None else _module_logger
+        self.registry = registry if registry is not None else metrics.default_registry
+        self.cleanup = cleanup
+        self.exit_code = exit_code
+        self.started = None
+        self.ends = {}
+        self.current = None
+        self._done = threading.Event()
+        self._watchdog = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the budget and the watchdog. Does nothing if already started. Safe to call from any
+        thread."""
+        with self._lock:
+            if self.started is not None:
+                return self
+            started = monotonic()
+            share = 0.0
+            for name, fraction in self.PHASES:
+                share += fraction
+                self.ends[name] = None if self.timeout is None else started + share * self.timeout
+            self.started = started
+            if self.timeout is not None:
+                self._watchdog = threading.Thread(target=self._watch, name='mservice-shutdown')
+                self._watchdog.daemon = True
+                self._watchdog.start()
+        return self
+
+    def remaining(self, phase=None):
+        """Seconds left in a phase, or in the whole budget if phase is None. None if there is no limit."""
+        if self.timeout is None:
+            return None
+        end = self.started + self.timeout if phase is None else self.ends[phase]
+        return max(end - monotonic(), 0.0)
+
+    def phase(self, name):
+        """Context manager timing a phase."""
+        return _ShutdownPhase(self, name)
+
+    def finish(self):
+        """Stop the watchdog, the service stopped within budget."""
+        self._done.set()
+
+    def _watch(self):
+        if self._done.wait(self.timeout):
+            return
+        # Logging may be what is stuck, so write to stderr directly.
+        try:
+            os.write(2, ('Shutdown did not finish within %s seconds, exiting in phase %s\n' %
+                         (self.timeout, self.current)).encode('utf-8'))
+        except OSError:
+            pass
+        try:
+            if self.cleanup is not None:
+                self.cleanup()
+        finally:
+            os._exit(self.exit_code)
+
+
+class _ShutdownPhase(object):
+
+    def __init__(self, budget, name):
+        self.budget = budget
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = monotonic()
+        self.budget.current = self.name
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        finished = monotonic()
+        budget = self.budget
+        budget.registry.histogram('mservice_shutdown_seconds', 'Duration of shutdown phases',
+                                  labels={'phase': self.name}).record(finished - self.start)
+        end = budget.ends.get(self.name)
+        if end is not None and finished > end:
+            budget.logger.warning('Shutdown phase %s took %.3f seconds, %.3f seconds over budget',
+                                  self.name, finished - self.start, finished - end)
+        return False
+
+
 class DefaultServiceState(ServiceState):
     """Default service state"""
 
     def __init__(self, svcname=None, logger=None, root_logger=None, rundir=None, pidfile=None,
-                 daemonize=False, uid=None, gid=None):
+                 daemonize=False, uid=None, gid=None, workers=1, metrics_port=None, metrics_file=None,
+                 health_port=None, health_socket=None, shutdown_timeout=None, profile_seconds=30.0,
+                 profile_interval=0.01, max_rss=None, max_wake_seconds=None, max_wakes=None, max_uptime=None,
+                 recycle_stagger=30.0):
         super(DefaultServiceState, self).__init__(logger=logger)
         self.svcname = svcname if svcname is not None else 'unknown'
         self.root_logger = root_logger
@@ -64,34 +900,88 @@ class DefaultServiceState(ServiceState):
         self.daemonize = daemonize
         self.uid = uid
         self.gid = gid
+        self.workers = workers
+        self.metrics_port = metrics_port
+        self.metrics_file = metrics_file
+        self.health_port = health_port
+        self.health_socket = health_socket
+        self.shutdown_timeout = shutdown_timeout
+        self.profile_seconds = profile_seconds
+        self.profile_interval = profile_interval
+        self.max_rss = max_rss
+        self.max_wake_seconds = max_wake_seconds
+        self.max_wakes = max_wakes
+        self.max_uptime = max_uptime
+        self.recycle_stagger = recycle_stagger
 
     @property
     def terminate(self):
         global terminate
         return terminate
 
+    def close_log_handlers(self, timeout=None):
+        if isinstance(self.logger, ExceptionRateLimitedLogAdaptor):
+            self.logger.log_summary(force=True)
+        if self.root_logger is not None:
+            close_background_handlers(self.root_logger, timeout)
+
+    def after_fork(self):
+        if self.root_logger is not None:
+            # The supervisor writes the records it queued before the fork.
+            discard_inherited_records(self.root_logger)
+
     def wait(self, seconds):
         self.logger.debug('Pausing for %s seconds', seconds)
-        signal.signal(signal.SIGALRM, alarm_handler)
-        signal.alarm(seconds)
         if not self.terminate:
-            # FIXME: We have a race condition here.
-            # If SIGTERM arrives just before the pause call we miss it for `seconds`.
-            # A second SIGTERM will help
-            signal.pause()
+            # Signals received after the terminate test are written to the wakeup pipe so
+            # the wait returns immediately.
+            waker.wait(seconds)
         self.logger.debug('Continue')
 
 
+def _close_grpc_channels():
+    # Only if the service used grpc_core, so grpc is not imported otherwise.
+    pool = sys.modules.get('mservice.grpc_core.pool')
+    if pool is not None:
+        try:
+            pool.close_default_pool()
+        except Exception as e:
+            _module_logger.exception('Exception caught closing gRPC channels', exc_info=e)
+
+
 class ServiceExecutor(object):
 
-    def __init__(self, wakeup, state_or_logger=None):
+    def __init__(self, wakeup, state_or_logger=None, schedule=None, dispatcher=None, offload_wake=False):
         """Constructor
 
         Args:
-            wakeup: Max timetosleep before calling on_wakeup().
+            wakeup: Max time to sleep, in seconds, before calling on_wake(). Fractions are allowed.
             state_or_logger
+            schedule: A WakeSchedule, defaults to FIXED_DELAY with a period of `wakeup`.
+            dispatcher: A WakeDispatcher used by dispatch(). Pending work is drained or cancelled
+                before on_term() is called.
+            offload_wake: If True on_wake() is run by the dispatcher instead of the run loop, so a slow
+                wake does not delay HUP and TERM handling. The schedule advances when on_wake() is
+                dispatched, not when it finishes.
         """
+        if offload_wake and dispatcher is None:
+            raise ValueError('offload_wake requires a dispatcher')
         self.wakeup = wakeup
+        self.schedule = schedule if schedule is not None else WakeSchedule(wakeup)
+        self.dispatcher = dispatcher
+        self.offload_wake = offload_wake
+        self._jobs = None
+        self._reloader = None
+        self.health = HealthState(self.schedule.period)
+        self._health_server = None
+        self._shutdown_budget = None
+        self._terminated = False
+        self._batchers = []
+        self._resources = None
+        self.watchdog = None
+        self.recycle_reason = None
+        self._recycle_fd = None     # Set in workers, see WorkerSupervisor.
+        self._slot = None
         if state_or_logger is None:
             self.state = DefaultServiceState()
         elif isinstance(state_or_logger, ServiceState):
@@ -100,12 +990,46 @@ class ServiceExecutor(object):
             self.state = DefaultServiceState(logger=state_or_logger)
         else:
             raise TypeError('state_or_logger must be a ServiceState, Logger, or LoggerAdaptor')
+        self.metrics = metrics.default_registry
+        self.start_duration = self.metrics.histogram('mservice_start_seconds', 'Duration of on_start()')
+        self.wake_duration = self.metrics.histogram('mservice_wake_seconds', 'Duration of on_wake()')
+        self.hup_duration = self.metrics.histogram('mservice_hup_seconds', 'Duration of on_hup()')
+        self.term_duration = self.metrics.histogram('mservice_term_seconds', 'Duration of on_term()')
+        self.wake_overruns = self.metrics.counter('mservice_wake_overruns_total',
+                                                  'Calls to on_wake() that took longer than the wakeup period')
+        self.wakes_missed = self.metrics.counter('mservice_wakes_missed_total',
+                                                 'Scheduled wakes dropped by the overrun policy')
+        if dispatcher is not None:
+            dispatcher.bind(self.logger, self.metrics)
+        if isinstance(self.logger, ExceptionRateLimitedLogAdaptor):
+            logger = self.logger
+            self.metrics.counter('mservice_log_exceptions_suppressed_total', 'Exceptions suppressed by rate limit',
+                                 fn=lambda: logger.suppressed)
+        self._metrics_exporter = None
 
     def _run_loop(self):
+        waker.open()
+        self.health.running = True
+        watch = self._watch_terminate()
+        try:
+            self._run_loop_inner()
+        finally:
+            watch.set()
+            self.health.running = False
+            waker.close()
+        self.logger.info('TERM received, exited daemon run loop')
+        self._terminate(True)
+
+    def _run_loop_inner(self):
         global hup_recv
         count = 0
+        schedule = self.schedule
+        schedule.start(monotonic())
+        waker.take_notified()
+        wake_now = False
 
         while not self.state.terminate:
+            self.health.tick()
             # A HUP increments hup_recv.
             hup_recv_local = hup_recv
             hup_signaled = hup_recv_local != count  # test
@@ -113,16 +1037,48 @@ class ServiceExecutor(object):
 
             if hup_signaled:
                 self.logger.info('HUP received, refreshing')
-                self.on_hup()
-            else:
-                self.on_wake()
+                with self.hup_duration.time():
+                    self.on_hup()
+                self.reloader.request()
+                # Wake once the refresh is done.
+                wake_now = True
+                continue
+
+            if self._reloader is not None:
+                self._reloader.poll()
+
+            start = monotonic()
+            scheduled = schedule.delay(start) <= 0
+            # Always cleared, a notify() before a scheduled wake is served by that wake.
+            notified = waker.take_notified()
+            if scheduled or wake_now or notified:
+                wake_now = False
+                if self.offload_wake:
+                    # Timed when the pool task finishes, see _offloaded_wake_done().
+                    self._dispatch_wake()
+                    finished = monotonic()
+                else:
+                    self.health.wake_begin(start)
+                    self.on_wake()
+                    finished = monotonic()
+                    elapsed = finished - start
+                    self.health.wake_end(finished, elapsed)
+                    self._record_wake(elapsed)
+                if scheduled:
+                    missed = schedule.complete(start, finished)
+                    if missed:
+                        self.wakes_missed.inc(missed)
                 # If force_terminate() was called then exit
                 if self.state.terminate:
                     break
-                self.state.wait(self.wakeup)
-
-        self.logger.info('TERM received, exited daemon run loop')
-        self.on_term(True)
+            delay = schedule.delay(monotonic())
+            if self._jobs is not None:
+                self._jobs.run_due(monotonic())
+                job_delay = self._jobs.delay(monotonic())
+                if job_delay is not None:
+                    delay = min(delay, job_delay)
+            if delay > 0 and not waker.notified:
+                self.state.wait(delay)
 
     @property
     def logger(self):
@@ -132,16 +1088,209 @@ class ServiceExecutor(object):
         """Force termination of the run loop"""
         global terminate
         terminate = True
+        self.notify()
 
     def force_hup(self):
         """Force on_hup() to be called."""
         global hup_recv
         hup_recv += 1
+        self.notify()
+
+    @property
+    def reloader(self):
+        """The Reloader running prepare_reload() on HUP."""
+        if self._reloader is None:
+            self._reloader = Reloader(self)
+        return self._reloader
+
+    @property
+    def resources(self):
+        """The ResourceStore, see mservice.resources. Files are kept in the resources directory of
+        the rundir, so resources are shared by workers and instances using the same rundir."""
+        if self._resources is None:
+            from .resources import ResourceStore
+            rundir = getattr(self.state, 'rundir', None) or os.path.join(os.getcwd(), 'run')
+            self._resources = ResourceStore(os.path.join(rundir, 'resources'), registry=self.metrics)
+        return self._resources
+
+    @property
+    def jobs(self):
+        """The JobScheduler holding periodic jobs."""
+        if self._jobs is None:
+            self._jobs = JobScheduler(self.logger, self.metrics, self._interrupt)
+        return self._jobs
+
+    def add_periodic(self, name, interval, fn, mode=WakeSchedule.FIXED_RATE, overrun=WakeSchedule.SKIP,
+                     jitter=0.0, use_pool=False):
+        """Run a function periodically from the run loop, independent of on_wake(). The run loop sleeps
+        until the next wake or job is due. Safe to call from any thread.
+
+        Args:
+            name: Unique job name. Adding a job with the same name replaces it.
+            interval: Period in seconds.
+            fn: Function taking no arguments.
+            mode: WakeSchedule mode.
+            overrun: WakeSchedule overrun policy.
+            jitter: WakeSchedule jitter.
+            use_pool: Run in a thread pool so a slow job does not delay other jobs or on_wake(). A job
+                is never run concurrently with itself.
+
+        Returns:
+            The PeriodicJob, which has run count, failure count, last duration and last lateness.
+        """
+        job = PeriodicJob(name, fn, WakeSchedule(interval, mode, overrun, jitter), use_pool)
+        self.jobs.add(job, monotonic())
+        self._interrupt()
+        return job
+
+    def remove_periodic(self, name):
+        """Remove a periodic job.
+
+        Returns:
+            The removed PeriodicJob or None.
+        """
+        if self._jobs is None:
+            return None
+        return self._jobs.remove(name)
+
+    def notify(self):
+        """Wake the run loop so on_wake() is called without waiting for the wakeup period to
+        expire. Safe to call from any thread, typically when work becomes ready."""
+        waker.notify()
+
+    def add_batcher(self, batcher):
+        """Register a MicroBatcher so queued items are flushed, or failed if not graceful, before
+        on_term() is called.
+
+        Returns:
+            The batcher.
+        """
+        self._batchers.append(batcher.start())
+        return batcher
+
+    def batcher(self, on_batch, **kwargs):
+        """Create and register a MicroBatcher, see mservice.batch. Keyword arguments are passed to
+        its constructor.
+
+        Returns:
+            The MicroBatcher.
+        """
+        from .batch import MicroBatcher
+        kwargs.setdefault('registry', self.metrics)
+        return self.add_batcher(MicroBatcher(on_batch, **kwargs))
+
+    def dispatch(self, fn, *args, **kwargs):
+        """Run a function in the dispatcher pool, applying its overflow policy when full. A BLOCK wait
+        is abandoned when the service terminates. Use from on_wake() for work that would otherwise
+        delay signal handling.
+
+        Args:
+            fn: The function. It must be picklable for a PROCESS pool.
+            args: Positional arguments passed to fn.
+            kwargs: Keyword arguments passed to fn.
+
+        Returns:
+            A concurrent.futures.Future, or None if the work was dropped.
+        """
+        if self.dispatcher is None:
+            raise RuntimeError('no dispatcher, pass one to the constructor')
+        return self.dispatcher.submit_unless(lambda: self.state.terminate, fn, *args, **kwargs)
+
+    def _dispatch_wake(self):
+        global _wake_target
+        if self.dispatcher.kind == WakeDispatcher.PROCESS:
+            # Inherited by the pool workers when they are forked. The duration is returned to the
+            # service, which records it.
+            _wake_target = self
+            future = self.dispatch(_offloaded_wake)
+            if future is not None:
+                future.add_done_callback(self._offloaded_wake_done)
+        else:
+            future = self.dispatch(self._timed_wake)
+        if future is None:
+            self.logger.debug('on_wake() dropped, %d dispatched calls pending', len(self.dispatcher))
+
+    def _timed_wake(self):
+        # Recorded before the future completes, so a drained dispatcher has recorded every wake.
+        elapsed = _offloaded_wake(self)
+        self.health.wake_done(elapsed)
+        self._record_wake(elapsed)
+
+    def _offloaded_wake_done(self, future):
+        # Failures are logged by the dispatcher.
+        if future.cancelled() or future.exception() is not None:
+            return
+        elapsed = future.result()
+        self.health.wake_done(elapsed)
+        self._record_wake(elapsed)
+
+    def _record_wake(self, elapsed):
+        self.wake_duration.record(elapsed)
+        period = self.schedule.period
+        if elapsed > period:
+            self.wake_overruns.inc()
+            self.logger.debug('on_wake() took %.3f seconds, longer than the %s second period', elapsed, period)
+
+    def _interrupt(self):
+        # Wake the run loop so it recomputes its sleep, without calling on_wake().
+        waker.interrupt()
 
     def on_hup(self):
-        """Called when SIGHUP is received."""
+        """Called when SIGHUP is received, on the run loop before prepare_reload() is started."""
         pass
 
+    def prepare_reload(self):
+        """Called in a background thread after on_hup(). Build new resources, such as configuration
+        and models, while on_wake() keeps using the current resources. Use warmup() to load them in
+        parallel.
+
+        The default prepares resources of the ResourceStore whose version changed.
+
+        Returns:
+            The new resources passed to commit_reload(), or None if there is nothing to reload.
+        """
+        if self._resources is not None:
+            return self._resources.prepare()
+        return None
+
+    def commit_reload(self, resources):
+        """Called on the run loop, never concurrently with on_wake() unless it is offloaded, to swap
+        in the resources returned by prepare_reload(). Keep it short, assigning an attribute is
+        enough.
+
+        Args:
+            resources: The value returned by prepare_reload().
+
+        Returns:
+            The old resources passed to release_reload(), or None.
+        """
+        if self._resources is not None:
+            return self._resources.commit(resources)
+        return None
+
+    def release_reload(self, resources):
+        """Called in a background thread to release the resources replaced by commit_reload().
+
+        Args:
+            resources: The value returned by commit_reload().
+        """
+        if self._resources is not None:
+            self._resources.release(resources)
+
+    def rollback_reload(self, error, resources):
+        """Called in a background thread when a reload fails, or is abandoned because the service is
+        stopping. The current resources stay in service.
+
+        The default unmaps the resources prepared by the ResourceStore.
+
+        Args:
+            error: The exception raised by prepare_reload() or commit_reload(), None if abandoned.
+            resources: The resources from prepare_reload() that were not committed, None if prepare
+                failed.
+        """
+        if self._resources is not None and resources is not None:
+            self._resources.release(resources.values())
+
     def on_term(self, graceful):
         """Called when SIGTERM is received."""
         pass
@@ -162,8 +1311,263 @@ class ServiceExecutor(object):
         """Called after on_term, just before logging shutdown. Dependent services should be stopped here."""
         pass
 
+    # Lifecycle dispatch used by run(). Executors with a different calling convention for the
+    # hooks, such as AsyncServiceExecutor, override these.
+    def _start(self, workdir):
+        with self.start_duration.time():
+            self.on_start(workdir)
+        self.health.started = True
+
+    @property
+    def shutdown_budget(self):
+        """The ShutdownBudget, started when termination is requested, the run loop exits or on_term() is
+        called."""
+        if self._shutdown_budget is None:
+            cleanup = None
+            if getattr(self.state, 'daemonize', False):
+                cleanup = self._remove_pidfile
+            self._shutdown_budget = ShutdownBudget(getattr(self.state, 'shutdown_timeout', None),
+                                                   logger=self.logger, registry=self.metrics, cleanup=cleanup)
+        return self._shutdown_budget
+
+    def _watch_terminate(self):
+        # Start the shutdown budget, and with it the hard exit, as soon as termination is requested,
+        # so a process whose on_wake() never returns to the run loop still stops. Signal handlers
+        # only set a flag, so it is polled. Returns the Event ending the watch.
+        done = threading.Event()
+        budget = self.shutdown_budget
+        if budget.timeout is None:
+            return done
+
+        def watch():
+            while not done.wait(0.1):
+                if self.state.terminate:
+                    budget.start()
+                    return
+        thread = threading.Thread(target=watch, name='mservice-term-watch')
+        thread.daemon = True
+        thread.start()
+        return done
+
+    def _drain_dispatcher(self, graceful):
+        if self.dispatcher is not None:
+            self.dispatcher.shutdown(graceful, self.shutdown_budget.remaining('drain'))
+
+    def _drain_batchers(self, graceful):
+        for batcher in self._batchers:
+            try:
+                batcher.close(graceful, self.shutdown_budget.remaining('drain'))
+            except Exception as e:
+                self.logger.exception('Exception caught closing batcher %s', batcher.name, exc_info=e)
+
+    def _drain_jobs(self):
+        if self._jobs is not None:
+            self._jobs.shutdown()
+        if self._reloader is not None:
+            self._reloader.shutdown(self.shutdown_budget.remaining('drain'))
+
+    def _terminate(self, graceful):
+        # The run loop terminates when it exits, the lifecycle when the loop raised. Either way
+        # each shutdown phase and on_term() run once.
+        if self._terminated:
+            return
+        self._terminated = True
+        self._term(graceful)
+
+    def _drain(self, graceful):
+        # Runs within the drain phase of the shutdown budget. Producers are drained before the
+        # batchers they may submit to.
+        self._drain_jobs()
+        self._drain_dispatcher(graceful)
+        self._drain_batchers(graceful)
+
+    def _term(self, graceful):
+        budget = self.shutdown_budget.start()
+        with budget.phase('drain'):
+            self._drain(graceful)
+        with budget.phase('term'):
+            with self.term_duration.time():
+                self.on_term(graceful)
+
+    def _start_metrics_export(self, slot=None):
+        port = self.state.metrics_port
+        path = self.state.metrics_file
+        if port is None and path is None:
+            return
+        if slot is not None:
+            # Workers cannot share a port or file.
+            port = None if port is None else port + slot
+            path = None if path is None else '%s.%d' % (path, slot)
+        try:
+            exporter = metrics.MetricsExporter(self.metrics, port=port, path=path)
+            exporter.start()
+            self._metrics_exporter = exporter
+        except Exception as e:
+            self.logger.exception('Cannot start metrics export', exc_info=e)
+
+    def _stop_metrics_export(self):
+        if self._metrics_exporter is not None:
+            try:
+                self._metrics_exporter.stop()
+            except Exception as e:
+                self.logger.exception('Exception caught stopping metrics export', exc_info=e)
+            self._metrics_exporter = None
+
+    def _worker_stop_timeout(self):
+        # Workers exit by themselves within their budget, allow a little more before SIGKILL.
+        timeout = getattr(self.state, 'shutdown_timeout', None)
+        return 30.0 if timeout is None else timeout + 2.0
+
+    def _recycle_stagger(self):
+        stagger = getattr(self.state, 'recycle_stagger', None)
+        return 30.0 if stagger is None else stagger
+
+    def _start_health_server(self, slot=None):
+        port = getattr(self.state, 'health_port', None)
+        path = getattr(self.state, 'health_socket', None)
+        if port is None and path is None:
+            return
+        if slot is not None:
+            # Workers cannot share a port or socket.
+            port = None if port is None else port + slot
+            path = None if path is None else '%s.%d' % (path, slot)
+        try:
+            server = HealthServer(self.health, port=port, path=path)
+            server.start()
+            self._health_server = server
+        except Exception as e:
+            self.logger.exception('Cannot start health server', exc_info=e)
+
+    def _stop_health_server(self):
+        if self._health_server is not None:
+            try:
+                self._health_server.stop()
+            except Exception as e:
+                self.logger.exception('Exception caught stopping health server', exc_info=e)
+            self._health_server = None
+
+    def _start_watchdog(self):
+        state = self.state
+        watchdog = Watchdog(max_rss=getattr(state, 'max_rss', None),
+                            max_wake_seconds=getattr(state, 'max_wake_seconds', None),
+                            max_wakes=getattr(state, 'max_wakes', None),
+                            max_uptime=getattr(state, 'max_uptime', None))
+        if not watchdog.enabled:
+            return
+        self.watchdog = watchdog.start(self.health, self.wake_duration, self.recycle, self.metrics)
+
+    def _start_log_summary(self):
+        logger = self.logger
+        if isinstance(logger, ExceptionRateLimitedLogAdaptor) and (logger.rlimit > 0 or logger.limiter is not None):
+            # Suppressed counts are reported even when the sources stay quiet.
+            self.add_periodic('mservice-log-summary', logger.summary_interval, logger.log_summary)
+
+    def recycle(self, reason):
+        """Stop through the normal on_term() and on_shutdown() path so a fresh process replaces this
+        one. Called by the watchdog, safe to call from any thread. A worker asks the supervisor, which
+        replaces workers one at a time. Otherwise run() exits with RECYCLE_EXIT_CODE for the process
+        manager to restart the service.
+
+        Args:
+            reason: Why the process is recycled.
+        """
+        self.recycle_reason = reason
+        fd = self._recycle_fd
+        if fd is not None:
+            try:
+                os.write(fd, struct.pack('!H', self._slot))
+                return
+            except OSError as e:
+                self.logger.warning('Cannot reach the supervisor, recycling now: %s', e)
+        self.force_terminate()
+
+    def _start_diagnostics(self):
+        diagnostics.configure(rundir=getattr(self.state, 'rundir', None),
+                              name=getattr(self.state, 'svcname', None),
+                              profile_seconds=getattr(self.state, 'profile_seconds', None),
+                              profile_interval=getattr(self.state, 'profile_interval', None))
+        diagnostics.start()
+
+    def _shutdown(self):
+        self.on_shutdown()
+
+    def _stop_services(self):
+        if self.watchdog is not None:
+            self.watchdog.stop()
+        if self._resources is not None:
+            self._resources.close()
+        _close_grpc_channels()
+        self._stop_metrics_export()
+        self._stop_health_server()
+
+    def _close_logs(self):
+        budget = self.shutdown_budget
+        with budget.phase('logs'):
+            self.state.close_log_handlers(budget.remaining('logs'))
+            logging.shutdown()
+        budget.finish()
+
+    def _remove_pidfile(self):
+        try:
+            os.remove(self.state.pidfile)
+        except:
+            pass
+
+    def _run_worker(self, workdir, slot=0):
+        """Run the service lifecycle in a worker process forked by WorkerSupervisor.
+
+        Args:
+            workdir: The working directory.
+            slot: The worker slot number.
+
+        Returns:
+            The process exit code.
+        """
+        started = False
+        graceful = True
+        exit_code = 0
+        self._slot = slot
+        try:
+            self._start_metrics_export(slot)
+            self._start_health_server(slot)
+            self._start_diagnostics()
+            self._start_watchdog()
+            self._start_log_summary()
+            self._start(workdir)
+            started = True
+            self.logger.info('Worker %d started', os.getpid())
+            self._run_loop()
+
+        except KeyboardInterrupt:
+            self.logger.debug('KeyboardInterrupt')
+
+        except Exception as e:
+            self.logger.exception('Exception caught', exc_info=e)
+            exit_code = 1
+            graceful = False
+
+        if started:
+            try:
+                self._terminate(graceful)
+            except Exception as et:
+                self.logger.exception('Exception caught during on_term()', exc_info=et)
+
+        with self.shutdown_budget.start().phase('shutdown'):
+            try:
+                self._shutdown()
+            except Exception as e:
+                self.logger.exception('Exception caught', exc_info=e)
+                exit_code = 1
+            self._stop_services()
+        self.logger.info('Worker %d stopped', os.getpid())
+        self._close_logs()
+        if exit_code == 0 and self.recycle_reason is not None:
+            exit_code = RECYCLE_EXIT_CODE
+        return exit_code
+
     def run(self, workdir):
-        """Run the daemon.
+        """Run the daemon. If the state has more than one worker the process becomes a supervisor
+        that forks the workers, see WorkerSupervisor.
 
         Args:
             workdir: The working directory.
@@ -173,6 +1577,7 @@ class ServiceExecutor(object):
         """
         if workdir is None:
             workdir = os.getcwdu()
+        supervise = self.state.workers > 1
 
         if self.state.daemonize:
             if not os.path.exists(self.state.rundir):
@@ -183,6 +1588,8 @@ class ServiceExecutor(object):
             print('Starting service')
             self.logger.info('Starting service...')
 
+            # Imported here so foreground services do not load python-daemon.
+            import daemon.pidfile
             context = daemon.DaemonContext(working_directory=workdir,
                                            umask=0o022,
                                            pidfile=daemon.pidfile.PIDLockFile(self.state.pidfile),
@@ -191,15 +1598,26 @@ class ServiceExecutor(object):
                                            signal_map = {
                                                signal.SIGTERM: term_handler,
                                                signal.SIGHUP:  hup_handler,
-                                               signal.SIGALRM: alarm_handler,
+                                               signal.SIGUSR1: usr1_handler,
+                                               signal.SIGUSR2: usr2_handler,
                                            })
             started = False
             try:
                 with context:
-                    self.on_start(workdir)
-                    started = True
-                    self.logger.info('Service started')
-                    self._run_loop()
+                    if supervise:
+                        WorkerSupervisor(self, workdir, self.state.workers,
+                                         stop_timeout=self._worker_stop_timeout(),
+                                         recycle_stagger=self._recycle_stagger()).run()
+                    else:
+                        self._start_metrics_export()
+                        self._start_health_server()
+                        self._start_diagnostics()
+                        self._start_watchdog()
+                        self._start_log_summary()
+                        self._start(workdir)
+                        started = True
+                        self.logger.info('Service started')
+                        self._run_loop()
 
             except Exception as e:
                 self.logger.exception('Exception caught', exc_info=e)
@@ -207,7 +1625,7 @@ class ServiceExecutor(object):
                     print('An error occured starting service')
                 else:
                     try:
-                        self.on_term(False)
+                        self._terminate(False)
                     except Exception as et:
                         self.logger.exception('Exception caught during on_term()', exc_info=et)
 
@@ -217,11 +1635,22 @@ class ServiceExecutor(object):
             try:
                 signal.signal(signal.SIGTERM, term_handler)
                 signal.signal(signal.SIGHUP, hup_handler)
-                signal.signal(signal.SIGALRM, alarm_handler)
-                self.on_start(workdir)
-                started = True
-                self.logger.info('Service started')
-                self._run_loop()
+                signal.signal(signal.SIGUSR1, usr1_handler)
+                signal.signal(signal.SIGUSR2, usr2_handler)
+                if supervise:
+                    WorkerSupervisor(self, workdir, self.state.workers,
+                                     stop_timeout=self._worker_stop_timeout(),
+                                     recycle_stagger=self._recycle_stagger()).run()
+                else:
+                    self._start_metrics_export()
+                    self._start_health_server()
+                    self._start_diagnostics()
+                    self._start_watchdog()
+                    self._start_log_summary()
+                    self._start(workdir)
+                    started = True
+                    self.logger.info('Service started')
+                    self._run_loop()
 
             except KeyboardInterrupt:
                 self.logger.debug('KeyboardInterrupt')
@@ -233,24 +1662,264 @@ class ServiceExecutor(object):
 
             if started:
                 try:
-                    self.on_term(graceful)
+                    self._terminate(graceful)
                 except Exception as et:
                     self.logger.exception('Exception caught during on_term()', exc_info=et)
 
-        try:
-            self.on_shutdown()
-        except Exception as e:
-            logger.exception('Exception caught', exc_info=e)
-
-        # kill_all_grpc()
+        with self.shutdown_budget.start().phase('shutdown'):
+            if not supervise:
+                # Workers call on_shutdown(), the supervisor never called on_start().
+                try:
+                    self._shutdown()
+                except Exception as e:
+                    self.logger.exception('Exception caught', exc_info=e)
+            self._stop_services()
         self.logger.info('Service stopped')
-        logging.shutdown()
+        self._close_logs()
         if self.state.daemonize:
+            self._remove_pidfile()
+        if self.recycle_reason is not None and not supervise:
+            sys.exit(RECYCLE_EXIT_CODE)
+
+
+class WorkerSupervisor(object):
+    """Prefork supervisor. The supervisor process holds the pid file and forks `workers` processes
+    that each run the on_start()/run loop/on_term()/on_shutdown() lifecycle of the executor.
+    Workers that exit unexpectedly are restarted with exponential backoff, SIGHUP and SIGTERM are
+    forwarded to every worker.
+
+    Workers recycled by their watchdog ask the supervisor over a pipe. Requests are queued and
+    granted one at a time, at least `recycle_stagger` seconds apart: the worker is sent SIGTERM and
+    replaced without backoff, so the pool never loses more than one worker to recycling. A recycled
+    worker still running after `stop_timeout`, such as one stuck in on_wake(), is sent SIGKILL.
+    """
+
+    def __init__(self, svc, workdir, workers, min_backoff=1.0, max_backoff=60.0, min_uptime=10.0,
+                 stop_timeout=30.0, recycle_stagger=30.0):
+        """Constructor
+
+        Args:
+            svc: The ServiceExecutor run in each worker.
+            workdir: The working directory.
+            workers: The number of worker processes.
+            min_backoff: Restart delay after the first crash.
+            max_backoff: Upper bound of the restart delay, which doubles on each crash.
+            min_uptime: A worker running longer than this resets its backoff.
+            stop_timeout: Seconds to wait for workers after SIGTERM before sending SIGKILL.
+            recycle_stagger: Min seconds between the replacement of two recycled workers.
+        """
+        self.svc = svc
+        self.workdir = workdir
+        self.workers = workers
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.min_uptime = min_uptime
+        self.stop_timeout = stop_timeout
+        self.slot_pid = [None] * workers
+        self.slot_started = [0.0] * workers
+        self.slot_backoff = [min_backoff] * workers
+        self.restart_at = {}
+        self.pid_slot = {}
+        self.stopping = False
+        self.recycle_stagger = recycle_stagger
+        self.recycle_queue = []
+        self.recycling = None
+        self.recycle_deadline = None
+        self.next_recycle = 0.0
+        self.recycles = svc.metrics.counter('mservice_worker_recycles_total', 'Workers replaced by their watchdog')
+        self._recycle_r = None
+        self._recycle_w = None
+
+    @property
+    def logger(self):
+        return self.svc.logger
+
+    def _spawn(self, slot):
+        global terminate, hup_recv
+        pid = os.fork()
+        if pid == 0:
+            # Worker. Never return into the caller, it holds the pid file context.
+            exit_code = 1
+            try:
+                waker.close()
+                self.svc.state.after_fork()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, term_handler)
+                signal.signal(signal.SIGHUP, hup_handler)
+                signal.signal(signal.SIGUSR1, usr1_handler)
+                signal.signal(signal.SIGUSR2, usr2_handler)
+                terminate = False
+                hup_recv = 0
+                os.close(self._recycle_r)
+                self.svc._recycle_fd = self._recycle_w
+                exit_code = self.svc._run_worker(self.workdir, slot)
+            finally:
+                os._exit(exit_code)
+        self.slot_pid[slot] = pid
+        self.slot_started[slot] = monotonic()
+        self.pid_slot[pid] = slot
+        self.logger.info('Started worker %d in slot %d', pid, slot)
+
+    def _reap(self):
+        while self.pid_slot:
             try:
-                os.remove(self.state.pidfile)
-            except:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    self.pid_slot.clear()
+                    break
+                raise
+            if pid == 0:
+                break
+            slot = self.pid_slot.pop(pid, None)
+            if slot is None:
+                continue
+            self.slot_pid[slot] = None
+            if self.stopping:
+                continue
+            recycled = slot == self.recycling
+            if slot in self.recycle_queue:
+                self.recycle_queue.remove(slot)
+            if recycled:
+                self.recycling = None
+                self.next_recycle = monotonic() + self.recycle_stagger
+            if recycled or (os.WIFEXITED(status) and os.WEXITSTATUS(status) == RECYCLE_EXIT_CODE):
+                self.logger.info('Worker %d in slot %d recycled, replacing it', pid, slot)
+                self.recycles.inc()
+                self.restart_at[slot] = monotonic()
+                continue
+            if os.WIFSIGNALED(status):
+                self.logger.error('Worker %d killed by signal %d', pid, os.WTERMSIG(status))
+            else:
+                self.logger.error('Worker %d exited with status %d', pid, os.WEXITSTATUS(status))
+            now = monotonic()
+            if (now - self.slot_started[slot]) >= self.min_uptime:
+                self.slot_backoff[slot] = self.min_backoff
+            delay = self.slot_backoff[slot]
+            self.slot_backoff[slot] = min(delay * 2, self.max_backoff)
+            self.restart_at[slot] = now + delay
+            self.logger.info('Restarting slot %d in %.1f seconds', slot, delay)
+
+    def _signal_all(self, signum):
+        for pid in list(self.pid_slot.keys()):
+            try:
+                os.kill(pid, signum)
+            except OSError:
                 pass
 
+    def _read_recycle_requests(self):
+        try:
+            data = os.read(self._recycle_r, 512)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        # Writes of 2 bytes are atomic so requests are never split.
+        for i in range(0, len(data) - 1, 2):
+            slot = struct.unpack('!H', data[i:i + 2])[0]
+            if slot < self.workers and slot != self.recycling and slot not in self.recycle_queue:
+                self.recycle_queue.append(slot)
+
+    def _recycle_next(self, now):
+        if self.recycling is not None or not self.recycle_queue or now < self.next_recycle:
+            return
+        slot = self.recycle_queue.pop(0)
+        pid = self.slot_pid[slot]
+        if pid is None:
+            return
+        self.logger.info('Recycling worker %d in slot %d', pid, slot)
+        self.recycling = slot
+        self.recycle_deadline = now + self.stop_timeout
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def _kill_recycling(self, now):
+        if self.recycling is None or self.recycle_deadline is None or now < self.recycle_deadline:
+            return
+        self.recycle_deadline = None
+        pid = self.slot_pid[self.recycling]
+        if pid is None:
+            return
+        self.logger.warning('Recycled worker %d still running after %s seconds, sending SIGKILL',
+                            pid, self.stop_timeout)
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def _forward_handler(self, signum, frame):
+        self._signal_all(signum)
+
+    def _stop_all(self):
+        self.stopping = True
+        self._signal_all(signal.SIGTERM)
+        deadline = monotonic() + self.stop_timeout
+        while self.pid_slot:
+            self._reap()
+            remaining = deadline - monotonic()
+            if not self.pid_slot:
+                break
+            if remaining <= 0:
+                self.logger.warning('Workers still running after %s seconds, sending SIGKILL',
+                                    self.stop_timeout)
+                self._signal_all(signal.SIGKILL)
+                for pid in list(self.pid_slot.keys()):
+                    try:
+                        os.waitpid(pid, 0)
+                    except OSError:
+                        pass
+                self.pid_slot.clear()
+                break
+            waker.wait(min(remaining, 1.0))
+
+    def run(self):
+        """Fork the workers and supervise them until SIGTERM is received."""
+        prev_chld = signal.signal(signal.SIGCHLD, chld_handler)
+        # The supervisor has no service code to inspect, stack dumps and profiles are done by workers.
+        prev_usr = [signal.signal(signum, self._forward_handler) for signum in (signal.SIGUSR1, signal.SIGUSR2)]
+        waker.open()
+        self._recycle_r, self._recycle_w = os.pipe()
+        flags = fcntl.fcntl(self._recycle_r, fcntl.F_GETFL)
+        fcntl.fcntl(self._recycle_r, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        try:
+            for slot in range(self.workers):
+                self._spawn(slot)
+            self.logger.info('Service started with %d workers', self.workers)
+            count = hup_recv
+            while not terminate:
+                self._reap()
+                if hup_recv != count:
+                    count = hup_recv
+                    self.logger.info('HUP received, forwarding to workers')
+                    self._signal_all(signal.SIGHUP)
+                self._read_recycle_requests()
+                now = monotonic()
+                self._recycle_next(now)
+                self._kill_recycling(now)
+                for slot, due in list(self.restart_at.items()):
+                    if due <= now and not terminate:
+                        del self.restart_at[slot]
+                        self._spawn(slot)
+                timeout = 5.0
+                if self.restart_at:
+                    timeout = min(timeout, max(min(self.restart_at.values()) - now, 0))
+                if self.recycle_queue and self.recycling is None:
+                    timeout = min(timeout, max(self.next_recycle - now, 0))
+                if self.recycling is not None and self.recycle_deadline is not None:
+                    timeout = min(timeout, max(self.recycle_deadline - now, 0))
+                waker.wait(timeout, (self._recycle_r,))
+            self.logger.info('TERM received, stopping workers')
+        finally:
+            self._stop_all()
+            os.close(self._recycle_r)
+            os.close(self._recycle_w)
+            waker.close()
+            signal.signal(signal.SIGCHLD, prev_chld)
+            signal.signal(signal.SIGUSR1, prev_usr[0])
+            signal.signal(signal.SIGUSR2, prev_usr[1])
+
 
 def init_log_handler(log_handler, log_level):
     log_handler.setLevel(log_level)
@@ -269,6 +1938,29 @@ def init_parser_options(parser):
                       help='Logging file, defaults to console or AWS CloudWatch when running as a daemon.')
     parser.add_option('-F', '--ghost-log-file', type='string', action='store', dest='ghost_log_file',
                       help='Logging file for ghostdriver, defaults to /working/dir/ghostdriver.log')
+    parser.add_option('--log-queue-size', type='int', action='store', dest='log_queue_size', default=10000,
+                      help='Max log records queued for the log file or AWS CloudWatch, defaults to 10000.')
+    parser.add_option('--log-max-bytes', type='int', action='store', dest='log_max_bytes', default=100 * 1024 * 1024,
+                      help='Rotate the log file before it grows past this size, defaults to 100 MB. Zero disables.')
+    parser.add_option('--log-rotate-seconds', type='int', action='store', dest='log_rotate_seconds', default=0,
+                      help='Rotate the log file at multiples of this many seconds, 86400 rotates at midnight UTC. '
+                           'Defaults to 0 (disabled).')
+    parser.add_option('--log-backup-count', type='int', action='store', dest='log_backup_count', default=10,
+                      help='Rotated log files kept, defaults to 10.')
+    parser.add_option('--log-no-compress', action='store_false', dest='log_compress', default=True,
+                      help='Do not gzip rotated log files.')
+    parser.add_option('--log-overflow', type='choice', action='store', dest='log_overflow',
+                      choices=list(LogRecordBuffer.POLICIES), default=LogRecordBuffer.DROP_OLDEST,
+                      help='What to do when the log queue is full: %s. Defaults to %s.' %
+                           (', '.join(LogRecordBuffer.POLICIES), LogRecordBuffer.DROP_OLDEST))
+    parser.add_option('--log-rate', type='float', action='store', dest='log_rate', default=0,
+                      help='Max log records per second from each call site and level, defaults to 0 (unlimited).')
+    parser.add_option('--log-burst', type='int', action='store', dest='log_burst', default=10,
+                      help='Max burst of log records from each call site and level, defaults to 10.')
+    parser.add_option('--log-rate-global', type='float', action='store', dest='log_rate_global', default=0,
+                      help='Max log records per second from the service, defaults to 0 (unlimited).')
+    parser.add_option('--log-summary-interval', type='float', action='store', dest='log_summary_interval',
+                      default=60, help='Seconds between reports of rate limited log records, defaults to 60.')
     parser.add_option('-d', '--daemonize', action='store_true', dest='daemonize', default=False,
                       help='Run as a daemon.')
     parser.add_option('-U', '--user', type='string', action='store', dest='user',
@@ -277,6 +1969,35 @@ def init_parser_options(parser):
                       help='Runs the daemon in the group context. A name or gid can be given.')
     parser.add_option('-p', '--pid-file', type='string', action='store', dest='pid_file',
                       help='PID lock file, defaults to the current directory.')
+    parser.add_option('-w', '--workers', type='int', action='store', dest='workers', default=1,
+                      help='Number of worker processes, defaults to 1. More than 1 runs a supervisor that forks '
+                           'the workers.')
+    parser.add_option('--metrics-port', type='int', action='store', dest='metrics_port',
+                      help='Serve metrics in the Prometheus text format on this port. Workers use port + slot.')
+    parser.add_option('--metrics-file', type='string', action='store', dest='metrics_file',
+                      help='Write metrics in the Prometheus text format to this file every 15 seconds.')
+    parser.add_option('--health-port', type='int', action='store', dest='health_port',
+                      help='Serve liveness and readiness over HTTP on this port. Workers use port + slot.')
+    parser.add_option('--health-socket', type='string', action='store', dest='health_socket',
+                      help='Serve liveness and readiness over HTTP on this Unix socket. Workers use path.slot.')
+    parser.add_option('--shutdown-timeout', type='float', action='store', dest='shutdown_timeout', default=10.0,
+                      help='Seconds allowed to stop the service after SIGTERM, after which it exits. Zero is '
+                           'unlimited. Defaults to 10.')
+    parser.add_option('--profile-seconds', type='float', action='store', dest='profile_seconds', default=30.0,
+                      help='Seconds to profile for on SIGUSR2, defaults to 30. SIGUSR1 dumps thread stacks. Output '
+                           'is written to the pid file directory.')
+    parser.add_option('--profile-interval', type='float', action='store', dest='profile_interval', default=10.0,
+                      help='Milliseconds between profiler samples, defaults to 10.')
+    parser.add_option('--max-rss', type='float', action='store', dest='max_rss',
+                      help='Recycle a process whose resident memory exceeds this many MB.')
+    parser.add_option('--max-wake-seconds', type='float', action='store', dest='max_wake_seconds',
+                      help='Recycle a process when 3 calls to on_wake() within 5 seconds take longer than this.')
+    parser.add_option('--max-wakes', type='int', action='store', dest='max_wakes',
+                      help='Recycle a process after this many calls to on_wake(), plus up to 10%.')
+    parser.add_option('--max-uptime', type='float', action='store', dest='max_uptime',
+                      help='Recycle a process after this many seconds, plus up to 10%.')
+    parser.add_option('--recycle-stagger', type='float', action='store', dest='recycle_stagger', default=30.0,
+                      help='Min seconds between recycling two workers, defaults to 30.')
     parser.add_option('-v', '--verbose', action='store_true', dest='verbose', default=False, help='Verbose output.')
 
 
@@ -311,23 +2032,50 @@ def process_parser_options(options, svc_name, stream_name=None):
     root_logger = logging.getLogger('marbles')
     root_logger.setLevel(log_level)
     actual_logger = logging.getLogger('marbles.svc.' + svc_name)
-    logger = ExceptionRateLimitedLogAdaptor(actual_logger)
+    limiter = None
+    if options.log_rate > 0 or options.log_rate_global > 0:
+        limiter = LogRateLimiter(rate=options.log_rate, burst=options.log_burst,
+                                 global_rate=options.log_rate_global,
+                                 summary_interval=options.log_summary_interval)
+    logger = ExceptionRateLimitedLogAdaptor(actual_logger, limiter=limiter,
+                                            summary_interval=options.log_summary_interval)
+    if limiter is not None:
+        metrics.default_registry.counter('mservice_log_records_suppressed_total', 'Log records suppressed by rate limit',
+                                         fn=lambda: limiter.suppressed)
     if stream_name is None:
         stream_name = 'svc-' + svc_name
 
     console_handler = None
     if options.log_file:
-        log_handler = logging.FileHandler(options.log_file, mode='a')
+        # Formatted and written by a background thread, the caller only queues the record.
+        log_handler = RotatingFileLogHandler(options.log_file,
+                                             capacity=options.log_queue_size,
+                                             overflow=options.log_overflow,
+                                             max_bytes=options.log_max_bytes,
+                                             rotate_seconds=options.log_rotate_seconds,
+                                             backup_count=options.log_backup_count,
+                                             compress=options.log_compress)
+        init_log_handler(log_handler, log_level)
     else:
         if not options.daemonize:
             console_handler = logging.StreamHandler()   # Log to console
             init_log_handler(console_handler, log_level)
             root_logger.addHandler(console_handler)
-        log_handler = watchtower.CloudWatchLogHandler(log_group='core-nlp-services',
-                                                      use_queues=False, # Does not shutdown if True
-                                                      stream_name=stream_name,
-                                                      create_log_group=False)
-    init_log_handler(log_handler, log_level)
+        # Watchtower's own queues do not shutdown so it is used synchronously from our background
+        # handler, which is stopped by the executor. Imported here because it loads boto3, which is
+        # slow and large, and only CloudWatch logging needs it.
+        import watchtower
+        cloudwatch_handler = watchtower.CloudWatchLogHandler(log_group='core-nlp-services',
+                                                             use_queues=False,
+                                                             stream_name=stream_name,
+                                                             create_log_group=False)
+        init_log_handler(cloudwatch_handler, log_level)
+        log_handler = BatchingLogHandler(HandlerSink(cloudwatch_handler),
+                                         capacity=options.log_queue_size,
+                                         overflow=options.log_overflow)
+        log_handler.setLevel(log_level)
+    metrics.default_registry.counter('mservice_log_records_dropped_total', 'Log records dropped by a full queue',
+                                     fn=lambda: log_handler.dropped)
     root_logger.addHandler(log_handler)
 
     if options.pid_file is None:
@@ -339,5 +2087,13 @@ def process_parser_options(options, svc_name, stream_name=None):
 
     return DefaultServiceState(svcname=svc_name, logger=logger, root_logger=root_logger,
                                rundir=rundir, pidfile=pid_file, daemonize=options.daemonize,
-                               uid=uid, gid=gid)
+                               uid=uid, gid=gid, workers=max(options.workers or 1, 1),
+                               metrics_port=options.metrics_port, metrics_file=options.metrics_file,
+                               health_port=options.health_port, health_socket=options.health_socket,
+                               shutdown_timeout=options.shutdown_timeout or None,
+                               profile_seconds=options.profile_seconds,
+                               profile_interval=options.profile_interval / 1000.0,
+                               max_rss=int(options.max_rss * 2 ** 20) if options.max_rss else None,
+                               max_wake_seconds=options.max_wake_seconds, max_wakes=options.max_wakes,
+                               max_uptime=options.max_uptime, recycle_stagger=options.recycle_stagger)
 
@@ -1,30 +1,90 @@
-from google.protobuf import empty_pb2
-import grpc
-import os
+import sys
+import types
 import logging
-import discovery_pb2.py
-import discovery_pb2_grpc.py
+import importlib
 
 
 _logger = logging.getLogger(__name__)
 
+# Names loaded on first access so importing grpc_core does not load grpc and protobuf until they
+# are used. Maps a name to (module, attribute), attribute None is the module itself.
+_LAZY = {
+    'grpc': ('grpc', None),
+    'empty_pb2': ('google.protobuf.empty_pb2', None),
+    'discovery_pb2': ('discovery_pb2', None),
+    'discovery_pb2_grpc': ('discovery_pb2_grpc', None),
+    'ChannelPool': ('.pool', 'ChannelPool'),
+    'get_default_pool': ('.pool', 'get_default_pool'),
+    'set_default_pool': ('.pool', 'set_default_pool'),
+    'close_default_pool': ('.pool', 'close_default_pool'),
+    'configure_endpoints': ('.configure', 'configure_endpoints'),
+    'EndpointResult': ('.configure', 'EndpointResult'),
+    'ConfigureDeadlineExceeded': ('.configure', 'ConfigureDeadlineExceeded'),
+    'TRANSIENT_STATUS_CODES': ('.configure', 'TRANSIENT_STATUS_CODES'),
+    'GrpcServiceExecutor': ('.server', 'GrpcServiceExecutor'),
+    'DiscoveryClient': ('.discovery', 'DiscoveryClient'),
+    'Endpoint': ('.discovery', 'Endpoint'),
+    'ServiceNotFound': ('.discovery', 'ServiceNotFound'),
+    'ResiliencePolicy': ('.resilience', 'ResiliencePolicy'),
+    'CallRejected': ('.resilience', 'CallRejected'),
+}
 
-def get_client_transport(stub_class, host, port):
-    """Open a connection to the gRPC service endpoint
+
+class _LazyModule(types.ModuleType):
+    # A module __getattr__ needs Python 3.7, the class of the module is replaced instead.
+
+    def __getattr__(self, name):
+        try:
+            module_name, attr = _LAZY[name]
+        except KeyError:
+            raise AttributeError('module %r has no attribute %r' % (__name__, name))
+        module = importlib.import_module(module_name, __name__)
+        value = module if attr is None else getattr(module, attr)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_LAZY))
+
+
+def get_client_transport(stub_class, host, port, pool=None):
+    """Open a connection to the gRPC service endpoint. Channels are reused from a ChannelPool so
+    calling this per request is cheap. The channel is owned by the pool and must not be closed.
 
     Args:
         stub_class: A grpc endpoint definition (the stub).
         host: The host domain name. Set to local_host if running locally.
         port: The service port.
+        pool: The ChannelPool, defaults to the process wide pool.
 
     Returns:
         A tuple of the client end-point stub and channel
     """
-    channel = grpc.insecure_channel('%s:%u' % (host, port))
+    if pool is None:
+        from .pool import get_default_pool
+        pool = get_default_pool()
+    channel = pool.get(host, port)
     stub = stub_class(channel)
     return stub, channel
 
 
+def get_service_transport(stub_class, service, discovery, pool=None):
+    """Open a connection to an endpoint of a service resolved from a DiscoveryClient. Resolution is
+    served from the client cache so calling this per request is cheap.
+
+    Args:
+        stub_class: A grpc endpoint definition (the stub).
+        service: The service name.
+        discovery: The DiscoveryClient.
+        pool: The ChannelPool, defaults to the process wide pool.
+
+    Returns:
+        A tuple of the client end-point stub and channel
+    """
+    endpoint = discovery.resolve(service)
+    return get_client_transport(stub_class, endpoint.host, endpoint.port, pool)
+
+
 def configure_endpoint(stub, configuration, timeout=120):
     """Configure a service endpoint asynchronously.
 
@@ -32,8 +92,19 @@ def configure_endpoint(stub, configuration, timeout=120):
     :param configuration: The configuration.
     :param timeout: optional timeout
     :return: A ConfigResult instance.
+
+    Use configure_endpoints() to configure many endpoints concurrently.
     """
     config_future = stub.configure.future(configuration, timeout)
     return config_future.result()
 
 
+try:
+    sys.modules[__name__].__class__ = _LazyModule
+except TypeError:
+    # Python 2 modules cannot change class, replace the module with a lazy copy. The copy holds the
+    # original, which would otherwise clear the globals of these functions when collected.
+    _module = _LazyModule(__name__, __doc__)
+    _module.__dict__.update(globals())
+    _module._original = sys.modules[__name__]
+    sys.modules[__name__] = _module
@@ -0,0 +1,114 @@
+from __future__ import unicode_literals, print_function
+import grpc
+import time
+import random
+import heapq
+import collections
+import logging
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+_logger = logging.getLogger(__name__)
+
+# Python 2 has no monotonic clock.
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+# Status codes retried by default. UNAVAILABLE means the endpoint did not process the call. After
+# DEADLINE_EXCEEDED, ABORTED or RESOURCE_EXHAUSTED it may have applied the configuration, so pass
+# them in retry_codes only if configure is idempotent.
+TRANSIENT_STATUS_CODES = (
+    grpc.StatusCode.UNAVAILABLE,
+)
+
+
+class ConfigureDeadlineExceeded(Exception):
+    """The overall deadline of configure_endpoints() expired before the endpoint was configured."""
+    pass
+
+
+EndpointResult = collections.namedtuple('EndpointResult', ['stub', 'result', 'error', 'attempts'])
+EndpointResult.__doc__ = """Outcome of configuring one endpoint. Exactly one of result or error is set."""
+
+
+def configure_endpoints(stubs, configuration, max_concurrency=16, timeout=120, deadline=None, retries=3,
+                        backoff=0.1, max_backoff=5.0, retry_codes=TRANSIENT_STATUS_CODES):
+    """Configure many service endpoints concurrently. Results are yielded as each endpoint finishes so
+    the total time is bounded by the slowest endpoint rather than the sum of all of them.
+
+    :param stubs: Client end-point stubs returned from get_client_transport().
+    :param configuration: The configuration sent to every endpoint.
+    :param max_concurrency: Max number of configure calls in flight.
+    :param timeout: Deadline in seconds for each call.
+    :param deadline: Optional deadline in seconds for the whole operation. Endpoints not configured
+        when it expires are reported with a ConfigureDeadlineExceeded error.
+    :param retries: Max retries per endpoint for status codes in retry_codes.
+    :param backoff: Initial retry delay in seconds. Delays double per attempt with full jitter.
+    :param max_backoff: Max retry delay in seconds.
+    :param retry_codes: Status codes that are retried, add codes after which the endpoint may have
+        applied the configuration only if configure is idempotent.
+    :return: An iterator of EndpointResult.
+    """
+    ready = collections.deque((stub, 1) for stub in stubs)
+    retry_heap = []     # (due time, sequence, stub, attempt)
+    done = queue.Queue()
+    in_flight = {}
+    seq = 0
+    end = None if deadline is None else _monotonic() + deadline
+    max_concurrency = max(max_concurrency, 1)
+
+    def on_done(stub, attempt, future):
+        done.put((stub, attempt, future))
+
+    try:
+        while ready or retry_heap or in_flight:
+            now = _monotonic()
+            while retry_heap and retry_heap[0][0] <= now:
+                _, _, stub, attempt = heapq.heappop(retry_heap)
+                ready.append((stub, attempt))
+
+            while ready and len(in_flight) < max_concurrency:
+                stub, attempt = ready.popleft()
+                call_timeout = timeout if end is None else min(timeout, end - _monotonic())
+                if call_timeout <= 0:
+                    yield EndpointResult(stub, None, ConfigureDeadlineExceeded(), attempt - 1)
+                    continue
+                future = stub.configure.future(configuration, call_timeout)
+                in_flight[future] = stub
+                future.add_done_callback(lambda f, s=stub, a=attempt: on_done(s, a, f))
+
+            if not in_flight and not retry_heap:
+                break
+
+            # Calls in flight finish by the overall deadline because their own deadline is capped by
+            # it, and retries are only scheduled before it.
+            wait = None
+            if retry_heap:
+                wait = max(retry_heap[0][0] - now, 0)
+            try:
+                stub, attempt, future = done.get(timeout=wait)
+            except queue.Empty:
+                continue
+            del in_flight[future]
+
+            error = future.exception()
+            if error is None:
+                yield EndpointResult(stub, future.result(), None, attempt)
+                continue
+            code = error.code() if callable(getattr(error, 'code', None)) else None
+            if code in retry_codes and attempt <= retries:
+                delay = random.uniform(0, min(max_backoff, backoff * (2 ** (attempt - 1))))
+                due = _monotonic() + delay
+                if end is None or due < end:
+                    _logger.debug('Retrying configure in %.3f seconds, status %s', delay, code)
+                    seq += 1
+                    heapq.heappush(retry_heap, (due, seq, stub, attempt + 1))
+                    continue
+            yield EndpointResult(stub, None, error, attempt)
+    finally:
+        # Only reached with calls in flight if the caller stopped iterating.
+        for future in list(in_flight.keys()):
+            future.cancel()
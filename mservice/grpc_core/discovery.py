@@ -0,0 +1,408 @@
+from __future__ import unicode_literals, print_function
+import time
+import heapq
+import random
+import itertools
+import threading
+import collections
+import logging
+
+
+_logger = logging.getLogger(__name__)
+
+# Python 2 has no monotonic clock.
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+class Endpoint(collections.namedtuple('Endpoint', ['host', 'port'])):
+    """A resolved service endpoint."""
+    __slots__ = ()
+
+
+class ServiceNotFound(Exception):
+    """The service has no endpoints, or its first lookup failed."""
+    pass
+
+
+class PickFirst(object):
+    """Always pick the first endpoint, the others are fallbacks for when it is removed."""
+    name = 'pick-first'
+
+    def __init__(self, endpoints, previous=None):
+        self.endpoints = endpoints
+
+    def pick(self):
+        return self.endpoints[0]
+
+    def acquire(self):
+        return self.pick()
+
+    def release(self, endpoint):
+        pass
+
+
+class RoundRobin(PickFirst):
+    """Pick endpoints in turn. next() on an itertools.count is atomic under the GIL so no lock is taken."""
+    name = 'round-robin'
+
+    def __init__(self, endpoints, previous=None):
+        super(RoundRobin, self).__init__(endpoints)
+        # Random start so a fleet of clients does not hit the same endpoint first.
+        self._counter = itertools.count(random.randrange(len(endpoints)))
+
+    def pick(self):
+        return self.endpoints[next(self._counter) % len(self.endpoints)]
+
+
+class LeastOutstanding(PickFirst):
+    """Pick the endpoint with the fewest calls in flight. Calls must be bracketed by acquire() and
+    release(), see DiscoveryClient.endpoint(). The counts are shared with the balancer being replaced
+    when endpoints are refreshed, so calls acquired before a refresh are released correctly.
+    """
+    name = 'least-outstanding'
+
+    def __init__(self, endpoints, previous=None):
+        super(LeastOutstanding, self).__init__(endpoints)
+        if isinstance(previous, LeastOutstanding):
+            self.outstanding = previous.outstanding
+            self._lock = previous._lock
+        else:
+            self.outstanding = {}
+            self._lock = threading.Lock()
+        with self._lock:
+            for endpoint in endpoints:
+                self.outstanding.setdefault(endpoint, 0)
+        self._counter = itertools.count(random.randrange(len(endpoints)))
+
+    def pick(self):
+        # Start the scan at a rotating offset so ties are spread.
+        n = len(self.endpoints)
+        start = next(self._counter) % n
+        outstanding = self.outstanding
+        best = None
+        for i in range(n):
+            endpoint = self.endpoints[(start + i) % n]
+            if best is None or outstanding[endpoint] < outstanding[best]:
+                best = endpoint
+        return best
+
+    def acquire(self):
+        with self._lock:
+            endpoint = self.pick()
+            self.outstanding[endpoint] += 1
+        return endpoint
+
+    def release(self, endpoint):
+        with self._lock:
+            if self.outstanding.get(endpoint, 0) > 0:
+                self.outstanding[endpoint] -= 1
+
+
+BALANCERS = dict((cls.name, cls) for cls in (PickFirst, RoundRobin, LeastOutstanding))
+
+
+class _Entry(object):
+    __slots__ = ('name', 'endpoints', 'balancer', 'active', 'hits', 'seen_hits', 'failures', 'watcher',
+                 'stream')
+
+    def __init__(self, name, endpoints, balancer, now):
+        self.name = name
+        self.endpoints = endpoints
+        self.balancer = balancer
+        self.active = now       # Last time resolve() was seen to be called, checked by the poller.
+        self.hits = 0
+        self.seen_hits = 0
+        self.failures = 0
+        self.watcher = None
+        self.stream = None
+
+
+class _Lease(object):
+
+    def __init__(self, balancer, endpoint):
+        self.balancer = balancer
+        self.endpoint = endpoint
+
+    def __enter__(self):
+        return self.endpoint
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.balancer.release(self.endpoint)
+        return False
+
+
+class DiscoveryClient(object):
+    """Client side cache of service endpoints.
+
+    Endpoints of each service name are kept in memory and refreshed in the background, either by
+    polling `lookup` every `ttl` seconds or by consuming a `watch` stream, so resolve() is a dict
+    lookup and a balancer pick. If a refresh fails the last endpoints are served until it succeeds.
+    Only the first resolution of a name blocks on a lookup, use add() to load names ahead of time.
+
+    The lookup and watch functions adapt the discovery service, for example:
+
+        lookup = lambda name: [(e.host, e.port) for e in stub.resolve(Request(name=name), 5).endpoints]
+    """
+
+    def __init__(self, lookup, watch=None, ttl=30.0, balancer=RoundRobin.name, idle_timeout=600.0,
+                 min_backoff=0.5, max_backoff=30.0):
+        """Constructor
+
+        Args:
+            lookup: Function taking a service name and returning a list of (host, port) tuples.
+            watch: Optional function taking a service name and returning an iterator that yields a list of
+                (host, port) tuples each time the endpoints change. If given it is used instead of polling.
+            ttl: Seconds between polls of `lookup`.
+            balancer: 'pick-first', 'round-robin' or 'least-outstanding'.
+            idle_timeout: Names not resolved for this many seconds are dropped. Zero or None disables.
+                The watch of a dropped name is cancelled if its stream has a cancel() method, as gRPC
+                response streams do, otherwise it ends when the stream next yields.
+            min_backoff: Delay before retrying a failed refresh or a broken watch.
+            max_backoff: Upper bound of the retry delay, which doubles on each failure.
+        """
+        if balancer not in BALANCERS:
+            raise ValueError('balancer must be one of %s' % ', '.join(sorted(BALANCERS)))
+        self.lookup = lookup
+        self.watch = watch
+        self.ttl = ttl
+        self.balancer_class = BALANCERS[balancer]
+        self.idle_timeout = idle_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self._entries = {}
+        self._heap = []         # (due, sequence, name)
+        self._seq = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+        self._closed = False
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def endpoints(self, name):
+        """The cached endpoints of a service, loading it if needed."""
+        entry = self._entries.get(name)
+        if entry is None:
+            entry = self._load(name)
+        return entry.endpoints
+
+    def resolve(self, name):
+        """Pick an endpoint of a service.
+
+        Returns:
+            An Endpoint.
+
+        Raises:
+            ServiceNotFound: if the first lookup of the name failed or returned no endpoints.
+        """
+        entry = self._entries.get(name)
+        if entry is None:
+            entry = self._load(name)
+        entry.hits += 1
+        return entry.balancer.pick()
+
+    def endpoint(self, name):
+        """Context manager picking an endpoint and counting it as outstanding until the block exits,
+        for the least-outstanding balancer.
+
+            with discovery.endpoint('parser') as endpoint:
+                stub, channel = get_client_transport(ParserStub, endpoint.host, endpoint.port)
+                stub.parse(request)
+        """
+        entry = self._entries.get(name)
+        if entry is None:
+            entry = self._load(name)
+        entry.hits += 1
+        balancer = entry.balancer
+        return _Lease(balancer, balancer.acquire())
+
+    def add(self, name):
+        """Load a service name and keep it refreshed. Returns its endpoints."""
+        return self.endpoints(name)
+
+    def remove(self, name):
+        """Stop refreshing a service name."""
+        with self._cond:
+            entry = self._entries.pop(name, None)
+        if entry is not None:
+            self._cancel_watch(name, entry.stream)
+
+    def _make_entry(self, name, endpoints, previous=None):
+        endpoints = tuple(Endpoint(host, int(port)) for host, port in endpoints)
+        if not endpoints:
+            return None
+        balancer = self.balancer_class(endpoints, previous.balancer if previous is not None else None)
+        return _Entry(name, endpoints, balancer, _monotonic())
+
+    def _load(self, name):
+        if self._closed:
+            raise ServiceNotFound(name)
+        try:
+            found = self.lookup(name)
+        except Exception as e:
+            raise ServiceNotFound('%s: %s' % (name, e))
+        entry = self._make_entry(name, found)
+        if entry is None:
+            raise ServiceNotFound(name)
+        with self._cond:
+            current = self._entries.get(name)
+            if current is not None:
+                # Another thread loaded it first.
+                return current
+            self._entries[name] = entry
+            if self.watch is not None:
+                self._start_watch(entry)
+                if self.idle_timeout:
+                    self._schedule(name, entry.active + self.idle_timeout)
+            else:
+                self._schedule(name, _monotonic() + self.ttl)
+        return entry
+
+    def _schedule(self, name, due):
+        # Caller holds the lock.
+        self._seq += 1
+        heapq.heappush(self._heap, (due, self._seq, name))
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._poll_loop, name='mservice-discovery')
+            self._thread.daemon = True
+            self._thread.start()
+        self._cond.notify()
+
+    def _backoff(self, failures):
+        return random.uniform(0, min(self.max_backoff, self.min_backoff * (2 ** min(failures, 16))))
+
+    def _idle(self, entry, now):
+        if entry.hits != entry.seen_hits:
+            entry.seen_hits = entry.hits
+            entry.active = now
+            return False
+        return bool(self.idle_timeout) and now - entry.active > self.idle_timeout
+
+    def _poll_loop(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    now = _monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                if self._closed:
+                    return
+                name = heapq.heappop(self._heap)[2]
+                entry = self._entries.get(name)
+            if entry is None:
+                continue
+            now = _monotonic()
+            if entry.watcher is not None:
+                # Watched names are refreshed by their stream, the poller only drops them when idle.
+                with self._cond:
+                    entry = self._entries.get(name)
+                    if entry is None:
+                        continue
+                    if not self._idle(entry, now):
+                        self._schedule(name, entry.active + self.idle_timeout)
+                        continue
+                    del self._entries[name]
+                _logger.debug('Dropping idle service %s', name)
+                self._cancel_watch(name, entry.stream)
+                continue
+            if self._idle(entry, now):
+                _logger.debug('Dropping idle service %s', name)
+                with self._cond:
+                    if self._entries.get(name) is entry:
+                        del self._entries[name]
+                continue
+            self._refresh(entry)
+
+    def _refresh(self, entry):
+        try:
+            new = self._make_entry(entry.name, self.lookup(entry.name), entry)
+            if new is None:
+                raise ServiceNotFound(entry.name)
+        except Exception as e:
+            entry.failures += 1
+            delay = self._backoff(entry.failures)
+            _logger.warning('Cannot refresh service %s, serving %d cached endpoints, retry in %.1f seconds: %s',
+                            entry.name, len(entry.endpoints), delay, e)
+            with self._cond:
+                if self._entries.get(entry.name) is entry:
+                    self._schedule(entry.name, _monotonic() + delay)
+            return
+        new.hits = new.seen_hits = entry.hits
+        new.active = entry.active
+        with self._cond:
+            if self._entries.get(entry.name) is entry:
+                self._entries[entry.name] = new
+                self._schedule(entry.name, _monotonic() + self.ttl)
+
+    def _start_watch(self, entry):
+        # Caller holds the lock.
+        thread = threading.Thread(target=self._watch_loop, args=(entry.name,), name='mservice-discovery-watch')
+        thread.daemon = True
+        entry.watcher = thread
+        thread.start()
+
+    def _cancel_watch(self, name, stream):
+        cancel = getattr(stream, 'cancel', None)
+        if cancel is not None:
+            try:
+                cancel()
+            except Exception as e:
+                _logger.debug('Cannot cancel watch of service %s: %s', name, e)
+
+    def _watched(self, name):
+        # Caller holds the lock. The entry of a name watched by the calling thread, None once the name
+        # was dropped, even if it was loaded again since with another watch.
+        entry = self._entries.get(name)
+        if entry is None or entry.watcher is not threading.current_thread():
+            return None
+        return entry
+
+    def _watch_loop(self, name):
+        failures = 0
+        while not self._closed:
+            try:
+                stream = self.watch(name)
+                with self._cond:
+                    entry = self._watched(name)
+                    if entry is None:
+                        self._cancel_watch(name, stream)
+                        return
+                    entry.stream = stream
+                for found in stream:
+                    failures = 0
+                    with self._cond:
+                        entry = self._watched(name)
+                        if entry is None or self._closed:
+                            return
+                        new = self._make_entry(name, found, entry)
+                        if new is None:
+                            _logger.warning('Service %s has no endpoints, serving %d cached endpoints',
+                                            name, len(entry.endpoints))
+                            continue
+                        # Keep the activity seen by the poller so updates do not keep a name alive.
+                        new.hits = entry.hits
+                        new.seen_hits = entry.seen_hits
+                        new.active = entry.active
+                        new.watcher = entry.watcher
+                        new.stream = entry.stream
+                        self._entries[name] = new
+            except Exception as e:
+                if self._watched(name) is not None:
+                    _logger.warning('Watch of service %s failed, serving cached endpoints: %s', name, e)
+            failures += 1
+            with self._cond:
+                if self._watched(name) is None:
+                    return
+                if not self._closed:
+                    self._cond.wait(self._backoff(failures))
+
+    def close(self):
+        """Stop refreshing. Cached endpoints can still be resolved. A watch blocked waiting for its
+        stream ends when the stream yields or fails."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,181 @@
+from __future__ import unicode_literals, print_function
+import time
+import weakref
+import threading
+import logging
+
+
+_logger = logging.getLogger(__name__)
+
+# Python 2 has no monotonic clock.
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+class _PoolEntry(object):
+    __slots__ = ('channels', 'next', 'last_used')
+
+    def __init__(self, channels, now):
+        self.channels = channels
+        self.next = 0
+        self.last_used = now
+
+
+class ChannelPool(object):
+    """Cache of gRPC client channels keyed by target, channel options and compression.
+
+    Each target can be served by several channels, handed out round-robin, so load is spread over
+    more than one HTTP/2 connection. Channels are owned by the pool, callers must not close them.
+
+    Targets not handed out for `idle_timeout` seconds are dropped from the pool. Their channels are
+    not closed while stubs still hold them: gRPC closes a channel when the last reference to it is
+    garbage collected, and close() closes those still referenced.
+    """
+
+    def __init__(self, size=1, keepalive_time_ms=None, keepalive_timeout_ms=None, max_message_length=None,
+                 compression=None, idle_timeout=300.0, options=None, policy=None):
+        """Constructor
+
+        Args:
+            size: Number of channels per target.
+            keepalive_time_ms: Interval between keepalive pings, None uses the gRPC default.
+            keepalive_timeout_ms: Time to wait for a keepalive ack, None uses the gRPC default.
+            max_message_length: Max send and receive message size in bytes, None uses the gRPC default.
+            compression: Default grpc.Compression for channels.
+            idle_timeout: Seconds after which an unused target is dropped. Zero or None disables.
+            options: Extra channel options as a list of (name, value) tuples.
+            policy: A ResiliencePolicy applied to calls on the channels, None disables.
+        """
+        self.size = max(size, 1)
+        self.compression = compression
+        self.idle_timeout = idle_timeout
+        self.policy = policy
+        self.options = list(options or [])
+        if keepalive_time_ms is not None:
+            self.options.append(('grpc.keepalive_time_ms', keepalive_time_ms))
+            self.options.append(('grpc.keepalive_permit_without_calls', 1))
+        if keepalive_timeout_ms is not None:
+            self.options.append(('grpc.keepalive_timeout_ms', keepalive_timeout_ms))
+        if max_message_length is not None:
+            self.options.append(('grpc.max_send_message_length', max_message_length))
+            self.options.append(('grpc.max_receive_message_length', max_message_length))
+        if self.size > 1:
+            # Without a local subchannel pool channels to the same target share one connection.
+            self.options.append(('grpc.use_local_subchannel_pool', 1))
+        self._entries = {}
+        # Channels of dropped targets still referenced by stubs.
+        self._retired = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._next_eviction = _monotonic() + (idle_timeout or 0)
+
+    def _create(self, target, options, compression):
+        # Imported on first use so a pool can be created without loading grpc.
+        import grpc
+        if compression is not None:
+            channel = grpc.insecure_channel(target, options=options, compression=compression)
+        else:
+            channel = grpc.insecure_channel(target, options=options)
+        if self.policy is not None:
+            channel = self.policy.intercept(channel, target)
+        return channel
+
+    def get(self, host, port, options=None, compression=None):
+        """Get a channel to a gRPC service endpoint.
+
+        Args:
+            host: The host domain name.
+            port: The service port.
+            options: Extra channel options as a list of (name, value) tuples, merged with the pool options.
+            compression: A grpc.Compression, defaults to the pool compression.
+
+        Returns:
+            A grpc.Channel.
+        """
+        target = '%s:%u' % (host, port)
+        merged = self.options + list(options or [])
+        if compression is None:
+            compression = self.compression
+        key = (target, tuple(merged), compression)
+        now = _monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                channels = [self._create(target, merged, compression) for _ in range(self.size)]
+                entry = _PoolEntry(channels, now)
+                self._entries[key] = entry
+            entry.last_used = now
+            channel = entry.channels[entry.next]
+            entry.next = (entry.next + 1) % len(entry.channels)
+            if self.idle_timeout and now >= self._next_eviction:
+                self._drop_idle(now)
+        return channel
+
+    def _drop_idle(self, now):
+        # Caller holds the lock. Channels are left to the garbage collector, which closes them once
+        # no stub references them.
+        self._next_eviction = now + self.idle_timeout
+        idle = [k for k, e in self._entries.items() if (now - e.last_used) >= self.idle_timeout]
+        for k in idle:
+            _logger.debug('Dropping idle channels to %s', k[0])
+            self._retired.update(self._entries.pop(k).channels)
+
+    def evict_idle(self):
+        """Drop targets that have not been used for `idle_timeout` seconds."""
+        if not self.idle_timeout:
+            return
+        with self._lock:
+            self._drop_idle(_monotonic())
+
+    def _close_channels(self, channels):
+        for channel in channels:
+            try:
+                channel.close()
+            except Exception as e:
+                _logger.warning('Exception closing channel: %s', e)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+        """Close all channels, including those of dropped targets still referenced by stubs. The pool
+        can still be used afterwards."""
+        with self._lock:
+            channels = [c for e in self._entries.values() for c in e.channels]
+            channels.extend(self._retired)
+            self._entries = {}
+            self._retired = weakref.WeakSet()
+        self._close_channels(channels)
+
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool():
+    """Get the process wide channel pool used by get_client_transport()."""
+    global _default_pool
+    if _default_pool is None:
+        with _default_pool_lock:
+            if _default_pool is None:
+                _default_pool = ChannelPool()
+    return _default_pool
+
+
+def set_default_pool(pool):
+    """Replace the process wide channel pool, for example to tune keepalive or message size. The
+    previous pool is closed.
+
+    Args:
+        pool: A ChannelPool instance.
+    """
+    global _default_pool
+    with _default_pool_lock:
+        old = _default_pool
+        _default_pool = pool
+    if old is not None and old is not pool:
+        old.close()
+
+
+def close_default_pool():
+    """Close all channels in the process wide pool. Called by the service executor at shutdown."""
+    if _default_pool is not None:
+        _default_pool.close()
@@ -0,0 +1,541 @@
+from __future__ import unicode_literals, print_function
+import time
+import math
+import threading
+import collections
+import logging
+from .. import metrics
+
+
+_logger = logging.getLogger(__name__)
+
+# Python 2 has no monotonic clock.
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+class CallRejected(Exception):
+    """A call was failed fast without being sent. `reason` is LIMIT or CIRCUIT_OPEN. Calls made through
+    the interceptor raise a subclass that is also a grpc.RpcError with code() RESOURCE_EXHAUSTED or
+    UNAVAILABLE.
+    """
+    LIMIT = 'limit'
+    CIRCUIT_OPEN = 'circuit-open'
+
+    def __init__(self, target, reason):
+        super(CallRejected, self).__init__('%s: call rejected, %s' % (target, reason))
+        self.target = target
+        self.reason = reason
+
+
+class AIMDLimit(object):
+    """Additive increase, multiplicative decrease concurrency limit. The limit grows by one per
+    successful call while at least half of it is in use, and is multiplied by `backoff_ratio` when a
+    call times out or the target reports overload.
+    """
+
+    def __init__(self, initial=20, min_limit=1, max_limit=1000, backoff_ratio=0.9):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+
+    def update(self, rtt, inflight, overload):
+        """Adjust the limit after a call.
+
+        Args:
+            rtt: Call duration in seconds.
+            inflight: Calls in flight when the call was sent, including itself.
+            overload: True if the call timed out or the target was overloaded.
+        """
+        if overload:
+            self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+        elif inflight * 2 >= self.limit:
+            self.limit = min(self.max_limit, self.limit + 1)
+
+
+class GradientLimit(object):
+    """Concurrency limit following the ratio of the long term to the recent latency. When recent
+    calls are slower than usual the target is queueing, so the limit shrinks in proportion. A queue
+    allowance of sqrt(limit) lets the limit grow while latency is stable.
+    """
+
+    def __init__(self, initial=20, min_limit=1, max_limit=1000, tolerance=1.5, smoothing=0.2,
+                 long_window=600, short_window=10):
+        """Constructor
+
+        Args:
+            initial: The initial limit.
+            min_limit: Lower bound of the limit.
+            max_limit: Upper bound of the limit.
+            tolerance: Latency increase over the long term average tolerated before shrinking.
+            smoothing: Weight of a new estimate of the limit.
+            long_window: Samples in the long term latency average.
+            short_window: Samples in the recent latency average.
+        """
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self._long_alpha = 2.0 / (long_window + 1)
+        self._short_alpha = 2.0 / (short_window + 1)
+        self.long_rtt = None
+        self.short_rtt = None
+
+    def update(self, rtt, inflight, overload):
+        if self.long_rtt is None:
+            self.long_rtt = self.short_rtt = rtt
+        else:
+            self.long_rtt += (rtt - self.long_rtt) * self._long_alpha
+            self.short_rtt += (rtt - self.short_rtt) * self._short_alpha
+        if overload:
+            gradient = 0.5
+        elif self.short_rtt > 0:
+            gradient = max(0.5, min(1.0, self.tolerance * self.long_rtt / self.short_rtt))
+        else:
+            gradient = 1.0
+        if not overload and inflight * 2 < self.limit:
+            # The caller is not using the limit, latency says nothing about it.
+            return
+        estimate = self.limit * gradient + math.sqrt(self.limit)
+        limit = self.limit * (1 - self.smoothing) + estimate * self.smoothing
+        self.limit = max(self.min_limit, min(self.max_limit, limit))
+
+
+LIMITS = {'aimd': AIMDLimit, 'gradient': GradientLimit}
+
+
+class CircuitBreaker(object):
+    """Fails calls fast while a target is failing.
+
+    CLOSED: calls are sent. The outcome of the last `window` calls is kept, when at least `min_calls`
+        are known and the failure ratio reaches `failure_ratio` the breaker opens.
+    OPEN: calls are rejected for `open_seconds`, then the breaker is half open.
+    HALF_OPEN: `probes` calls are sent. If they all succeed the breaker closes, if one fails it opens.
+    """
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+    STATE_NAMES = ('closed', 'open', 'half-open')
+
+    def __init__(self, failure_ratio=0.5, window=20, min_calls=10, open_seconds=5.0, probes=1):
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.probes = max(probes, 1)
+        self.state = self.CLOSED
+        self.opened = 0
+        self._outcomes = collections.deque(maxlen=max(window, 1))
+        self._failures = 0
+        self._open_until = 0.0
+        self._probes_sent = 0
+        self._probes_ok = 0
+
+    def allow(self, now):
+        """Test if a call can be sent. Caller serializes access."""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            if now < self._open_until:
+                return False
+            self.state = self.HALF_OPEN
+            self._probes_sent = self._probes_ok = 0
+        if self._probes_sent < self.probes:
+            self._probes_sent += 1
+            return True
+        return False
+
+    def cancel_probe(self):
+        """Give back a probe admitted by allow() that was not sent. Caller serializes access."""
+        if self.state == self.HALF_OPEN and self._probes_sent > 0:
+            self._probes_sent -= 1
+
+    def record(self, failed, now):
+        """Record the outcome of a sent call. Caller serializes access."""
+        if self.state == self.HALF_OPEN:
+            if failed:
+                self._open(now)
+            else:
+                self._probes_ok += 1
+                if self._probes_ok >= self.probes:
+                    self.state = self.CLOSED
+                    self._outcomes.clear()
+                    self._failures = 0
+            return
+        if self.state == self.OPEN:
+            # A call sent before the breaker opened.
+            return
+        if len(self._outcomes) == self._outcomes.maxlen and self._outcomes[0]:
+            self._failures -= 1
+        self._outcomes.append(failed)
+        if failed:
+            self._failures += 1
+            n = len(self._outcomes)
+            if n >= self.min_calls and self._failures >= self.failure_ratio * n:
+                self._open(now)
+
+    def _open(self, now):
+        if self.state != self.OPEN:
+            _logger.warning('Circuit opened for %s seconds', self.open_seconds)
+        self.state = self.OPEN
+        self.opened += 1
+        self._open_until = now + self.open_seconds
+
+
+class TargetGuard(object):
+    """Concurrency limit and circuit breaker of one target, see ResiliencePolicy."""
+
+    def __init__(self, target, limit, breaker, registry):
+        self.target = target
+        self.limit = limit
+        self.breaker = breaker
+        self.inflight = 0
+        self.hedge_delay = None
+        self.hedge_count = 0
+        self._lock = threading.Lock()
+        labels = {'target': target}
+        self.latency = registry.histogram('mservice_grpc_client_seconds', 'Duration of outbound calls',
+                                          labels=labels)
+        self.rejected_limit = registry.counter('mservice_grpc_client_rejected_total', 'Calls failed fast',
+                                               labels={'target': target, 'reason': CallRejected.LIMIT})
+        self.rejected_open = registry.counter('mservice_grpc_client_rejected_total', 'Calls failed fast',
+                                              labels={'target': target, 'reason': CallRejected.CIRCUIT_OPEN})
+        self.hedged = registry.counter('mservice_grpc_client_hedged_total', 'Hedged calls sent', labels=labels)
+        registry.gauge('mservice_grpc_client_inflight', 'Outbound calls in flight', labels=labels,
+                       fn=lambda: self.inflight)
+        if limit is not None:
+            registry.gauge('mservice_grpc_client_limit', 'Adaptive concurrency limit', labels=labels,
+                           fn=lambda: self.limit.limit)
+        if breaker is not None:
+            registry.gauge('mservice_grpc_client_circuit_state', 'Circuit state, 0 closed, 1 open, 2 half open',
+                           labels=labels, fn=lambda: self.breaker.state)
+
+    def acquire(self, hedge=False):
+        """Reserve a slot for a call.
+
+        Args:
+            hedge: The call is a hedge. Hedges are only sent in the closed state and below the limit.
+
+        Returns:
+            A token passed to release().
+
+        Raises:
+            CallRejected: if the circuit is open or the limit is reached.
+        """
+        now = _monotonic()
+        with self._lock:
+            breaker = self.breaker
+            probe = False
+            if breaker is not None:
+                if hedge and breaker.state != breaker.CLOSED:
+                    raise CallRejected(self.target, CallRejected.CIRCUIT_OPEN)
+                if not breaker.allow(now):
+                    self.rejected_open.inc()
+                    raise CallRejected(self.target, CallRejected.CIRCUIT_OPEN)
+                probe = breaker.state == breaker.HALF_OPEN
+            if self.limit is not None and self.inflight >= int(self.limit.limit):
+                if probe:
+                    breaker.cancel_probe()
+                if not hedge:
+                    self.rejected_limit.inc()
+                raise CallRejected(self.target, CallRejected.LIMIT)
+            self.inflight += 1
+            return now, self.inflight, probe
+
+    def release(self, token, failed=False, overload=False, sample=True):
+        """Release a slot.
+
+        Args:
+            token: The value returned by acquire().
+            failed: The call failed, counted by the circuit breaker.
+            overload: The call timed out or the target was overloaded, shrinks the limit.
+            sample: False for calls cancelled by the caller, their outcome says nothing about the target.
+                A probe of a half open circuit is given back.
+        """
+        start, inflight, probe = token
+        now = _monotonic()
+        rtt = now - start
+        with self._lock:
+            self.inflight -= 1
+            if sample:
+                if self.limit is not None:
+                    self.limit.update(rtt, inflight, overload)
+                if self.breaker is not None:
+                    self.breaker.record(failed, now)
+            elif probe:
+                self.breaker.cancel_probe()
+        if sample:
+            self.latency.record(rtt)
+
+
+class ResiliencePolicy(object):
+    """Protection of outbound calls, applied per target by a client interceptor, see ChannelPool.
+
+    - An adaptive concurrency limit fails calls fast with RESOURCE_EXHAUSTED when too many are in
+      flight to a target. 'aimd' reacts to timeouts and overload, 'gradient' also to rising latency.
+    - A circuit breaker fails calls fast with UNAVAILABLE while a target is failing, then probes it.
+    - Calls to idempotent methods listed in `hedge_methods` are sent a second time if the first has
+      not completed after `hedge_delay` seconds. The first response wins and the other is cancelled.
+      Only calls made with future() are hedged, a blocking call has completed when the interceptor
+      gets it back.
+    """
+
+    def __init__(self, limit='aimd', initial_limit=20, min_limit=1, max_limit=1000, breaker=True,
+                 failure_ratio=0.5, window=20, min_calls=10, open_seconds=5.0, probes=1, hedge_methods=(),
+                 hedge_delay=None, hedge_quantile=0.95, registry=None):
+        """Constructor
+
+        Args:
+            limit: 'aimd', 'gradient', or None for no limit.
+            initial_limit: Initial concurrency limit per target.
+            min_limit: Lower bound of the limit.
+            max_limit: Upper bound of the limit.
+            breaker: Enable the circuit breaker.
+            failure_ratio: Failure ratio that opens the circuit.
+            window: Number of recent calls the failure ratio is computed over.
+            min_calls: Min calls in the window before the circuit can open.
+            open_seconds: Seconds the circuit stays open before probing.
+            probes: Calls sent while half open.
+            hedge_methods: Full method names, such as '/pkg.Service/Method', that are safe to send twice.
+            hedge_delay: Seconds before hedging. None uses the `hedge_quantile` latency of the target.
+            hedge_quantile: Latency quantile used when hedge_delay is None.
+            registry: The MetricsRegistry, defaults to metrics.default_registry.
+        """
+        if limit is not None and limit not in LIMITS:
+            raise ValueError('limit must be one of %s or None' % ', '.join(sorted(LIMITS)))
+        self.limit = limit
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.breaker = breaker
+        self.failure_ratio = failure_ratio
+        self.window = window
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self.hedge_methods = frozenset(hedge_methods)
+        self.hedge_delay = hedge_delay
+        self.hedge_quantile = hedge_quantile
+        self.registry = registry if registry is not None else metrics.default_registry
+        self._guards = {}
+        self._lock = threading.Lock()
+
+    def guard(self, target):
+        """The TargetGuard of a target, created on first use."""
+        guard = self._guards.get(target)
+        if guard is None:
+            with self._lock:
+                guard = self._guards.get(target)
+                if guard is None:
+                    limit = None
+                    if self.limit is not None:
+                        limit = LIMITS[self.limit](self.initial_limit, self.min_limit, self.max_limit)
+                    breaker = None
+                    if self.breaker:
+                        breaker = CircuitBreaker(self.failure_ratio, self.window, self.min_calls,
+                                                 self.open_seconds, self.probes)
+                    guard = TargetGuard(target, limit, breaker, self.registry)
+                    self._guards[target] = guard
+        return guard
+
+    def hedge_after(self, guard):
+        """Seconds to wait before hedging a call to a target, None if there is no latency data yet."""
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        latency = guard.latency
+        if latency.count < 20:
+            return None
+        # quantile() scans every bucket, refresh it every 64 samples.
+        if guard.hedge_delay is None or latency.count - guard.hedge_count >= 64:
+            guard.hedge_delay = latency.quantile(self.hedge_quantile)
+            guard.hedge_count = latency.count
+        return guard.hedge_delay
+
+    def interceptor(self, target):
+        """A grpc.UnaryUnaryClientInterceptor applying the policy to calls to a target."""
+        return _interceptor_class()(self, self.guard(target))
+
+    def intercept(self, channel, target):
+        """Wrap a channel so calls to `target` go through the policy."""
+        import grpc
+        return grpc.intercept_channel(channel, self.interceptor(target))
+
+
+_interceptor = None
+
+
+def _interceptor_class():
+    # grpc is imported when the first interceptor is created.
+    global _interceptor
+    if _interceptor is not None:
+        return _interceptor
+    import grpc
+
+    failure_codes = frozenset((grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED,
+                               grpc.StatusCode.RESOURCE_EXHAUSTED, grpc.StatusCode.INTERNAL,
+                               grpc.StatusCode.UNKNOWN))
+    overload_codes = frozenset((grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED,
+                                grpc.StatusCode.RESOURCE_EXHAUSTED))
+
+    class RejectedRpcError(CallRejected, grpc.RpcError):
+
+        def code(self):
+            if self.reason == CallRejected.LIMIT:
+                return grpc.StatusCode.RESOURCE_EXHAUSTED
+            return grpc.StatusCode.UNAVAILABLE
+
+        def details(self):
+            return str(self)
+
+    class ResilienceInterceptor(grpc.UnaryUnaryClientInterceptor):
+
+        def __init__(self, policy, guard):
+            self.policy = policy
+            self.guard = guard
+
+        def _send(self, continuation, details, request, hedge=False):
+            guard = self.guard
+            try:
+                token = guard.acquire(hedge)
+            except CallRejected as e:
+                raise RejectedRpcError(e.target, e.reason)
+            try:
+                call = continuation(details, request)
+            except Exception:
+                guard.release(token, sample=False)
+                raise
+
+            def done(future):
+                if future.cancelled():
+                    guard.release(token, sample=False)
+                    return
+                code = future.code()
+                guard.release(token, failed=code in failure_codes, overload=code in overload_codes)
+
+            call.add_done_callback(done)
+            return call
+
+        def intercept_unary_unary(self, continuation, client_call_details, request):
+            first = self._send(continuation, client_call_details, request)
+            if client_call_details.method not in self.policy.hedge_methods:
+                return first
+            delay = self.policy.hedge_after(self.guard)
+            # A blocking call has already completed, only future() calls are hedged.
+            if delay is None or first.done():
+                return first
+            return HedgedCall(self, continuation, client_call_details, request, first, delay)
+
+    class HedgedCall(grpc.Call, grpc.Future):
+        """A call and its hedge, sent by a timer if the call has not completed after the hedge delay.
+        Completes with the first attempt to complete, the other is cancelled."""
+
+        def __init__(self, interceptor, continuation, details, request, first, delay):
+            self._lock = threading.Lock()
+            self._done = threading.Event()
+            self._attempts = [first]
+            self._winner = None
+            self._callbacks = []
+            self._timer = threading.Timer(delay, self._hedge, (interceptor, continuation, details, request))
+            self._timer.daemon = True
+            self._timer.start()
+            first.add_done_callback(self._settle)
+
+        def _hedge(self, interceptor, continuation, details, request):
+            if self._done.is_set():
+                return
+            try:
+                second = interceptor._send(continuation, details, request, hedge=True)
+            except CallRejected:
+                return
+            except Exception as e:
+                _logger.warning('Cannot hedge call to %s: %s', interceptor.guard.target, e)
+                return
+            interceptor.guard.hedged.inc()
+            with self._lock:
+                settled = self._winner is not None
+                if not settled:
+                    self._attempts.append(second)
+            if settled:
+                second.cancel()
+                return
+            second.add_done_callback(self._settle)
+
+        def _settle(self, call):
+            with self._lock:
+                if self._winner is not None:
+                    return
+                self._winner = call
+                others = [attempt for attempt in self._attempts if attempt is not call]
+                callbacks, self._callbacks = self._callbacks, []
+            self._timer.cancel()
+            for other in others:
+                other.cancel()
+            self._done.set()
+            for fn in callbacks:
+                fn(self)
+
+        def _wait(self, timeout=None):
+            if not self._done.wait(timeout):
+                raise grpc.FutureTimeoutError()
+            return self._winner
+
+        def cancel(self):
+            with self._lock:
+                if self._winner is not None:
+                    return False
+                attempts = list(self._attempts)
+            self._timer.cancel()
+            return any([attempt.cancel() for attempt in attempts])
+
+        def cancelled(self):
+            return self._done.is_set() and self._winner.cancelled()
+
+        def running(self):
+            return not self._done.is_set()
+
+        def done(self):
+            return self._done.is_set()
+
+        def result(self, timeout=None):
+            return self._wait(timeout).result()
+
+        def exception(self, timeout=None):
+            return self._wait(timeout).exception()
+
+        def traceback(self, timeout=None):
+            return self._wait(timeout).traceback()
+
+        def add_done_callback(self, fn):
+            with self._lock:
+                if self._winner is None:
+                    self._callbacks.append(fn)
+                    return
+            fn(self)
+
+        def is_active(self):
+            return not self._done.is_set()
+
+        def time_remaining(self):
+            return self._attempts[0].time_remaining()
+
+        def add_callback(self, callback):
+            with self._lock:
+                if self._winner is not None:
+                    return False
+                self._callbacks.append(lambda future: callback())
+                return True
+
+        def initial_metadata(self):
+            return self._wait().initial_metadata()
+
+        def trailing_metadata(self):
+            return self._wait().trailing_metadata()
+
+        def code(self):
+            return self._wait().code()
+
+        def details(self):
+            return self._wait().details()
+
+    _interceptor = ResilienceInterceptor
+    return _interceptor
@@ -0,0 +1,144 @@
+from __future__ import unicode_literals, print_function
+import grpc
+import threading
+from concurrent import futures
+from .. import executor
+
+
+def _call_in_loop(loop, fn):
+    # Run fn on the event loop thread and wait for the result.
+    future = futures.Future()
+
+    def run():
+        try:
+            future.set_result(fn())
+        except Exception as e:
+            future.set_exception(e)
+
+    loop.call_soon_threadsafe(run)
+    return future.result()
+
+
+class GrpcServiceExecutor(executor.ServiceExecutor):
+    """Service executor that hosts a gRPC server. The server is started after on_start() and drained
+    before on_term() so in-flight RPCs complete within the grace period.
+
+    Override add_servicers() to register the servicers.
+    """
+
+    def __init__(self, wakeup, state_or_logger=None, port=0, host='[::]', max_workers=10,
+                 maximum_concurrent_rpcs=None, grace=10.0, use_aio=False, reuse_port=False, options=None):
+        """Constructor
+
+        Args:
+            wakeup: Max time to sleep, in seconds, before calling on_wake(). Fractions are allowed.
+            state_or_logger: A ServiceState, Logger, or LoggerAdaptor.
+            port: The listen port. Zero picks a free port, see bound_port.
+            host: The listen address.
+            max_workers: Size of the thread pool handling RPCs. Used by the grpc.aio server for
+                synchronous handlers.
+            maximum_concurrent_rpcs: RPCs beyond this are rejected with RESOURCE_EXHAUSTED, None is
+                unlimited.
+            grace: Seconds in-flight RPCs are given to complete on graceful termination.
+            use_aio: Use a grpc.aio server running on its own event loop thread.
+            reuse_port: Set SO_REUSEPORT so several processes, such as supervisor workers, can share
+                the port with the kernel balancing connections between them.
+            options: Extra server options as a list of (name, value) tuples.
+        """
+        super(GrpcServiceExecutor, self).__init__(wakeup, state_or_logger)
+        self.host = host
+        self.port = port
+        self.max_workers = max_workers
+        self.maximum_concurrent_rpcs = maximum_concurrent_rpcs
+        self.grace = grace
+        self.use_aio = use_aio
+        self.options = [('grpc.so_reuseport', 1 if reuse_port else 0)] + list(options or [])
+        self.bound_port = None
+        self.server = None
+        self._thread_pool = None
+        self._loop = None
+        self._loop_thread = None
+
+    def add_servicers(self, server):
+        """Called to register servicers before the server starts, for example
+        `add_MyServicer_to_server(MyServicer(), server)`.
+
+        Args:
+            server: A grpc.Server or grpc.aio.Server.
+        """
+        pass
+
+    def _start(self, workdir):
+        super(GrpcServiceExecutor, self)._start(workdir)
+        address = '%s:%d' % (self.host, self.port)
+        if self.use_aio:
+            self._start_aio_server(address)
+        else:
+            self._thread_pool = futures.ThreadPoolExecutor(max_workers=self.max_workers)
+            server = grpc.server(self._thread_pool, options=self.options,
+                                 maximum_concurrent_rpcs=self.maximum_concurrent_rpcs)
+            self.add_servicers(server)
+            self.bound_port = server.add_insecure_port(address)
+            server.start()
+            self.server = server
+        self.logger.info('gRPC server listening on %s:%d', self.host, self.bound_port)
+
+    def _start_aio_server(self, address):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        self._loop = loop
+        self._loop_thread = threading.Thread(target=loop.run_forever, name='grpc-aio')
+        self._loop_thread.daemon = True
+        self._loop_thread.start()
+
+        def create():
+            asyncio.set_event_loop(loop)
+            self._thread_pool = futures.ThreadPoolExecutor(max_workers=self.max_workers)
+            server = grpc.aio.server(migration_thread_pool=self._thread_pool, options=self.options,
+                                     maximum_concurrent_rpcs=self.maximum_concurrent_rpcs)
+            self.add_servicers(server)
+            self.bound_port = server.add_insecure_port(address)
+            return server
+
+        server = _call_in_loop(loop, create)
+        asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+        self.server = server
+
+    def _stop_server(self, grace):
+        server = self.server
+        if server is None:
+            return
+        self.server = None
+        self.logger.info('Stopping gRPC server, grace %s seconds', grace)
+        if self._loop is not None:
+            import asyncio
+            loop = self._loop
+            try:
+                asyncio.run_coroutine_threadsafe(server.stop(grace), loop).result()
+            finally:
+                loop.call_soon_threadsafe(loop.stop)
+                self._loop_thread.join()
+                loop.close()
+                self._loop = None
+                self._loop_thread = None
+        else:
+            server.stop(grace).wait()
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=False)
+            self._thread_pool = None
+
+    def _drain(self, graceful):
+        # Stop accepting RPCs and drain in-flight RPCs before on_term() releases what they use. The
+        # grace period is capped by what is left of the drain phase.
+        grace = 0
+        if graceful:
+            grace = self.grace
+            remaining = self.shutdown_budget.remaining('drain')
+            if remaining is not None:
+                grace = min(grace, remaining)
+        self._stop_server(grace)
+        super(GrpcServiceExecutor, self)._drain(graceful)
+
+    def _shutdown(self):
+        self._stop_server(0)
+        super(GrpcServiceExecutor, self)._shutdown()
@@ -0,0 +1,210 @@
+from __future__ import unicode_literals, print_function
+import os
+import json
+import time
+import threading
+import logging
+
+
+_logger = logging.getLogger(__name__)
+
+# Python 2 has no monotonic clock.
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class HealthState(object):
+    """Liveness and readiness of a service, updated by the run loop and read by probes.
+
+    Updates are single attribute stores, which are atomic under the GIL, so the run loop never takes a
+    lock. A probe may see fields from two different ticks, which is acceptable for a health check.
+
+    Live: the run loop ticked, and any on_wake() in progress started, within `timeout` seconds.
+    Ready: live, on_start() finished, the run loop has not exited, and no reload is in progress.
+    """
+
+    def __init__(self, period, tolerance=3.0, min_timeout=5.0):
+        """Constructor
+
+        Args:
+            period: The wakeup period in seconds.
+            tolerance: Multiple of the period after which a run loop that has not ticked is not live.
+            min_timeout: Lower bound of the timeout in seconds, for short periods.
+        """
+        self.timeout = max(tolerance * period, min_timeout)
+        self.started = False
+        self.running = False
+        self.reloading = False
+        self.last_tick = None
+        self.wake_started = None
+        self.last_wake_duration = None
+        self.wakes = 0
+
+    def tick(self):
+        self.last_tick = monotonic()
+
+    def wake_begin(self, now):
+        self.wake_started = now
+
+    def wake_end(self, now, duration):
+        self.wake_started = None
+        self.last_wake_duration = duration
+        self.wakes += 1
+        self.last_tick = now
+
+    def wake_done(self, duration):
+        """Count a wake run off the run loop, which ticks on its own."""
+        self.last_wake_duration = duration
+        self.wakes += 1
+
+    def live(self, now=None):
+        if now is None:
+            now = monotonic()
+        last_tick = self.last_tick
+        wake_started = self.wake_started
+        if last_tick is None:
+            # Not yet in the run loop, on_start() may be slow but the process is alive.
+            return not self.started
+        if wake_started is not None and now - wake_started > self.timeout:
+            return False
+        return wake_started is not None or now - last_tick <= self.timeout
+
+    def ready(self, now=None):
+        return self.started and self.running and not self.reloading and self.live(now)
+
+    def report(self):
+        """Get the state as a dict for the JSON health document."""
+        now = monotonic()
+        last_tick = self.last_tick
+        wake_started = self.wake_started
+        return {
+            'live': self.live(now),
+            'ready': self.ready(now),
+            'started': self.started,
+            'running': self.running,
+            'reloading': self.reloading,
+            'pid': os.getpid(),
+            'timeout': self.timeout,
+            'wakes': self.wakes,
+            'last_tick_age': None if last_tick is None else now - last_tick,
+            'wake_running': None if wake_started is None else now - wake_started,
+            'last_wake_duration': self.last_wake_duration,
+        }
+
+
+_server_classes = None
+
+
+def _make_server(address, health):
+    # http.server loads ssl and email, so it is imported when the server is first started.
+    global _server_classes
+    if _server_classes is None:
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+            from socketserver import ThreadingMixIn, UnixStreamServer
+        except ImportError:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+            from SocketServer import ThreadingMixIn, UnixStreamServer
+
+        class HealthHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                health = self.server.health
+                path = self.path.split('?', 1)[0]
+                if path in ('/healthz', '/livez'):
+                    ok = health.live()
+                    body = b'ok\n' if ok else b'not live\n'
+                    content_type = 'text/plain'
+                elif path == '/readyz':
+                    ok = health.ready()
+                    body = b'ok\n' if ok else b'not ready\n'
+                    content_type = 'text/plain'
+                elif path in ('/', '/health'):
+                    report = health.report()
+                    ok = report['live']
+                    body = json.dumps(report, sort_keys=True).encode('utf-8')
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200 if ok else 503)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def address_string(self):
+                # Unix socket peers have no address.
+                return str(self.client_address)
+
+            def log_message(self, format, *args):
+                pass
+
+        class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        class ThreadingUnixServer(ThreadingMixIn, UnixStreamServer):
+            daemon_threads = True
+
+        _server_classes = (ThreadingHTTPServer, ThreadingUnixServer, HealthHandler)
+    tcp_class, unix_class, handler = _server_classes
+    if isinstance(address, tuple):
+        server = tcp_class(address, handler)
+    else:
+        server = unix_class(address, handler)
+    server.health = health
+    return server
+
+
+class HealthServer(object):
+    """Serves a HealthState over HTTP, on a TCP port, a Unix socket, or both, from background threads.
+
+    GET /healthz returns 200 when live, /readyz returns 200 when ready, otherwise 503. GET /health
+    returns the state as JSON.
+    """
+
+    def __init__(self, health, port=None, host='', path=None):
+        """Constructor
+
+        Args:
+            health: The HealthState.
+            port: TCP port, None disables.
+            host: TCP listen address.
+            path: Unix socket path, None disables. An existing socket file is replaced.
+        """
+        self.health = health
+        self.port = port
+        self.host = host
+        self.path = path
+        self._servers = []
+        self._threads = []
+
+    def start(self):
+        if self.port is not None:
+            server = _make_server((self.host, self.port), self.health)
+            self.port = server.server_address[1]
+            self._serve(server, 'health-http')
+        if self.path is not None:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self._serve(_make_server(self.path, self.health), 'health-unix')
+
+    def _serve(self, server, name):
+        self._servers.append(server)
+        thread = threading.Thread(target=server.serve_forever, name=name)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        for thread in self._threads:
+            thread.join()
+        self._servers = []
+        self._threads = []
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
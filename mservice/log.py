@@ -1,33 +1,291 @@
 from __future__ import unicode_literals, print_function
 import logging
-import inspect
+import threading
+import collections
 import time
 import sys
+import os
+import io
 from .testutils import isdebugging
 
 
+# Python 2 has no monotonic clock.
+_monotonic = getattr(time, 'monotonic', time.time)
+_exc_formatter = logging.Formatter()
+
+# Frames from Logger.log() up to the caller of an ExceptionRateLimitedLogAdaptor method, passed as
+# stacklevel so records report the caller instead of the adaptor. Python 3.11 counts frames outside
+# the logging module, Python 3.8 counts every frame above LoggerAdapter.log(), older versions have no
+# stacklevel.
+if sys.version_info >= (3, 11):
+    _STACKLEVEL = 3
+elif sys.version_info >= (3, 8):
+    _STACKLEVEL = 4
+else:
+    _STACKLEVEL = None
+
+
+class TokenBucket(object):
+    """Token bucket refilled at `rate` tokens per second up to `burst` tokens."""
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, now):
+        """Take a token.
+
+        Returns:
+            True if a token was available.
+        """
+        elapsed = now - self.stamp
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class LogRateLimiter(object):
+    """Log record rate limit policy. Each (logger, level, call site) has its own token bucket and all
+    records share a global bucket. Suppressed records are counted per source until the next summary.
+    """
+
+    def __init__(self, rate=0, burst=10, global_rate=0, global_burst=None, summary_interval=60.0,
+                 max_sources=1024):
+        """Constructor
+
+        Args:
+            rate: Records per second from each call site and level. Zero is unlimited.
+            burst: Records allowed in a burst from each call site and level.
+            global_rate: Records per second from all sources. Zero is unlimited.
+            global_burst: Records allowed in a burst from all sources, defaults to max(global_rate, burst).
+            summary_interval: Min seconds between summaries of suppressed records.
+            max_sources: Max number of call sites tracked. The least recently seen is forgotten.
+        """
+        now = _monotonic()
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_sources = max(max_sources, 1)
+        self.summary_interval = summary_interval
+        if global_rate > 0:
+            if global_burst is None:
+                global_burst = max(global_rate, self.burst)
+            self.global_bucket = TokenBucket(global_rate, max(global_burst, 1), now)
+        else:
+            self.global_bucket = None
+        self.buckets = collections.OrderedDict()
+        self.pending = {}
+        self.suppressed = 0
+        self.next_summary = now + summary_interval
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        """Take a token for a record.
+
+        Args:
+            key: The record source, a tuple of logger name, level, file name and line number.
+
+        Returns:
+            True if the record should be logged.
+        """
+        now = _monotonic()
+        with self._lock:
+            if self.rate > 0:
+                bucket = self.buckets.pop(key, None)
+                if bucket is None:
+                    bucket = TokenBucket(self.rate, self.burst, now)
+                    if len(self.buckets) >= self.max_sources:
+                        self.buckets.popitem(last=False)
+                self.buckets[key] = bucket
+                if not bucket.take(now):
+                    self._count(key, now)
+                    return False
+            if self.global_bucket is not None and not self.global_bucket.take(now):
+                self._count(key, now)
+                return False
+            return True
+
+    def _count(self, key, now):
+        if not self.pending:
+            self.next_summary = now + self.summary_interval
+        self.pending[key] = self.pending.get(key, 0) + 1
+        self.suppressed += 1
+
+    def summary_due(self):
+        return bool(self.pending) and _monotonic() >= self.next_summary
+
+    def take_summary(self, force=False):
+        """Take the suppressed counts if the summary interval expired.
+
+        Returns:
+            A dict mapping source key to the number of suppressed records, or None.
+        """
+        with self._lock:
+            if not self.pending or (not force and _monotonic() < self.next_summary):
+                return None
+            pending = self.pending
+            self.pending = {}
+            return pending
+
+
 class ExceptionRateLimitedLogAdaptor(logging.LoggerAdapter, object):
     '''Rate limit exception log adaptor.'''
 
-    def __init__(self, logger, rlimit=2.0):
+    def __init__(self, logger, rlimit=2.0, max_sources=1024, limiter=None, summary_interval=None):
         """Exception rate limit. Exceptions of the same type, from same caller and line number are
-        are rate limited to 1 every `rlimit` seconds (default 2.0)
+        are rate limited to 1 every `rlimit` seconds (default 2.0). The next exception logged after the
+        limit expires reports how many were suppressed, or log_summary() does if the source stays
+        quiet.
 
         Args:
             logger: A logger instance.
             rlimit: The rate limit value. Zero disables.
+            max_sources: Max number of exception sources tracked. The least recently seen source is
+                forgotten when exceeded.
+            limiter: Optional LogRateLimiter applied to records of every level.
+            summary_interval: Min seconds between summaries of suppressed exceptions, defaults to the
+                limiter summary interval or 60 seconds.
         """
-        super(self.__class__, self).__init__(logger, {})
-        self.error_cache = {}
+        super(ExceptionRateLimitedLogAdaptor, self).__init__(logger, {})
+        # Maps (exc type, file, line, rlimitby) -> [time last logged, suppressed count], least
+        # recently seen first.
+        self.error_cache = collections.OrderedDict()
+        # exception() is called from the run loop, pools and server threads.
+        self._lock = threading.Lock()
         self.logger = logger
         self.rlimit = rlimit
-        self.last_update_time = time.time()
+        self.max_sources = max(max_sources, 1)
+        self.suppressed = 0
+        self.limiter = limiter
+        if summary_interval is None:
+            summary_interval = limiter.summary_interval if limiter is not None else 60.0
+        self.summary_interval = summary_interval
+        self._next_summary = _monotonic() + summary_interval
+
+    def _log_limited(self, level, msg, args, kwargs):
+        # Must be called directly from the public logging method so the call site is 2 frames up.
+        limiter = self.limiter
+        if limiter is not None:
+            if not self.isEnabledFor(level):
+                return
+            frame = sys._getframe(2)
+            if not limiter.allow((self.logger.name, level, frame.f_code.co_filename, frame.f_lineno)):
+                return
+            del frame
+            if limiter.summary_due():
+                self.log_summary()
+        if _STACKLEVEL is not None:
+            kwargs['stacklevel'] = kwargs.get('stacklevel', 1) + _STACKLEVEL - 1
+        super(ExceptionRateLimitedLogAdaptor, self).log(level, msg, *args, **kwargs)
+
+    def log_summary(self, force=False):
+        """Log a warning summarizing records suppressed by the limiter since the last summary, and one
+        for exceptions suppressed by sources whose rate limit expired without a new occurrence to
+        report them. The executor calls it every `summary_interval` seconds.
+
+        Args:
+            force: Log the summaries even if the summary interval has not expired.
+        """
+        if self.limiter is not None:
+            pending = self.limiter.take_summary(force)
+            if pending:
+                top = sorted(pending.items(), key=lambda x: x[1], reverse=True)
+                sources = ', '.join(['%s %s:%d x%d' % (logging.getLevelName(key[1]), os.path.basename(key[2]),
+                                                       key[3], n) for key, n in top[:5]])
+                if len(top) > 5:
+                    sources += ', ...'
+                self.logger.warning('Log rate limit suppressed %d records from %d sources: %s',
+                                    sum(pending.values()), len(pending), sources)
+        expired = self._take_expired(force)
+        if expired:
+            top = sorted(expired, key=lambda x: x[1], reverse=True)
+            sources = ', '.join(['%s %s:%d x%d' % (getattr(key[0], '__name__', key[0]), os.path.basename(key[1]),
+                                                   key[2], n) for key, n in top[:5]])
+            if len(top) > 5:
+                sources += ', ...'
+            self.logger.warning('Exception rate limit suppressed %d exceptions from %d sources: %s',
+                                sum(n for _, n in expired), len(expired), sources)
+
+    def _take_expired(self, force=False):
+        # Take the suppressed counts of exception sources whose rate limit expired. When forced, as
+        # on shutdown, every pending count is taken.
+        now = _monotonic()
+        with self._lock:
+            if not force and now < self._next_summary:
+                return None
+            self._next_summary = now + self.summary_interval
+            expired = []
+            for key, entry in self.error_cache.items():
+                if entry[1] and (force or (now - entry[0]) >= self.rlimit):
+                    expired.append((key, entry[1]))
+                    entry[1] = 0
+        return expired
 
-    def find_caller(self):
-        if sys.exc_info()[2]:
-            return sys.exc_info()[2].tb_frame.f_code.co_filename, sys.exc_info()[2].tb_lineno
-        frmrec = inspect.stack()[2]
-        return frmrec[1:4]
+    def log(self, level, msg, *args, **kwargs):
+        self._log_limited(level, msg, args, kwargs)
+
+    def debug(self, msg, *args, **kwargs):
+        self._log_limited(logging.DEBUG, msg, args, kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self._log_limited(logging.INFO, msg, args, kwargs)
+
+    def warning(self, msg, *args, **kwargs):
+        self._log_limited(logging.WARNING, msg, args, kwargs)
+
+    def error(self, msg, *args, **kwargs):
+        self._log_limited(logging.ERROR, msg, args, kwargs)
+
+    def critical(self, msg, *args, **kwargs):
+        self._log_limited(logging.CRITICAL, msg, args, kwargs)
+
+    def find_caller(self, tb=None, depth=2):
+        """Get the exception source. This is the frame that raised when an exception is being handled,
+        otherwise the caller `depth` frames up. Source files are not read.
+
+        Returns:
+            A tuple of file name and line number.
+        """
+        if tb is None:
+            tb = sys.exc_info()[2]
+        if tb is not None:
+            return tb.tb_frame.f_code.co_filename, tb.tb_lineno
+        frame = sys._getframe(depth)
+        return frame.f_code.co_filename, frame.f_lineno
+
+    def _suppress(self, key):
+        """Test and update the rate limit for an exception source.
+
+        Returns:
+            None if the exception should be suppressed, else the number suppressed since the source was
+            last logged.
+        """
+        now = _monotonic()
+        cache = self.error_cache
+        with self._lock:
+            entry = cache.pop(key, None)
+            if entry is not None and (now - entry[0]) < self.rlimit:
+                entry[1] += 1
+                cache[key] = entry
+                self.suppressed += 1
+                return None
+            cache[key] = [now, 0]
+            if len(cache) > self.max_sources:
+                cache.popitem(last=False)
+            else:
+                # Expire the least recently seen source so the cache shrinks after a burst of distinct
+                # exceptions. Sources with a pending suppressed count are kept for the report.
+                oldest = next(iter(cache))
+                oldest_entry = cache[oldest]
+                if not oldest_entry[1] and (now - oldest_entry[0]) >= self.rlimit:
+                    del cache[oldest]
+        return 0 if entry is None else entry[1]
 
     def exception(self, msg, *args, **kwargs):
         """Logs an exception with rate limiting when from the same exception source. Arguments are the same as for
@@ -39,35 +297,592 @@ class ExceptionRateLimitedLogAdaptor(logging.LoggerAdapter, object):
         :param  rlimitby: Extra keyword argument to uniquely define the exception source.
                 The default is file name, line number, and exception type.
         """
+        extra = kwargs.pop('rlimitby', None)
         if self.rlimit > 0:
-            extra_args = map(lambda y: y[1], filter(lambda x: x[0] == 'rlimitby', kwargs.items()))
-            exc_info = filter(lambda x: x[0] == 'exc_info' and isinstance(x[1], Exception), kwargs.items())
-            kwargs = dict(filter(lambda x: x[0] != 'rlimitby' and isinstance(x[1], Exception), kwargs.items()))
-            extra = ''.join(extra_args)
-            caller = self.find_caller()
-            if len(exc_info) == 0:
-                callerid = "%s:%s:%s" % (caller[0], caller[1], extra)
+            exc_info = kwargs.get('exc_info')
+            if isinstance(exc_info, BaseException):
+                exc_type, tb = type(exc_info), getattr(exc_info, '__traceback__', None)
+            elif isinstance(exc_info, tuple):
+                exc_type, tb = exc_info[0], exc_info[2]
             else:
-                callerid = "%s:%s:%d:%s" % (type(exc_info[0][1]).__name__, caller[0], caller[1], extra)
-            del caller  # prevent GC issues - see traceback source
-
-            tmnew = time.time()
-
-            # Regularly clear cache to recover memory
-            if (tmnew - self.last_update_time) > (2*self.rlimit):
-                self.error_cache = {}
-            self.last_update_time = tmnew
-
-            if callerid in self.error_cache:
-                tmold = self.error_cache[callerid]
-                self.error_cache[callerid] = tmnew
-                tmdiff = tmnew - tmold
-                # If tmdiff < 0 then the system clock has changed
-                if tmdiff < self.rlimit and tmdiff >= 0:
+                exc_type, _, tb = sys.exc_info()
+            filename, lineno = self.find_caller(tb, 2)
+            del tb  # prevent GC issues - see traceback source
+            suppressed = self._suppress((exc_type, filename, lineno, extra))
+            if suppressed is None:
+                return
+            if suppressed:
+                msg = '%s (%d similar suppressed)' % (msg, suppressed)
+        kwargs.setdefault('exc_info', True)
+        self._log_limited(logging.ERROR, msg, args, kwargs)
+
+
+class LogRecordBuffer(object):
+    """Bounded FIFO of log records shared between producers and a single consumer thread.
+
+    When full the overflow policy decides what happens to a new record:
+        DROP_OLDEST: discard the oldest queued record.
+        DROP_NEWEST: discard the new record.
+        BLOCK: wait for the consumer to make room.
+    """
+    DROP_OLDEST = 'drop-oldest'
+    DROP_NEWEST = 'drop-newest'
+    BLOCK = 'block'
+    POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+    def __init__(self, capacity=10000, overflow=DROP_OLDEST):
+        if overflow not in self.POLICIES:
+            raise ValueError('overflow must be one of %s' % ', '.join(self.POLICIES))
+        self.capacity = max(capacity, 1)
+        self.overflow = overflow
+        self.enqueued = 0
+        self.dropped = 0
+        self._init_sync()
+
+    def _init_sync(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._items = collections.deque()
+        self._in_flight = 0
+        self._flush_requested = False
+        self._closed = False
+
+    def after_fork(self, keep=True):
+        """Recreate the lock in a forked child, the consumer thread did not survive the fork.
+
+        Args:
+            keep: Keep the queued records. True when the parent exits without writing them, as
+                when daemonizing, False when the parent keeps running and writes them itself.
+        """
+        items = self._items
+        self._init_sync()
+        if keep:
+            self._items = items
+
+    def __len__(self):
+        return len(self._items)
+
+    def put_nowait(self, record):
+        """Queue a record, applying the overflow policy when full."""
+        with self._cond:
+            if self._closed:
+                self.dropped += 1
+                return
+            if len(self._items) >= self.capacity:
+                if self.overflow == self.DROP_NEWEST:
+                    self.dropped += 1
                     return
+                elif self.overflow == self.DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self._items) >= self.capacity and not self._closed:
+                        self._cond.wait()
+            self._items.append((_monotonic(), record))
+            self.enqueued += 1
+            if len(self._items) == 1 or self._flush_requested:
+                self._cond.notify_all()
+
+    def get_batch(self, max_size, max_age):
+        """Wait for a batch. A batch is returned when `max_size` records are queued, the oldest record
+        has been queued for `max_age` seconds, or a flush was requested. The caller must call
+        task_done() once the batch is written.
+
+        Returns:
+            A list of records, or None when the buffer is closed and empty.
+        """
+        with self._cond:
+            while True:
+                n = len(self._items)
+                if n >= max_size or (n and (self._flush_requested or self._closed)):
+                    break
+                if self._closed:
+                    return None
+                if n == 0:
+                    self._flush_requested = False
+                    self._cond.wait()
+                    continue
+                remaining = self._items[0][0] + max_age - _monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            count = min(n, max_size)
+            batch = [self._items.popleft()[1] for _ in range(count)]
+            self._in_flight = count
+            if self.overflow == self.BLOCK:
+                self._cond.notify_all()
+            return batch
+
+    def task_done(self):
+        with self._cond:
+            self._in_flight = 0
+            if not self._items:
+                self._flush_requested = False
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Ask the consumer to write everything queued and wait until it has.
+
+        Returns:
+            True if the buffer drained before the timeout.
+        """
+        deadline = None if timeout is None else _monotonic() + timeout
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            while self._items or self._in_flight:
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - _monotonic()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            return True
+
+    def close(self):
+        """Stop accepting records. The consumer drains what is queued then get_batch() returns None."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class HandlerSink(object):
+    """Batch sink that writes records to a logging handler."""
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def __call__(self, records):
+        for record in records:
+            if record.levelno >= self.handler.level:
+                self.handler.handle(record)
+        self.handler.flush()
+
+    def close(self):
+        self.handler.close()
+
+
+class BatchingLogHandler(logging.Handler):
+    """Non blocking log handler. Records are queued in a bounded LogRecordBuffer and written to a sink
+    in batches by a background thread, so the cost on the calling thread is a queue append.
+
+    A sink is a callable taking a list of records, see HandlerSink. It may have a close() method.
+    """
+
+    def __init__(self, sink, capacity=10000, overflow=LogRecordBuffer.DROP_OLDEST, batch_size=100,
+                 max_age=1.0):
+        """Constructor
+
+        Args:
+            sink: Callable that writes a batch of records.
+            capacity: Max number of queued records.
+            overflow: LogRecordBuffer overflow policy.
+            batch_size: Max records per batch.
+            max_age: Max seconds a record waits for a batch to fill.
+        """
+        # Not a QueueHandler, which Python 2 does not have.
+        super(BatchingLogHandler, self).__init__()
+        self.queue = LogRecordBuffer(capacity, overflow)
+        self.sink = sink
+        self.batch_size = max(batch_size, 1)
+        self.max_age = max_age
+        self.written = 0
+        self.errors = 0
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._stopped = False
+
+    @property
+    def dropped(self):
+        return self.queue.dropped
+
+    @property
+    def enqueued(self):
+        return self.queue.enqueued
+
+    def stats(self):
+        """Counters as a dict."""
+        return {
+            'enqueued': self.queue.enqueued,
+            'dropped': self.queue.dropped,
+            'written': self.written,
+            'errors': self.errors,
+            'queued': len(self.queue),
+        }
+
+    def _ensure_thread(self):
+        # The thread is started lazily and restarted after a fork, which includes daemonizing.
+        if self._pid == os.getpid() or self._stopped:
+            return
+        with self._start_lock:
+            pid = os.getpid()
+            if self._pid == pid or self._stopped:
+                return
+            if self._pid is not None:
+                # Forked by daemonizing, the parent exits so its queued records are ours to write.
+                self.queue.after_fork()
+            self._thread = threading.Thread(target=self._run, name='log-flusher')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = pid
+
+    def after_fork(self, keep_queued=False):
+        """Reset the handler in a forked child whose parent keeps running, such as a worker forked
+        by WorkerSupervisor. Records queued by the parent are discarded unless `keep_queued`,
+        otherwise both processes would write them.
+        """
+        if self._pid is None or self._pid == os.getpid():
+            return
+        self._start_lock = threading.Lock()
+        self.queue.after_fork(keep_queued)
+        self._thread = None
+        self._pid = None
+
+    def prepare(self, record):
+        # Merge args and exception text now so the record does not reference mutable caller
+        # state. Formatting is left to the sink.
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self._ensure_thread()
+        self.queue.put_nowait(record)
+
+    def emit(self, record):
+        try:
+            self.enqueue(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+    def _run(self):
+        try:
+            while True:
+                batch = self.queue.get_batch(self.batch_size, self.max_age)
+                if batch is None:
+                    break
+                try:
+                    self.sink(batch)
+                    self.written += len(batch)
+                except Exception:
+                    self.errors += len(batch)
+                    self.handleError(batch[0])
+                finally:
+                    self.queue.task_done()
+        finally:
+            # After the last write, close() may have given up waiting.
+            self._close_sink()
+
+    def _close_sink(self):
+        close = getattr(self.sink, 'close', None)
+        if close is not None:
+            try:
+                close()
+            except Exception as e:
+                sys.stderr.write('Cannot close log sink: %s\n' % e)
+
+    def flush(self, timeout=None):
+        """Wait until queued records are written."""
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            self.queue.flush(timeout)
+
+    def close(self, timeout=None):
+        """Write queued records, stop the thread and close the sink. Safe to call more than once.
+
+        Args:
+            timeout: Max seconds to wait for the queue to drain. None waits indefinitely.
+        """
+        if not self._stopped:
+            self._stopped = True
+            self.queue.close()
+            with self._start_lock:
+                thread = self._thread if self._pid == os.getpid() else None
+            if thread is not None:
+                # The thread closes the sink when it exits, it may still be writing after the timeout.
+                thread.join(timeout)
+                if thread.is_alive():
+                    sys.stderr.write('Log handler closed with %d records unwritten\n' % len(self.queue))
             else:
-                self.error_cache[callerid] = tmnew
-        super(ExceptionRateLimitedLogAdaptor, self).exception(msg, *args, **kwargs)
+                self._close_sink()
+        super(BatchingLogHandler, self).close()
+
+
+class _Compressor(object):
+    """Background thread gzipping rotated log segments, so rotation never waits for compression."""
+
+    def __init__(self, on_done=None):
+        self.on_done = on_done
+        self._cond = threading.Condition(threading.Lock())
+        self._paths = collections.deque()
+        self._thread = None
+        self._pid = None
+        self._closed = False
+
+    def submit(self, path):
+        with self._cond:
+            if self._closed:
+                return
+            self._paths.append(path)
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='log-compressor')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        import gzip
+        import shutil
+        while True:
+            with self._cond:
+                while not self._paths and not self._closed:
+                    self._cond.wait()
+                if not self._paths:
+                    return
+                path = self._paths.popleft()
+            if not os.path.exists(path) or os.path.exists(path + '.gz'):
+                # Compressed by another process sharing the file.
+                continue
+            tmp = '%s.%d.gz.tmp' % (path, os.getpid())
+            try:
+                with io.open(path, 'rb') as src:
+                    with gzip.open(tmp, 'wb') as dst:
+                        shutil.copyfileobj(src, dst, 1 << 20)
+                os.rename(tmp, path + '.gz')
+                os.remove(path)
+            except Exception as e:
+                sys.stderr.write('Cannot compress log segment %s: %s\n' % (path, e))
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+            if self.on_done is not None:
+                self.on_done()
+
+    def close(self, timeout=None):
+        """Compress queued segments and stop. Segments left when the timeout expires are compressed
+        by the next process, see RotatingFileSink."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread if self._pid == os.getpid() else None
+        if thread is not None:
+            thread.join(timeout)
+
+
+class RotatingFileSink(object):
+    """Batch sink that formats records and appends each batch to a file with a single write.
+
+    The file is rotated when it would grow past `max_bytes`, or when a multiple of `rotate_seconds`
+    since the epoch is crossed, by renaming it to <path>.<time>. Rotated segments are gzipped by a
+    background thread and the oldest are deleted to keep `backup_count`. Segments left uncompressed
+    by a previous process are compressed on open.
+
+    Processes sharing the file, such as forked workers, rotate it under a file lock and reopen the
+    file when another process renamed it. A forked process opens the file again on its first write.
+    """
+
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, rotate_seconds=None, backup_count=10, compress=True,
+                 buffer_size=256 * 1024):
+        """Constructor
+
+        Args:
+            path: The log file.
+            max_bytes: Rotate before the file grows past this size, 0 or None disables.
+            rotate_seconds: Rotate at multiples of this many seconds since the epoch, such as 86400 for
+                midnight UTC, 0 or None disables.
+            backup_count: Rotated segments kept.
+            compress: Gzip rotated segments.
+            buffer_size: Size of the write buffer, batches larger than this are written directly.
+        """
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backup_count = backup_count
+        self.compress = compress
+        self.buffer_size = buffer_size
+        self.formatter = logging.Formatter()
+        self.rotations = 0
+        self._file = None
+        self._inherited = []
+        self._pid = None
+        self._dev = None
+        self._ino = None
+        self._next_rotation = None
+        self._scanned = False
+        self._compressor = _Compressor(self._prune) if compress else None
+
+    def _open(self):
+        # Opened on first write, by the flusher thread, so daemonizing does not close it.
+        self._file = io.open(self.path, 'ab', buffering=self.buffer_size)
+        self._pid = os.getpid()
+        st = os.fstat(self._file.fileno())
+        self._dev = st.st_dev
+        self._ino = st.st_ino
+        if self.rotate_seconds:
+            self._next_rotation = (int(time.time() // self.rotate_seconds) + 1) * self.rotate_seconds
+        if self._compressor is not None and not self._scanned:
+            self._scanned = True
+            folder, base = os.path.split(self.path)
+            for name in os.listdir(folder):
+                if name.startswith(base + '.') and name.endswith('.gz.tmp'):
+                    # Left by a process that exited while compressing, the name ends with its pid.
+                    try:
+                        os.kill(int(name[:-len('.gz.tmp')].rsplit('.', 1)[1]), 0)
+                    except (ValueError, OSError):
+                        try:
+                            os.remove(os.path.join(folder, name))
+                        except OSError:
+                            pass
+            for segment in self._segments():
+                if not segment.endswith('.gz'):
+                    self._compressor.submit(segment)
+
+    def _after_fork(self):
+        # The parent's flusher may have been writing when it forked, so the buffer can hold its bytes
+        # and its lock can be held. Close the raw file only, the parent writes those bytes itself,
+        # and keep the buffer referenced so it is never flushed or closed here. Daemonizing closes
+        # inherited descriptors and the number may since have been reused, so it is only closed if
+        # it still refers to the file opened.
+        raw = self._file.raw
+        try:
+            st = os.fstat(raw.fileno())
+            if (st.st_dev, st.st_ino) == (self._dev, self._ino):
+                raw.close()
+        except (OSError, ValueError):
+            pass
+        self._inherited.append(self._file)
+        self._file = None
+
+    def _close_file(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            finally:
+                self._file = None
+
+    def _segments(self):
+        # Rotated segments, oldest first. Names end with a sortable time.
+        folder, base = os.path.split(self.path)
+        prefix = base + '.'
+        names = [n for n in os.listdir(folder) if n.startswith(prefix) and n[len(prefix):len(prefix) + 1].isdigit()
+                 and not n.endswith('.tmp')]
+        return [os.path.join(folder, n) for n in sorted(names)]
+
+    def _prune(self):
+        segments = self._segments()
+        for segment in segments[:max(len(segments) - self.backup_count, 0)]:
+            try:
+                os.remove(segment)
+            except OSError:
+                pass
+
+    def _rotate(self):
+        import fcntl
+        with io.open(self.path + '.lock', 'wb') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                try:
+                    current = os.stat(self.path).st_ino
+                except OSError:
+                    current = None
+                if current == self._ino:
+                    # Not rotated by another process while we waited.
+                    self._close_file()
+                    stamp = self.path + time.strftime('.%Y%m%d-%H%M%S')
+                    rotated = stamp
+                    n = 0
+                    while os.path.exists(rotated) or os.path.exists(rotated + '.gz'):
+                        n += 1
+                        rotated = '%s.%d' % (stamp, n)
+                    os.rename(self.path, rotated)
+                    self.rotations += 1
+                    if self._compressor is not None:
+                        self._compressor.submit(rotated)
+                    else:
+                        self._prune()
+                self._close_file()
+                self._open()
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def __call__(self, records):
+        format = self.formatter.format
+        data = ('\n'.join(format(record) for record in records) + '\n').encode('utf-8')
+        if self._file is not None and self._pid != os.getpid():
+            self._after_fork()
+        if self._file is None:
+            self._open()
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            # Removed by hand.
+            st = None
+        if st is None or st.st_ino != self._ino:
+            # Rotated by another process.
+            self._close_file()
+            self._open()
+            size = os.fstat(self._file.fileno()).st_size
+        else:
+            size = st.st_size
+        if (self.max_bytes and size and size + len(data) > self.max_bytes) or \
+                (self._next_rotation is not None and time.time() >= self._next_rotation):
+            self._rotate()
+        self._file.write(data)
+        self._file.flush()
+
+    def close(self):
+        self._close_file()
+        if self._compressor is not None:
+            # Shutdown waits at most a second, segments left are compressed by the next process.
+            self._compressor.close(1.0)
+
+
+class RotatingFileLogHandler(BatchingLogHandler):
+    """Non blocking file log handler. Records are queued, then formatted and written in batches by a
+    background thread to a RotatingFileSink. Keyword arguments are passed to the sink, see its
+    constructor. The formatter is used by the background thread.
+    """
+
+    def __init__(self, path, capacity=10000, overflow=LogRecordBuffer.DROP_OLDEST, batch_size=500, max_age=0.5,
+                 **kwargs):
+        super(RotatingFileLogHandler, self).__init__(RotatingFileSink(path, **kwargs), capacity=capacity,
+                                                     overflow=overflow, batch_size=batch_size, max_age=max_age)
+
+    def setFormatter(self, fmt):
+        super(RotatingFileLogHandler, self).setFormatter(fmt)
+        self.sink.formatter = fmt
+
+
+def close_background_handlers(logger, timeout=None):
+    """Flush and stop background log handlers attached to a logger so queued records are written
+    before logging.shutdown().
+
+    Args:
+        logger: The logger, usually the service root logger.
+        timeout: Max seconds to wait for each handler.
+    """
+    for handler in list(logger.handlers):
+        if isinstance(handler, BatchingLogHandler):
+            handler.close(timeout)
+
+
+def discard_inherited_records(logger):
+    """Discard records queued by the parent process in background log handlers attached to a logger.
+    Called in a forked child while the parent keeps running and writes them.
+
+    Args:
+        logger: The logger, usually the service root logger.
+    """
+    for handler in list(logger.handlers):
+        if isinstance(handler, BatchingLogHandler):
+            handler.after_fork(keep_queued=False)
 
 
 def set_log_format(log_handler):
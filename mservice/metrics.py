@@ -0,0 +1,425 @@
+from __future__ import unicode_literals, print_function
+import os
+import math
+import time
+import threading
+import functools
+import collections
+import logging
+
+
+_logger = logging.getLogger(__name__)
+
+# Python 2 has no monotonic clock.
+monotonic = getattr(time, 'monotonic', time.time)
+_frexp = math.frexp
+
+
+class Counter(object):
+    """Monotonically increasing value. If `fn` is given the value is read from it at snapshot time,
+    for totals already counted elsewhere.
+
+    Updates are not locked. Under the GIL an increment racing with an increment from another thread
+    can very rarely be lost, which is acceptable for monitoring and keeps the cost to an attribute add.
+    """
+    kind = 'counter'
+    __slots__ = ('name', 'help', 'labels', 'value', 'fn')
+
+    def __init__(self, name, help='', labels=(), fn=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = 0
+        self.fn = fn
+
+    def inc(self, n=1):
+        self.value += n
+
+    def get(self):
+        if self.fn is not None:
+            try:
+                return self.fn()
+            except Exception as e:
+                _logger.debug('Counter %s callback failed: %s', self.name, e)
+                return float('nan')
+        return self.value
+
+    def samples(self):
+        return [(self.name, self.labels, self.get())]
+
+    def families(self):
+        return [(self.name, self.kind, self.help, self.samples())]
+
+
+class Gauge(object):
+    """Value that can go up and down. If `fn` is given the value is read from it at snapshot time."""
+    kind = 'gauge'
+    __slots__ = ('name', 'help', 'labels', 'value', 'fn')
+
+    def __init__(self, name, help='', labels=(), fn=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.value = 0
+        self.fn = fn
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def get(self):
+        if self.fn is not None:
+            try:
+                return self.fn()
+            except Exception as e:
+                _logger.debug('Gauge %s callback failed: %s', self.name, e)
+                return float('nan')
+        return self.value
+
+    def samples(self):
+        return [(self.name, self.labels, self.get())]
+
+    def families(self):
+        return [(self.name, self.kind, self.help, self.samples())]
+
+
+class Histogram(object):
+    """Log-linear histogram in the style of HdrHistogram. Each power of two above `lowest` is split
+    into `sub_buckets` linear buckets, so quantiles have a relative error below 1/sub_buckets with
+    constant memory and a constant cost per sample.
+    """
+    kind = 'summary'
+    __slots__ = ('name', 'help', 'labels', 'lowest', 'sub_buckets', 'counts', 'count', 'sum', 'max',
+                 '_nbuckets', '_scale', '_sub2')
+    QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+    def __init__(self, name, help='', labels=(), lowest=1e-6, octaves=40, sub_buckets=16):
+        """Constructor
+
+        Args:
+            name: The metric name.
+            help: Description.
+            labels: A tuple of (name, value) pairs.
+            lowest: Smallest value distinguished, smaller values are counted in the first bucket. The
+                default suits durations in seconds.
+            octaves: Number of powers of two above lowest that are tracked. Larger values are counted
+                in the last bucket.
+            sub_buckets: Linear buckets per power of two.
+        """
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lowest = float(lowest)
+        self.sub_buckets = sub_buckets
+        self._nbuckets = octaves * sub_buckets
+        self._scale = 1.0 / self.lowest
+        self._sub2 = 2 * sub_buckets
+        self.counts = [0] * self._nbuckets
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        """Add a sample."""
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+        # frexp gives value/lowest = m * 2**e with 0.5 <= m < 1.
+        m, e = _frexp(value * self._scale)
+        if e > 0:
+            index = (e - 1) * self.sub_buckets + int(m * self._sub2) - self.sub_buckets
+            if index >= self._nbuckets:
+                index = self._nbuckets - 1
+            self.counts[index] += 1
+        else:
+            self.counts[0] += 1
+
+    def count_above(self, value):
+        """Count samples larger than value, to the resolution of the buckets."""
+        m, e = _frexp(value * self._scale)
+        index = 0
+        if e > 0:
+            index = min((e - 1) * self.sub_buckets + int(m * self._sub2) - self.sub_buckets, self._nbuckets - 1)
+        return sum(self.counts[index + 1:])
+
+    def _upper(self, index):
+        octave, sub = divmod(index, self.sub_buckets)
+        return self.lowest * (2 ** octave) * (1.0 + float(sub + 1) / self.sub_buckets)
+
+    def quantile(self, q):
+        """Estimate a quantile, reported as the upper bound of the bucket containing it."""
+        total = sum(self.counts)
+        if total == 0:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return min(self._upper(index), self.max)
+        return self.max
+
+    def reset(self):
+        self.counts = [0] * self._nbuckets
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def samples(self):
+        result = [(self.name, self.labels + (('quantile', str(q)),), self.quantile(q)) for q in self.QUANTILES]
+        result.append((self.name + '_sum', self.labels, self.sum))
+        result.append((self.name + '_count', self.labels, self.count))
+        result.append((self.name + '_max', self.labels, self.max))
+        return result
+
+    def families(self):
+        # The max is not part of the summary type, it is exposed as a gauge of its own.
+        samples = self.samples()
+        return [(self.name, self.kind, self.help, samples[:-1]),
+                (self.name + '_max', 'gauge', 'Max of %s' % self.name, samples[-1:])]
+
+    def time(self):
+        """Context manager recording the duration of the block in seconds."""
+        return _Timer(self)
+
+
+class _Timer(object):
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.histogram.record(monotonic() - self.start)
+        return False
+
+
+class MetricsRegistry(object):
+    """Collection of named metrics. Metrics are created once and then updated without locking, the
+    registry lock is only taken on creation and snapshot.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        labels = tuple(sorted(labels.items())) if labels else ()
+        key = (name, labels)
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = cls(name, help, labels, **kwargs)
+                    self._metrics[key] = metric
+        if not isinstance(metric, cls):
+            raise TypeError('metric %s is a %s' % (name, type(metric).__name__))
+        return metric
+
+    def counter(self, name, help='', labels=None, fn=None):
+        """Get or create a Counter. If fn is given it replaces the callback of an existing counter."""
+        counter = self._get(Counter, name, help, labels)
+        if fn is not None:
+            counter.fn = fn
+        return counter
+
+    def gauge(self, name, help='', labels=None, fn=None):
+        """Get or create a Gauge. If fn is given it replaces the callback of an existing gauge."""
+        gauge = self._get(Gauge, name, help, labels)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name, help='', labels=None, **kwargs):
+        """Get or create a Histogram. Keyword arguments are passed to the constructor."""
+        return self._get(Histogram, name, help, labels, **kwargs)
+
+    def timer(self, name, help='', labels=None):
+        """Context manager recording the duration of a block, in seconds, to a histogram."""
+        return _Timer(self.histogram(name, help, labels))
+
+    def timed(self, name, help='', labels=None):
+        """Decorator recording the duration of each call, in seconds, to a histogram."""
+        histogram = self.histogram(name, help, labels)
+
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = monotonic()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    histogram.record(monotonic() - start)
+            return wrapper
+        return decorator
+
+    def metrics(self):
+        with self._lock:
+            return sorted(self._metrics.values(), key=lambda m: (m.name, m.labels))
+
+    def snapshot(self):
+        """Get all samples.
+
+        Returns:
+            A list of (name, labels, value) tuples where labels is a tuple of (name, value) pairs.
+        """
+        samples = []
+        for metric in self.metrics():
+            samples.extend(metric.samples())
+        return samples
+
+    def to_prometheus(self):
+        """Render all metrics in the Prometheus text exposition format."""
+        # Metrics sharing a name with different labels form one family, with one TYPE line.
+        families = collections.OrderedDict()
+        for metric in self.metrics():
+            for family, kind, help, samples in metric.families():
+                entry = families.get(family)
+                if entry is None:
+                    entry = families[family] = (kind, help, [])
+                entry[2].extend(samples)
+        lines = []
+        for family, (kind, help, samples) in families.items():
+            if help:
+                lines.append('# HELP %s %s' % (family, help))
+            lines.append('# TYPE %s %s' % (family, kind))
+            for name, labels, value in samples:
+                if labels:
+                    label_text = ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                          for k, v in labels)
+                    lines.append('%s{%s} %s' % (name, label_text, _format_value(value)))
+                else:
+                    lines.append('%s %s' % (name, _format_value(value)))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def write(self, path):
+        """Write the metrics to a file in the Prometheus text format. The file is replaced atomically so
+        readers, such as the node exporter textfile collector, never see a partial file.
+        """
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.to_prometheus())
+        os.rename(tmp, path)
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        return repr(value)
+    return str(value)
+
+
+# Process wide registry used by the service executor.
+default_registry = MetricsRegistry()
+
+
+_server_class = None
+
+
+def _make_server(address, registry):
+    # http.server loads ssl and email, so it is imported when the endpoint is first started.
+    global _server_class
+    if _server_class is None:
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+            from socketserver import ThreadingMixIn
+        except ImportError:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+            from SocketServer import ThreadingMixIn
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                body = self.server.registry.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+            handler = MetricsHandler
+
+        _server_class = ThreadingHTTPServer
+    server = _server_class(address, _server_class.handler)
+    server.registry = registry
+    return server
+
+
+class MetricsExporter(object):
+    """Exports a registry from a background thread to a Prometheus text HTTP endpoint, a file written
+    every `interval` seconds, or both.
+    """
+
+    def __init__(self, registry=None, port=None, host='', path=None, interval=15.0):
+        """Constructor
+
+        Args:
+            registry: The MetricsRegistry, defaults to default_registry.
+            port: HTTP port, None disables the endpoint.
+            host: HTTP listen address.
+            path: File path, None disables file export.
+            interval: Seconds between file writes.
+        """
+        self.registry = registry if registry is not None else default_registry
+        self.port = port
+        self.host = host
+        self.path = path
+        self.interval = interval
+        self._server = None
+        self._threads = []
+        self._stop = threading.Event()
+
+    def start(self):
+        if self.port is not None:
+            self._server = _make_server((self.host, self.port), self.registry)
+            self.port = self._server.server_address[1]
+            self._start_thread(self._server.serve_forever, 'metrics-http')
+        if self.path is not None:
+            self._start_thread(self._write_loop, 'metrics-file')
+
+    def _start_thread(self, target, name):
+        thread = threading.Thread(target=target, name=name)
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+    def _write_loop(self):
+        while not self._stop.wait(self.interval):
+            self._write()
+
+    def _write(self):
+        try:
+            self.registry.write(self.path)
+        except Exception as e:
+            _logger.warning('Cannot write metrics to %s: %s', self.path, e)
+
+    def stop(self):
+        """Stop exporting. The file is written a final time."""
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self.path is not None:
+            self._write()
@@ -0,0 +1,254 @@
+from __future__ import unicode_literals, print_function
+import os
+import io
+import errno
+import sys
+import time
+import fcntl
+import threading
+import traceback
+import collections
+import logging
+
+
+_logger = logging.getLogger(__name__)
+
+# Python 2 has no monotonic clock.
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+def _thread_names():
+    return dict((t.ident, t.name) for t in threading.enumerate())
+
+
+def format_stacks():
+    """Format the stack of every thread, like a traceback, innermost frame last."""
+    names = _thread_names()
+    lines = []
+    for ident, frame in sys._current_frames().items():
+        lines.append('Thread %s (%s):\n' % (names.get(ident, 'unknown'), ident))
+        lines.extend(traceback.format_stack(frame))
+        lines.append('\n')
+    return ''.join(lines)
+
+
+class SamplingProfiler(object):
+    """Statistical profiler sampling the stack of every thread from a background thread.
+
+    Every `interval` seconds the stacks are read with sys._current_frames(), so the profiled threads
+    do no work, and counted by call path. The result is written in the collapsed stack format read by
+    flamegraph.pl and speedscope, one line per call path:
+
+        thread;module:function;module:function count
+
+    Each sample takes the GIL briefly, at the default 100 Hz the overhead is well under 1%.
+    """
+
+    def __init__(self, path, duration=30.0, interval=0.01):
+        """Constructor
+
+        Args:
+            path: Output file, written when the profile stops.
+            duration: Seconds to sample for.
+            interval: Seconds between samples.
+        """
+        self.path = path
+        self.duration = duration
+        self.interval = interval
+        self.samples = 0
+        self.stacks = collections.Counter()
+        self._labels = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        thread = self._thread
+        return thread is not None and thread.is_alive()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='mservice-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop sampling early. The profile is still written."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _label(self, code, module):
+        # Formatting every frame of every sample is the main cost, cache it per code object.
+        label = self._labels.get(code)
+        if label is None:
+            label = '%s:%s' % (module or os.path.basename(code.co_filename), code.co_name)
+            self._labels[code] = label
+        return label
+
+    def sample(self):
+        """Take one sample of every thread except the profiler."""
+        me = threading.current_thread().ident
+        names = None
+        stacks = self.stacks
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            path = []
+            while frame is not None:
+                path.append(self._label(frame.f_code, frame.f_globals.get('__name__')))
+                frame = frame.f_back
+            if names is None or ident not in names:
+                names = _thread_names()
+            path.append(names.get(ident, 'thread-%s' % ident).replace(';', '_').replace(' ', '_'))
+            path.reverse()
+            stacks[';'.join(path)] += 1
+        self.samples += 1
+
+    def _run(self):
+        deadline = monotonic() + self.duration
+        try:
+            while not self._stop.is_set():
+                now = monotonic()
+                if now >= deadline:
+                    break
+                self.sample()
+                self._stop.wait(min(self.interval, deadline - now))
+        finally:
+            self.write()
+
+    def write(self):
+        try:
+            with io.open(self.path, 'w', encoding='utf-8') as f:
+                for stack, count in sorted(self.stacks.items()):
+                    f.write('%s %d\n' % (stack, count))
+            _logger.info('Profile of %d samples written to %s', self.samples, self.path)
+        except Exception as e:
+            _logger.exception('Cannot write profile to %s', self.path, exc_info=e)
+
+
+class Diagnostics(object):
+    """Stack dumps and profiles requested by signals, see usr1_handler() and usr2_handler() in the
+    executor. Work is done on a background thread, so requests are served while the run loop is busy
+    and signal handlers only bump a counter and write to a pipe the thread reads. Output files are
+    written to `rundir`:
+
+        <name>-<pid>.stacks         thread stacks, appended on each request
+        <name>-<pid>-<time>.folded  collapsed stacks of a profile
+    """
+
+    def __init__(self):
+        self.rundir = None
+        self.name = 'service'
+        self.profile_seconds = 30.0
+        self.profile_interval = 0.01
+        self.profiler = None
+        self._dumps = 0
+        self._profiles = 0
+        self._rfd = None
+        self._wfd = None
+        self._thread = None
+        self._pid = None
+
+    def configure(self, rundir=None, name=None, profile_seconds=None, profile_interval=None):
+        if rundir is not None:
+            self.rundir = rundir
+        if name is not None:
+            self.name = name
+        if profile_seconds:
+            self.profile_seconds = profile_seconds
+        if profile_interval:
+            self.profile_interval = profile_interval
+
+    def start(self):
+        """Start the background thread, again in a forked process, which has its own pipe."""
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        old = (self._rfd, self._wfd)
+        rfd, wfd = os.pipe()
+        flags = fcntl.fcntl(wfd, fcntl.F_GETFL)
+        fcntl.fcntl(wfd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        for fd in (rfd, wfd):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        self._rfd, self._wfd = rfd, wfd
+        for fd in old:
+            # Inherited from the parent, whose thread reads its own copy.
+            if fd is not None:
+                os.close(fd)
+        self.profiler = None
+        self._thread = threading.Thread(target=self._run, args=(rfd,), name='mservice-diagnostics')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def request_dump(self):
+        """Request a stack dump. Safe to call from a signal handler."""
+        self._dumps += 1
+        self._wake()
+
+    def request_profile(self):
+        """Request a profile. Safe to call from a signal handler."""
+        self._profiles += 1
+        self._wake()
+
+    def _wake(self):
+        # Event.set() takes a lock the interrupted thread may hold, a pipe write does not.
+        wfd = self._wfd
+        if wfd is None:
+            return
+        try:
+            os.write(wfd, b'\0')
+        except OSError:
+            # EAGAIN means the pipe is full so a wakeup is already pending.
+            pass
+
+    def _run(self, rfd):
+        dumps = self._dumps
+        profiles = self._profiles
+        while True:
+            try:
+                if not os.read(rfd, 512):
+                    return
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                return
+            if self._dumps != dumps:
+                dumps = self._dumps
+                try:
+                    self.dump_stacks()
+                except Exception as e:
+                    _logger.exception('Cannot dump stacks', exc_info=e)
+            if self._profiles != profiles:
+                profiles = self._profiles
+                try:
+                    self.profile()
+                except Exception as e:
+                    _logger.exception('Cannot start profiler', exc_info=e)
+
+    def _path(self, suffix):
+        rundir = self.rundir or os.getcwd()
+        if not os.path.isdir(rundir):
+            os.makedirs(rundir)
+        return os.path.join(rundir, '%s-%d%s' % (self.name, os.getpid(), suffix))
+
+    def dump_stacks(self):
+        """Append the stack of every thread to the stacks file. Returns its path."""
+        path = self._path('.stacks')
+        with io.open(path, 'a', encoding='utf-8') as f:
+            f.write('--- %s\n' % time.strftime('%Y-%m-%d %H:%M:%S'))
+            f.write(format_stacks())
+        _logger.info('Thread stacks written to %s', path)
+        return path
+
+    def profile(self, seconds=None):
+        """Start a SamplingProfiler unless one is running. Returns the profiler."""
+        if self.profiler is not None and self.profiler.running:
+            _logger.info('Profiler already running, writing to %s', self.profiler.path)
+            return self.profiler
+        path = self._path(time.strftime('-%Y%m%d-%H%M%S.folded'))
+        seconds = seconds or self.profile_seconds
+        self.profiler = SamplingProfiler(path, duration=seconds, interval=self.profile_interval).start()
+        _logger.info('Profiling for %s seconds to %s', seconds, path)
+        return self.profiler
@@ -0,0 +1,242 @@
+from __future__ import unicode_literals, print_function
+import os
+import re
+import io
+import mmap
+import time
+import fcntl
+import threading
+import logging
+from . import metrics
+
+
+_logger = logging.getLogger(__name__)
+
+# Python 2 has no monotonic clock.
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class Resource(object):
+    """A read-only memory map of one version of a resource. Pages are shared by every process mapping
+    the same file, so the data costs one copy per host however many workers use it.
+
+    `buffer` is a read-only memoryview, slicing it does not copy. Decode structured data in place,
+    for example with struct.unpack_from(), or with array() when numpy is installed.
+    """
+
+    def __init__(self, name, version, path):
+        self.name = name
+        self.version = version
+        self.path = path
+        with io.open(path, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            # mmap cannot map an empty file.
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self.buffer = memoryview(self._mmap) if self._mmap is not None else memoryview(b'')
+
+    def __len__(self):
+        return self.size
+
+    def array(self, dtype, count=-1, offset=0):
+        """A read-only numpy array viewing the data, without copying it."""
+        import numpy
+        return numpy.frombuffer(self.buffer, dtype=dtype, count=count, offset=offset)
+
+    def close(self):
+        """Unmap the file. If views of the buffer are still referenced the mapping is left to the
+        garbage collector."""
+        try:
+            self.buffer.release()
+            if self._mmap is not None:
+                self._mmap.close()
+        except BufferError:
+            pass
+
+
+class _Entry(object):
+    __slots__ = ('name', 'build', 'version')
+
+    def __init__(self, name, build, version):
+        self.name = name
+        self.build = build
+        self.version = version
+
+
+class ResourceStore(object):
+    """Resources built once per host into files under `root` and memory mapped by every process.
+
+    A resource is registered with a build function and a version. get() maps the file of the current
+    version, building it first if no process has. Builds are serialized across processes by a file
+    lock and published with an atomic rename, so workers starting together build once, and a restart
+    maps the existing file in milliseconds instead of parsing the source data again.
+
+    The version is a string, or a function returning one, such as the mtime or checksum of the source
+    data. On SIGHUP the executor calls prepare() from prepare_reload(), which builds or maps resources
+    whose version changed while the current ones stay in service, then commit() from
+    commit_reload() to swap them in. Services overriding the reload hooks call these themselves.
+    Old files are deleted after a build, processes still mapping them keep their pages until they
+    swap.
+    """
+    KEEP = 2
+
+    def __init__(self, root, registry=None):
+        """Constructor
+
+        Args:
+            root: Directory of the resource files, created if needed.
+            registry: The MetricsRegistry, defaults to metrics.default_registry.
+        """
+        self.root = root
+        self.registry = registry if registry is not None else metrics.default_registry
+        self._entries = {}
+        self._current = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, build, version=None):
+        """Register a resource.
+
+        Args:
+            name: The resource name, used as a directory name.
+            build: Function called with a binary file object to write the resource to. It may instead
+                return a bytes-like object, which is written for it.
+            version: A string or a function returning the current version string, None for a resource
+                that never changes.
+        """
+        if not re.match(r'^[A-Za-z0-9._-]+$', name) or name.startswith('.'):
+            raise ValueError('Invalid resource name %r' % name)
+        with self._lock:
+            self._entries[name] = _Entry(name, build, version)
+        labels = {'resource': name}
+        self.registry.gauge('mservice_resource_bytes', 'Size of the mapped resource', labels=labels,
+                            fn=lambda: len(self._current[name]) if name in self._current else 0)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def get(self, name):
+        """The current Resource, mapped or built on first use.
+
+        Raises:
+            KeyError: if the name is not registered.
+        """
+        resource = self._current.get(name)
+        if resource is None:
+            with self._lock:
+                resource = self._current.get(name)
+                if resource is None:
+                    resource = self._open(self._entries[name])
+                    self._current[name] = resource
+        return resource
+
+    def _version(self, entry):
+        version = entry.version() if callable(entry.version) else entry.version
+        version = '0' if version is None else '%s' % version
+        # The version is a file name.
+        return re.sub(r'[^A-Za-z0-9._-]', '_', version)
+
+    def _open(self, entry, version=None):
+        if version is None:
+            version = self._version(entry)
+        folder = os.path.join(self.root, entry.name)
+        path = os.path.join(folder, version + '.bin')
+        if os.path.exists(path):
+            return Resource(entry.name, version, path)
+        if not os.path.isdir(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                if not os.path.isdir(folder):
+                    raise
+        with io.open(os.path.join(folder, '.lock'), 'wb') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                # Another process may have built it while we waited for the lock.
+                if not os.path.exists(path):
+                    self._build(entry, folder, path)
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+        return Resource(entry.name, version, path)
+
+    def _build(self, entry, folder, path):
+        # Caller holds the file lock.
+        start = monotonic()
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with io.open(tmp, 'wb') as f:
+                data = entry.build(f)
+                if data is not None:
+                    f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, path)
+        except Exception:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        duration = monotonic() - start
+        self.registry.histogram('mservice_resource_build_seconds', 'Duration of resource builds',
+                                labels={'resource': entry.name}).record(duration)
+        _logger.info('Built resource %s in %.3f seconds', os.path.basename(path), duration)
+        self._clean(folder, path)
+
+    def _clean(self, folder, keep):
+        # Caller holds the file lock. Remove old versions and temporary files of crashed builds.
+        files = []
+        for fname in os.listdir(folder):
+            fpath = os.path.join(folder, fname)
+            if fname.endswith('.tmp'):
+                try:
+                    os.remove(fpath)
+                except OSError:
+                    pass
+            elif fname.endswith('.bin') and fpath != keep:
+                files.append((os.path.getmtime(fpath), fpath))
+        files.sort(reverse=True)
+        for _, fpath in files[self.KEEP - 1:]:
+            try:
+                os.remove(fpath)
+            except OSError:
+                pass
+
+    def prepare(self):
+        """Map or build resources whose version changed, without swapping them in. Called in the
+        reload thread.
+
+        Returns:
+            A dict of new Resource by name, None if no version changed.
+        """
+        with self._lock:
+            entries = list(self._entries.values())
+        prepared = {}
+        for entry in entries:
+            current = self._current.get(entry.name)
+            if current is None:
+                # Never used, get() will map the current version.
+                continue
+            version = self._version(entry)
+            if version != current.version:
+                prepared[entry.name] = self._open(entry, version)
+        return prepared or None
+
+    def commit(self, prepared):
+        """Swap in resources returned by prepare(). Returns the replaced resources."""
+        with self._lock:
+            old = [self._current.get(name) for name in prepared]
+            self._current.update(prepared)
+        for resource in prepared.values():
+            _logger.info('Resource %s now at version %s', resource.name, resource.version)
+        return [resource for resource in old if resource is not None]
+
+    def release(self, resources):
+        """Unmap replaced resources, see Resource.close()."""
+        for resource in resources:
+            resource.close()
+
+    def close(self):
+        """Unmap every resource."""
+        with self._lock:
+            current = list(self._current.values())
+            self._current = {}
+        self.release(current)
@@ -0,0 +1,192 @@
+from __future__ import unicode_literals, print_function
+import os
+import gc
+import time
+import random
+import logging
+import threading
+from . import metrics
+
+
+_logger = logging.getLogger(__name__)
+
+# Python 2 has no monotonic clock.
+monotonic = getattr(time, 'monotonic', time.time)
+
+# Exit status of a process that stopped to be recycled, EX_TEMPFAIL. A process manager or the
+# worker supervisor restarts it.
+RECYCLE_EXIT_CODE = 75
+
+_PAGE_SIZE = os.sysconf(str('SC_PAGE_SIZE'))
+
+
+def rss_bytes():
+    """Resident set size of the process in bytes. Where /proc is missing the peak RSS is returned."""
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (IOError, OSError):
+        import resource
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if os.uname()[0] == 'Darwin' else rss * 1024
+
+
+class GCStats(object):
+    """Records garbage collection pauses per generation to a histogram, and collection counts as
+    counters. Pauses are timed by a gc.callbacks hook, which Python 2 does not have."""
+
+    def __init__(self, registry=None):
+        self.registry = registry if registry is not None else metrics.default_registry
+        self._pauses = [self.registry.histogram('mservice_gc_pause_seconds', 'Duration of garbage collections',
+                                                labels={'generation': str(gen)}) for gen in range(3)]
+        self._start = None
+        self._installed = False
+        if hasattr(gc, 'get_stats'):
+            for gen in range(3):
+                self.registry.counter('mservice_gc_collections_total', 'Garbage collections',
+                                      labels={'generation': str(gen)},
+                                      fn=lambda gen=gen: gc.get_stats()[gen]['collections'])
+                self.registry.counter('mservice_gc_uncollectable_total', 'Uncollectable objects found',
+                                      labels={'generation': str(gen)},
+                                      fn=lambda gen=gen: gc.get_stats()[gen]['uncollectable'])
+
+    def _callback(self, phase, info):
+        if phase == 'start':
+            self._start = monotonic()
+        elif self._start is not None:
+            self._pauses[info['generation']].record(monotonic() - self._start)
+            self._start = None
+
+    def install(self):
+        callbacks = getattr(gc, 'callbacks', None)
+        if callbacks is not None and not self._installed:
+            callbacks.append(self._callback)
+            self._installed = True
+        return self
+
+    def uninstall(self):
+        if self._installed:
+            gc.callbacks.remove(self._callback)
+            self._installed = False
+
+
+class Watchdog(object):
+    """Recycles a process whose memory or latency degrades, before an operator has to.
+
+    check() runs every `interval` seconds on its own thread, so a wake stuck in on_wake() is seen, and
+    calls `recycle(reason)` once when a threshold is crossed:
+
+        rss: resident memory is above `max_rss` bytes, typically from fragmentation or native leaks.
+        latency: at least `slow_wakes` wakes since the last check took longer than `max_wake_seconds`,
+            or the wake in progress has run for `slow_wakes` times `max_wake_seconds`.
+        wakes: the process woke `max_wakes` times.
+        uptime: the process ran for `max_uptime` seconds.
+
+    The wake and uptime limits are raised by a random fraction up to `jitter`, so workers started
+    together do not all recycle together.
+    """
+
+    def __init__(self, max_rss=None, max_wake_seconds=None, slow_wakes=3, max_wakes=None, max_uptime=None,
+                 jitter=0.1, interval=5.0):
+        """Constructor
+
+        Args:
+            max_rss: Max resident memory in bytes, None disables.
+            max_wake_seconds: Duration after which a wake is slow, None disables.
+            slow_wakes: Slow wakes within one check interval that trigger a recycle.
+            max_wakes: Max number of wakes, None disables.
+            max_uptime: Max seconds the process runs, None disables.
+            jitter: Max fraction added to max_wakes and max_uptime.
+            interval: Seconds between checks.
+        """
+        spread = 1.0 + random.uniform(0, jitter)
+        self.max_rss = max_rss
+        self.max_wake_seconds = max_wake_seconds
+        self.slow_wakes = max(slow_wakes, 1)
+        self.max_wakes = None if not max_wakes else int(max_wakes * spread)
+        self.max_uptime = None if not max_uptime else max_uptime * spread
+        self.interval = interval
+        self.reason = None
+        self.rss = None
+        self._health = None
+        self._wake_duration = None
+        self._recycle = None
+        self._started = None
+        self._slow_seen = 0
+        self._gc = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.max_rss or self.max_wake_seconds or self.max_wakes or self.max_uptime)
+
+    def start(self, health, wake_duration, recycle, registry=None):
+        """Start watching.
+
+        Args:
+            health: The HealthState counting wakes.
+            wake_duration: The Histogram of wake durations.
+            recycle: Function called with the reason when a threshold is crossed.
+            registry: The MetricsRegistry, defaults to metrics.default_registry.
+        """
+        registry = registry if registry is not None else metrics.default_registry
+        self._health = health
+        self._wake_duration = wake_duration
+        self._recycle = recycle
+        self._started = monotonic()
+        if self.max_wake_seconds:
+            self._slow_seen = wake_duration.count_above(self.max_wake_seconds)
+        registry.gauge('mservice_rss_bytes', 'Resident memory of the process', fn=rss_bytes)
+        self._gc = GCStats(registry).install()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='mservice-watchdog')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._recycle = None
+        self._stop.set()
+        if self._gc is not None:
+            self._gc.uninstall()
+            self._gc = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                _logger.exception('Watchdog check failed', exc_info=e)
+
+    def check(self, now=None):
+        """Test the thresholds. Returns the reason of a recycle, or None."""
+        recycle = self._recycle
+        if self.reason is not None or recycle is None:
+            return self.reason
+        if now is None:
+            now = monotonic()
+        reason = None
+        if self.max_rss:
+            self.rss = rss_bytes()
+            if self.rss > self.max_rss:
+                reason = 'rss %d MB above %d MB' % (self.rss >> 20, self.max_rss >> 20)
+        if reason is None and self.max_wake_seconds:
+            slow = self._wake_duration.count_above(self.max_wake_seconds)
+            if slow - self._slow_seen >= self.slow_wakes:
+                reason = '%d wakes slower than %s seconds' % (slow - self._slow_seen, self.max_wake_seconds)
+            self._slow_seen = slow
+            wake_started = self._health.wake_started
+            if reason is None and wake_started is not None and \
+                    now - wake_started >= self.slow_wakes * self.max_wake_seconds:
+                reason = 'wake running for %d seconds' % (now - wake_started)
+        if reason is None and self.max_wakes and self._health.wakes >= self.max_wakes:
+            reason = '%d wakes' % self._health.wakes
+        if reason is None and self.max_uptime and now - self._started >= self.max_uptime:
+            reason = 'uptime %d seconds' % (now - self._started)
+        if reason is not None:
+            self.reason = reason
+            _logger.warning('Recycling process %d: %s', os.getpid(), reason)
+            recycle(reason)
+        return reason
@@ -0,0 +1,94 @@
+from __future__ import unicode_literals, print_function
+import unittest
+import os
+import sys
+import logging
+import asyncio
+
+
+# Modify python path
+thisdir = os.path.dirname(os.path.abspath(__file__))
+srcdir = os.path.dirname(thisdir)
+sys.path.insert(0, srcdir)
+
+
+from mservice.aio import AsyncServiceExecutor
+
+
+class AsyncServiceExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.svc = AsyncServiceExecutor(1.0, logging.getLogger('test'), max_concurrency=2)
+        self.svc._start('.')
+
+    def tearDown(self):
+        self.svc._shutdown()
+
+    def test_SpawnBound(self):
+        svc = self.svc
+        gate = asyncio.Event()
+        running = []
+
+        async def work(n):
+            running.append(n)
+            await gate.wait()
+            return n
+
+        async def run():
+            tasks = [await svc.spawn(work(n)) for n in range(2)]
+            third = svc.loop.create_task(svc.spawn(work(2)))
+            await asyncio.sleep(0.01)
+            # The third spawn() waits for a slot.
+            self.assertFalse(third.done())
+            self.assertEqual([0, 1], running)
+            gate.set()
+            tasks.append(await third)
+            return await asyncio.gather(*tasks)
+
+        self.assertEqual([0, 1, 2], svc._run(run()))
+        self.assertEqual(0, svc.pending)
+
+    def test_CancelledTaskReleasesSlot(self):
+        svc = self.svc
+
+        async def work():
+            await asyncio.sleep(0)
+            return 'done'
+
+        async def run():
+            # Cancelled before its first step, and while waiting for a slot.
+            for _ in range(3):
+                task = await svc.spawn(work())
+                task.cancel()
+            blocked = [await svc.spawn(asyncio.sleep(10)) for _ in range(2)]
+            waiting = svc.loop.create_task(svc.spawn(work()))
+            await asyncio.sleep(0.01)
+            waiting.cancel()
+            for task in blocked:
+                task.cancel()
+            await asyncio.gather(*blocked, return_exceptions=True)
+            await asyncio.sleep(0)
+            return await asyncio.wait_for(await svc.spawn(work()), 1.0)
+
+        self.assertEqual('done', svc._run(run()))
+        self.assertEqual(2, svc._slots._value)
+
+    def test_DrainTasksBeforeBatchers(self):
+        svc = self.svc
+        batcher = svc.batcher(lambda items: items, max_batch_size=1, max_latency_ms=0)
+
+        async def work():
+            await asyncio.sleep(0.1)
+            return await asyncio.wrap_future(batcher.submit('a'))
+
+        async def run():
+            return await svc.spawn(work())
+
+        task = svc._run(run())
+        # Spawned tasks still running on TERM can submit to a batcher.
+        svc._terminate(True)
+        self.assertEqual('a', task.result())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+from __future__ import unicode_literals, print_function
+import unittest
+import os
+import sys
+import time
+import threading
+
+
+# Modify python path
+thisdir = os.path.dirname(os.path.abspath(__file__))
+srcdir = os.path.dirname(thisdir)
+sys.path.insert(0, srcdir)
+
+
+from mservice.batch import MicroBatcher, BatcherFull, BatcherClosed
+from mservice.metrics import MetricsRegistry
+
+
+class BatchTest(unittest.TestCase):
+
+    def test_BatchSize(self):
+        batches = []
+
+        def on_batch(items):
+            batches.append(list(items))
+            return [i * 2 for i in items]
+
+        batcher = MicroBatcher(on_batch, max_batch_size=4, max_latency_ms=10000, registry=MetricsRegistry())
+        fs = [batcher.submit(i) for i in range(8)]
+        self.assertEqual([i * 2 for i in range(8)], [f.result(5) for f in fs])
+        self.assertEqual([[0, 1, 2, 3], [4, 5, 6, 7]], batches)
+        self.assertTrue(batcher.close())
+
+    def test_Latency(self):
+        batcher = MicroBatcher(lambda items: items, max_batch_size=100, max_latency_ms=20,
+                               registry=MetricsRegistry())
+        start = time.time()
+        self.assertEqual('a', batcher.submit('a').result(5))
+        self.assertLess(time.time() - start, 2.0)
+        batcher.close()
+
+    def test_Exception(self):
+        def on_batch(items):
+            raise ValueError('bad')
+
+        batcher = MicroBatcher(on_batch, max_batch_size=2, registry=MetricsRegistry())
+        fs = [batcher.submit(i) for i in range(2)]
+        for f in fs:
+            self.assertRaises(ValueError, f.result, 5)
+        batcher.close()
+
+    def test_Backpressure(self):
+        release = threading.Event()
+
+        def on_batch(items):
+            release.wait(5)
+            return items
+
+        batcher = MicroBatcher(on_batch, max_batch_size=1, max_latency_ms=0, capacity=1,
+                               overflow=MicroBatcher.REJECT, registry=MetricsRegistry())
+        first = batcher.submit(1)
+        # Wait for the worker to take the first item so the second is queued.
+        while len(batcher):
+            time.sleep(0.01)
+        second = batcher.submit(2)
+        self.assertRaises(BatcherFull, batcher.submit, 3)
+        release.set()
+        self.assertEqual([1, 2], [first.result(5), second.result(5)])
+        batcher.close()
+
+    def test_Close(self):
+        release = threading.Event()
+        batcher = MicroBatcher(lambda items: release.wait(5) and items, max_batch_size=1, max_latency_ms=0,
+                               registry=MetricsRegistry())
+        first = batcher.submit(1)
+        while len(batcher):
+            time.sleep(0.01)
+        queued = batcher.submit(2)
+        threading.Timer(0.1, release.set).start()
+        self.assertTrue(batcher.close(graceful=False, timeout=5))
+        self.assertEqual(1, first.result(5))
+        self.assertRaises(BatcherClosed, queued.result, 5)
+        self.assertRaises(BatcherClosed, batcher.submit, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
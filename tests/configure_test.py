@@ -0,0 +1,108 @@
+from __future__ import unicode_literals, print_function
+import unittest
+import os
+import sys
+import threading
+try:
+    import grpc
+except ImportError:
+    grpc = None
+
+
+# Modify python path
+thisdir = os.path.dirname(os.path.abspath(__file__))
+srcdir = os.path.dirname(thisdir)
+sys.path.insert(0, srcdir)
+
+
+class FakeError(Exception):
+
+    def __init__(self, code):
+        super(FakeError, self).__init__(code)
+        self._code = code
+
+    def code(self):
+        return self._code
+
+
+class FakeFuture(object):
+    """Completes on a timer, like the future of a grpc call."""
+
+    def __init__(self, outcome):
+        self.outcome = outcome
+        self.cancelled = False
+        self._callbacks = []
+        self._timer = threading.Timer(0.001, self._complete)
+
+    def _complete(self):
+        for callback in self._callbacks:
+            callback(self)
+
+    def add_done_callback(self, fn):
+        self._callbacks.append(fn)
+        self._timer.start()
+
+    def exception(self):
+        return self.outcome if isinstance(self.outcome, Exception) else None
+
+    def result(self):
+        return self.outcome
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class FakeStub(object):
+    """A stub whose configure calls return `outcomes` in order."""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = []
+        self.configure = self
+
+    def future(self, configuration, timeout):
+        self.calls.append(timeout)
+        return FakeFuture(self.outcomes.pop(0))
+
+
+@unittest.skipUnless(grpc, 'grpc is not installed')
+class ConfigureEndpointsTest(unittest.TestCase):
+
+    def configure(self, stubs, **kwargs):
+        from mservice.grpc_core.configure import configure_endpoints
+        kwargs.setdefault('backoff', 0.001)
+        return dict((r.stub, r) for r in configure_endpoints(stubs, 'config', **kwargs))
+
+    def test_Results(self):
+        stubs = [FakeStub('ok %d' % i) for i in range(10)]
+        results = self.configure(stubs, max_concurrency=3, timeout=5)
+        self.assertEqual(['ok %d' % i for i in range(10)], [results[s].result for s in stubs])
+        self.assertEqual([1] * 10, [results[s].attempts for s in stubs])
+
+    def test_RetryUnavailable(self):
+        unavailable = FakeError(grpc.StatusCode.UNAVAILABLE)
+        stub = FakeStub(unavailable, unavailable, 'ok')
+        result = self.configure([stub])[stub]
+        self.assertEqual('ok', result.result)
+        self.assertEqual(3, result.attempts)
+        stub = FakeStub(unavailable, unavailable, 'ok')
+        result = self.configure([stub], retries=1)[stub]
+        self.assertIs(unavailable, result.error)
+        self.assertEqual(2, result.attempts)
+
+    def test_NoRetryWhenApplied(self):
+        # The endpoint may have applied the configuration, a retry could apply it twice.
+        for code in (grpc.StatusCode.DEADLINE_EXCEEDED, grpc.StatusCode.ABORTED,
+                     grpc.StatusCode.RESOURCE_EXHAUSTED, grpc.StatusCode.INVALID_ARGUMENT):
+            stub = FakeStub(FakeError(code), 'ok')
+            result = self.configure([stub])[stub]
+            self.assertEqual(code, result.error.code())
+            self.assertEqual(1, len(stub.calls))
+        # Unless configure is idempotent.
+        stub = FakeStub(FakeError(grpc.StatusCode.DEADLINE_EXCEEDED), 'ok')
+        result = self.configure([stub], retry_codes=(grpc.StatusCode.DEADLINE_EXCEEDED,))[stub]
+        self.assertEqual('ok', result.result)
+
+
+if __name__ == '__main__':
+    unittest.main()
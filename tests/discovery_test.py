@@ -0,0 +1,201 @@
+from __future__ import unicode_literals, print_function
+import unittest
+import os
+import sys
+import time
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+# Modify python path
+thisdir = os.path.dirname(os.path.abspath(__file__))
+srcdir = os.path.dirname(thisdir)
+sys.path.insert(0, srcdir)
+
+
+from mservice.grpc_core.discovery import DiscoveryClient, Endpoint, ServiceNotFound
+
+
+class FakeDiscovery(object):
+    """In-process discovery service."""
+
+    def __init__(self, services):
+        self.services = dict(services)
+        self.lookups = 0
+        self.fail = False
+        self.changes = queue.Queue()
+
+    def lookup(self, name):
+        self.lookups += 1
+        if self.fail:
+            raise IOError('unavailable')
+        return self.services.get(name, [])
+
+    def watch(self, name):
+        yield self.services.get(name, [])
+        while True:
+            endpoints = self.changes.get()
+            if endpoints is None:
+                raise IOError('stream broken')
+            yield endpoints
+
+
+class FakeStream(object):
+    """A watch stream that can be cancelled, like a gRPC response stream."""
+
+    def __init__(self, endpoints):
+        self.changes = queue.Queue()
+        self.changes.put(endpoints)
+        self.cancelled = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        endpoints = self.changes.get()
+        if endpoints is None:
+            raise IOError('cancelled')
+        return endpoints
+    next = __next__
+
+    def cancel(self):
+        self.cancelled = True
+        self.changes.put(None)
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class DiscoveryTest(unittest.TestCase):
+
+    def test_RoundRobin(self):
+        fake = FakeDiscovery({'svc': [('a', 1), ('b', 2)]})
+        client = DiscoveryClient(fake.lookup, ttl=3600)
+        try:
+            picked = set(client.resolve('svc') for _ in range(4))
+            self.assertEqual(set([Endpoint('a', 1), Endpoint('b', 2)]), picked)
+            self.assertEqual(1, fake.lookups)
+            self.assertRaises(ServiceNotFound, client.resolve, 'missing')
+        finally:
+            client.close()
+
+    def test_PickFirst(self):
+        fake = FakeDiscovery({'svc': [('a', 1), ('b', 2)]})
+        client = DiscoveryClient(fake.lookup, balancer='pick-first')
+        self.assertEqual([Endpoint('a', 1)] * 3, [client.resolve('svc') for _ in range(3)])
+        client.close()
+
+    def test_LeastOutstanding(self):
+        fake = FakeDiscovery({'svc': [('a', 1), ('b', 2)]})
+        client = DiscoveryClient(fake.lookup, balancer='least-outstanding')
+        with client.endpoint('svc') as first:
+            with client.endpoint('svc') as second:
+                self.assertNotEqual(first, second)
+            self.assertNotEqual(first, client.resolve('svc'))
+        client.close()
+
+    def test_PollServesStale(self):
+        fake = FakeDiscovery({'svc': [('a', 1)]})
+        client = DiscoveryClient(fake.lookup, ttl=0.05, min_backoff=0.01, max_backoff=0.05)
+        try:
+            self.assertEqual(Endpoint('a', 1), client.resolve('svc'))
+            fake.fail = True
+            lookups = fake.lookups
+            self.assertTrue(wait_for(lambda: fake.lookups > lookups + 1))
+            self.assertEqual(Endpoint('a', 1), client.resolve('svc'))
+            fake.services['svc'] = [('b', 2)]
+            fake.fail = False
+            self.assertTrue(wait_for(lambda: client.resolve('svc') == Endpoint('b', 2)))
+        finally:
+            client.close()
+
+    def test_Watch(self):
+        fake = FakeDiscovery({'svc': [('a', 1)]})
+        client = DiscoveryClient(fake.lookup, watch=fake.watch, min_backoff=0.01, max_backoff=0.05)
+        try:
+            self.assertEqual(Endpoint('a', 1), client.resolve('svc'))
+            fake.changes.put([('b', 2)])
+            self.assertTrue(wait_for(lambda: client.resolve('svc') == Endpoint('b', 2)))
+            # A broken stream keeps the cached endpoints and reconnects.
+            fake.services['svc'] = [('c', 3)]
+            fake.changes.put(None)
+            self.assertTrue(wait_for(lambda: client.resolve('svc') == Endpoint('c', 3)))
+            self.assertEqual(1, fake.lookups)
+        finally:
+            client.close()
+            fake.changes.put(None)
+
+    def test_WatchIdle(self):
+        fake = FakeDiscovery({'svc': [('a', 1)], 'other': [('b', 2)]})
+        streams = []
+
+        def watch(name):
+            streams.append(FakeStream(fake.services[name]))
+            return streams[-1]
+        client = DiscoveryClient(fake.lookup, watch=watch, idle_timeout=0.1)
+        try:
+            client.resolve('svc')
+            client.resolve('other')
+            watcher = client._entries['svc'].watcher
+            # Updates from the stream do not keep a name alive, resolving it does.
+            deadline = time.time() + 0.3
+            while time.time() < deadline:
+                streams[0].changes.put([('a', 1)])
+                client.resolve('other')
+                time.sleep(0.01)
+            self.assertNotIn('svc', client)
+            self.assertIn('other', client)
+            self.assertTrue(streams[0].cancelled)
+            watcher.join(5)
+            self.assertFalse(watcher.is_alive())
+            self.assertFalse(streams[1].cancelled)
+            client.remove('other')
+            self.assertTrue(streams[1].cancelled)
+        finally:
+            client.close()
+
+    def test_WatchReloaded(self):
+        # A watch outliving its name leaves the watch of the name loaded again alone.
+        fake = FakeDiscovery({'svc': [('a', 1)]})
+        streams = []
+        gate = threading.Event()
+
+        def watch(name):
+            stream = FakeStream(fake.services[name])
+            streams.append(stream)
+            if len(streams) == 1:
+                gate.wait(5)
+            return stream
+        client = DiscoveryClient(fake.lookup, watch=watch)
+        try:
+            client.resolve('svc')
+            old = client._entries['svc'].watcher
+            self.assertTrue(wait_for(lambda: streams))
+            client.remove('svc')
+            client.resolve('svc')
+            self.assertTrue(wait_for(lambda: len(streams) == 2))
+            gate.set()
+            old.join(5)
+            self.assertFalse(old.is_alive())
+            self.assertTrue(streams[0].cancelled)
+            self.assertFalse(streams[1].cancelled)
+            self.assertIs(streams[1], client._entries['svc'].stream)
+            streams[1].changes.put([('b', 2)])
+            self.assertTrue(wait_for(lambda: client.resolve('svc') == Endpoint('b', 2)))
+        finally:
+            client.close()
+            for stream in streams:
+                stream.cancel()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,559 @@
+from __future__ import unicode_literals, print_function
+import unittest
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+
+
+# Modify python path
+thisdir = os.path.dirname(os.path.abspath(__file__))
+srcdir = os.path.dirname(thisdir)
+sys.path.insert(0, srcdir)
+
+
+from mservice import executor
+from mservice.executor import WakeSchedule, PeriodicJob, JobScheduler, WakeDispatcher
+from mservice.log import ExceptionRateLimitedLogAdaptor
+from mservice.metrics import MetricsRegistry
+
+
+class WakeScheduleTest(unittest.TestCase):
+
+    def test_FixedDelay(self):
+        schedule = WakeSchedule(10)
+        schedule.start(100)
+        self.assertEqual(0, schedule.delay(100))
+        # The next wake is a period after the previous one finished.
+        self.assertEqual(0, schedule.complete(100, 103))
+        self.assertEqual(10, schedule.delay(103))
+        self.assertEqual(0, schedule.complete(113, 140))
+        self.assertEqual(150, schedule.due)
+        self.assertEqual(1, schedule.overruns)
+        schedule.start(100, immediate=False)
+        self.assertEqual(110, schedule.due)
+
+    def test_FixedRate(self):
+        schedule = WakeSchedule(10, WakeSchedule.FIXED_RATE)
+        schedule.start(100)
+        # The cadence does not drift with the duration of on_wake().
+        self.assertEqual(0, schedule.complete(100, 103))
+        self.assertEqual(110, schedule.due)
+        self.assertEqual(0, schedule.complete(110, 119))
+        self.assertEqual(120, schedule.due)
+
+    def test_Overrun(self):
+        expected = {
+            # policy: (missed, next slot, due)
+            WakeSchedule.SKIP: (3, 140, 140),
+            WakeSchedule.CATCH_UP: (0, 110, 110),
+            WakeSchedule.COALESCE: (2, 130, 135),
+        }
+        for overrun, (missed, slot, due) in expected.items():
+            schedule = WakeSchedule(10, WakeSchedule.FIXED_RATE, overrun)
+            schedule.start(100)
+            # Runs past the slots at 110, 120 and 130.
+            self.assertEqual(missed, schedule.complete(100, 135), overrun)
+            self.assertEqual((slot, due), (schedule.slot, schedule.due), overrun)
+            self.assertEqual(1, schedule.overruns)
+            self.assertEqual(missed, schedule.missed)
+
+    def test_Jitter(self):
+        schedule = WakeSchedule(10, jitter=0.5)
+        schedule.start(100)
+        self.assertTrue(100 <= schedule.due <= 105)
+        schedule.complete(100, 101)
+        self.assertTrue(111 <= schedule.due <= 116)
+        self.assertRaises(ValueError, WakeSchedule, 10, 'bad')
+        self.assertRaises(ValueError, WakeSchedule, 10, overrun='bad')
+
+
+class JobSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.interrupts = 0
+        self.runs = []
+        self.scheduler = JobScheduler(ExceptionRateLimitedLogAdaptor(logging.getLogger('test')), MetricsRegistry(),
+                                      self.interrupt)
+        # Jobs run on the real clock, due times are tested far enough from it.
+        self.now = executor.monotonic()
+
+    def interrupt(self):
+        self.interrupts += 1
+
+    def add(self, name, interval, fn=None, use_pool=False):
+        job = PeriodicJob(name, fn or (lambda: self.runs.append(name)),
+                          WakeSchedule(interval, WakeSchedule.FIXED_RATE), use_pool)
+        self.scheduler.add(job, self.now)
+        return job
+
+    def test_Order(self):
+        for name, interval in (('a', 30), ('b', 10), ('c', 20)):
+            self.add(name, interval)
+        self.assertEqual(3, len(self.scheduler))
+        self.assertAlmostEqual(10, self.scheduler.delay(self.now))
+        self.scheduler.run_due(self.now + 35)
+        self.assertEqual(['b', 'c', 'a'], self.runs)
+
+    def test_Interval(self):
+        job = self.add('a', 10)
+        self.scheduler.run_due(self.now + 9)
+        self.assertEqual([], self.runs)
+        self.scheduler.run_due(self.now + 10)
+        self.assertEqual(['a'], self.runs)
+        # Rescheduled one interval after its slot.
+        self.assertAlmostEqual(self.now + 20, job.schedule.due)
+        self.assertAlmostEqual(10, self.scheduler.delay(self.now + 10))
+        self.scheduler.run_due(self.now + 15)
+        self.assertEqual(1, job.runs)
+        self.assertEqual(1, job.duration.count)
+
+    def test_Remove(self):
+        first = self.add('a', 10)
+        self.add('b', 20)
+        # Adding a job with the same name replaces it.
+        second = self.add('a', 30)
+        self.assertTrue(first.cancelled)
+        self.assertEqual(2, len(self.scheduler))
+        self.assertIs(second, self.scheduler.remove('a'))
+        self.assertTrue(second.cancelled)
+        self.assertIsNone(self.scheduler.remove('a'))
+        # Cancelled jobs are skipped by delay() and never run.
+        self.assertAlmostEqual(20, self.scheduler.delay(self.now))
+        self.scheduler.run_due(self.now + 100)
+        self.assertEqual(['b'], self.runs)
+        self.scheduler.remove('b')
+        self.assertIsNone(self.scheduler.delay(self.now))
+
+    def test_Exception(self):
+        def fail():
+            self.runs.append('fail')
+            raise ValueError('bad')
+
+        failing = self.add('fail', 10, fail)
+        self.add('ok', 10)
+        self.scheduler.run_due(self.now + 10)
+        self.scheduler.run_due(self.now + 20)
+        # A failing job does not stop the others and keeps its schedule.
+        self.assertEqual(['fail', 'ok', 'fail', 'ok'], self.runs)
+        self.assertEqual(2, failing.failures)
+        self.assertEqual(2, failing.runs)
+
+    def test_Pool(self):
+        job = self.add('pooled', 10, use_pool=True)
+        self.scheduler.run_due(self.now + 10)
+        self.scheduler.shutdown()
+        self.assertEqual(['pooled'], self.runs)
+        self.assertFalse(job.running)
+        # The run loop is woken to pick up the new due time.
+        self.assertEqual(1, self.interrupts)
+        self.assertAlmostEqual(self.now + 20, job.schedule.due)
+
+
+class WakeDispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gate = threading.Event()
+        self.started = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.gate.set()
+
+    def work(self, n):
+        with self.lock:
+            self.started.append(n)
+        self.gate.wait(5)
+        return n
+
+    def dispatcher(self, overflow, max_workers=2, max_pending=None):
+        dispatcher = WakeDispatcher(max_workers=max_workers, max_pending=max_pending, overflow=overflow)
+        dispatcher.bind(ExceptionRateLimitedLogAdaptor(logging.getLogger('test')), MetricsRegistry())
+        return dispatcher
+
+    def wait_started(self, n):
+        deadline = time.time() + 5
+        while len(self.started) < n and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(n, len(self.started))
+
+    def test_Skip(self):
+        dispatcher = self.dispatcher(WakeDispatcher.SKIP)
+        futures = [dispatcher.submit(self.work, n) for n in range(3)]
+        self.assertIsNone(futures[2])
+        self.assertEqual(2, len(dispatcher))
+        self.assertEqual(1, dispatcher.dropped)
+        self.wait_started(2)
+        self.gate.set()
+        self.assertTrue(dispatcher.shutdown(timeout=5))
+        self.assertEqual([0, 1], [f.result() for f in futures[:2]])
+        self.assertEqual(0, len(dispatcher))
+        self.assertEqual(2, dispatcher.latency.count)
+
+    def test_DropOldest(self):
+        dispatcher = self.dispatcher(WakeDispatcher.DROP_OLDEST, max_workers=1, max_pending=2)
+        futures = [dispatcher.submit(self.work, n) for n in range(3)]
+        # The running call cannot be cancelled, the oldest queued one is.
+        self.wait_started(1)
+        self.assertTrue(futures[1].cancelled())
+        self.assertEqual(2, len(dispatcher))
+        self.gate.set()
+        self.assertTrue(dispatcher.shutdown(timeout=5))
+        self.assertEqual([0, 2], self.started)
+        self.assertEqual(1, dispatcher.dropped)
+
+    def test_Block(self):
+        dispatcher = self.dispatcher(WakeDispatcher.BLOCK, max_workers=1)
+        dispatcher.submit(self.work, 0)
+        self.wait_started(1)
+        # Abandoned when the service terminates.
+        start = time.time()
+        self.assertIsNone(dispatcher.submit_unless(lambda: time.time() - start > 0.1, self.work, 1))
+        threading.Timer(0.1, self.gate.set).start()
+        self.assertIsNotNone(dispatcher.submit(self.work, 2))
+        self.assertTrue(dispatcher.shutdown(timeout=5))
+        self.assertEqual([0, 2], self.started)
+
+    def test_Shutdown(self):
+        dispatcher = self.dispatcher(WakeDispatcher.SKIP, max_workers=1, max_pending=3)
+        futures = [dispatcher.submit(self.work, n) for n in range(3)]
+        self.wait_started(1)
+        # Not graceful, queued work is cancelled and the running call is waited for.
+        self.assertFalse(dispatcher.shutdown(graceful=False, timeout=0.1))
+        self.assertEqual([False, True, True], [f.cancelled() for f in futures])
+        self.gate.set()
+        futures[0].result(5)
+        self.assertEqual(2, dispatcher.dropped)
+
+    def test_Drain(self):
+        dispatcher = self.dispatcher(WakeDispatcher.SKIP, max_workers=1, max_pending=3)
+        futures = [dispatcher.submit(self.work, n) for n in range(3)]
+        threading.Timer(0.1, self.gate.set).start()
+        self.assertTrue(dispatcher.shutdown(graceful=True, timeout=5))
+        self.assertEqual([0, 1, 2], [f.result() for f in futures])
+        self.assertEqual(0, dispatcher.dropped)
+
+
+class OffloadedExecutor(executor.ServiceExecutor):
+
+    def __init__(self):
+        super(OffloadedExecutor, self).__init__(0.05, logging.getLogger('test'),
+                                                dispatcher=WakeDispatcher(max_workers=1), offload_wake=True)
+        self.wake_duration = MetricsRegistry().histogram('wake_seconds')
+        self.threads = []
+
+    def on_wake(self):
+        self.threads.append(threading.current_thread().name)
+        time.sleep(0.1)
+        if len(self.threads) == 2:
+            self.force_terminate()
+
+
+class ReloadExecutor(executor.ServiceExecutor):
+    """Reload hooks recording their calls, with the thread they ran in."""
+
+    def __init__(self):
+        super(ReloadExecutor, self).__init__(1.0, ExceptionRateLimitedLogAdaptor(logging.getLogger('test')))
+        self.calls = []
+        self.version = 0
+        self.gate = threading.Event()
+        self.gate.set()
+        self.prepare_error = None
+        self.commit_error = None
+        self.current = 0
+        self.done = threading.Event()
+
+    def record(self, *call):
+        self.calls.append(call + (threading.current_thread().name,))
+
+    def prepare_reload(self):
+        self.gate.wait(5)
+        self.version += 1
+        self.record('prepare', self.version)
+        if self.prepare_error is not None:
+            raise self.prepare_error
+        return self.version
+
+    def commit_reload(self, resources):
+        self.record('commit', resources)
+        if self.commit_error is not None:
+            raise self.commit_error
+        old, self.current = self.current, resources
+        return old
+
+    def release_reload(self, resources):
+        self.record('release', resources)
+        self.done.set()
+
+    def rollback_reload(self, error, resources):
+        self.record('rollback', error, resources)
+        self.done.set()
+
+
+class ReloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.svc = ReloadExecutor()
+        self.reloader = self.svc.reloader
+
+    def wait_prepared(self, reloader=None):
+        reloader = reloader or self.reloader
+        deadline = time.time() + 5
+        while reloader._prepared is None and reloader.in_progress and time.time() < deadline:
+            time.sleep(0.001)
+
+    def test_Reload(self):
+        self.reloader.request()
+        self.assertTrue(self.svc.health.reloading)
+        self.wait_prepared()
+        self.assertTrue(self.reloader.poll())
+        self.assertTrue(self.svc.done.wait(5))
+        self.assertEqual([('prepare', 1, 'mservice-reload'), ('commit', 1, 'MainThread'),
+                          ('release', 0, 'mservice-reload')], self.svc.calls)
+        self.assertEqual(1, self.svc.current)
+        self.assertFalse(self.svc.health.reloading)
+        self.assertFalse(self.reloader.poll())
+
+    def test_PrepareFailure(self):
+        error = ValueError('bad config')
+        self.svc.prepare_error = error
+        self.reloader.request()
+        self.assertTrue(self.svc.done.wait(5))
+        self.wait_prepared()
+        self.assertFalse(self.reloader.poll())
+        self.assertEqual([('prepare', 1, 'mservice-reload'), ('rollback', error, None, 'mservice-reload')],
+                         self.svc.calls)
+        self.assertEqual(0, self.svc.current)
+        self.assertEqual(1, self.reloader.failures)
+        self.assertFalse(self.svc.health.reloading)
+
+    def test_CommitFailure(self):
+        error = ValueError('cannot swap')
+        self.svc.commit_error = error
+        self.reloader.request()
+        self.wait_prepared()
+        self.assertFalse(self.reloader.poll())
+        self.assertTrue(self.svc.done.wait(5))
+        # Rolled back in the background, not on the run loop.
+        self.assertEqual(('rollback', error, 1, 'mservice-reload'), self.svc.calls[-1])
+        self.assertEqual(1, self.reloader.failures)
+        self.assertEqual(0, self.reloader.reloads)
+
+    def test_HupDuringReload(self):
+        self.svc.gate.clear()
+        self.reloader.request()
+        # Queued while the first reload is prepared, and coalesced.
+        self.reloader.request()
+        self.reloader.request()
+        self.svc.gate.set()
+        self.wait_prepared()
+        self.assertTrue(self.reloader.poll())
+        self.assertTrue(self.reloader.in_progress)
+        self.wait_prepared()
+        self.assertTrue(self.reloader.poll())
+        self.assertFalse(self.reloader.in_progress)
+        self.assertEqual(2, self.reloader.reloads)
+        self.assertEqual(2, self.svc.current)
+        self.assertFalse(self.svc.health.reloading)
+
+    def test_ShutdownWhilePreparing(self):
+        self.svc.gate.clear()
+        self.reloader.request()
+        self.reloader.shutdown()
+        self.svc.gate.set()
+        self.assertTrue(self.svc.done.wait(5))
+        # The new resources are never used.
+        self.assertEqual(('rollback', None, 1, 'mservice-reload'), self.svc.calls[-1])
+        self.assertFalse(self.reloader.poll())
+        self.assertEqual(0, self.svc.current)
+        self.reloader.request()
+        self.assertFalse(self.reloader.in_progress)
+
+    def test_ShutdownWhenPrepared(self):
+        self.reloader.request()
+        self.wait_prepared()
+        self.reloader.shutdown(5)
+        self.assertTrue(self.svc.done.wait(5))
+        self.assertEqual(('rollback', None, 1, 'mservice-reload'), self.svc.calls[-1])
+        self.assertFalse(self.reloader.in_progress)
+        self.assertFalse(self.svc.health.reloading)
+
+
+class ShutdownBudgetTest(unittest.TestCase):
+
+    def test_Phases(self):
+        budget = executor.ShutdownBudget(10.0, registry=MetricsRegistry()).start()
+        try:
+            ends = [budget.ends[name] - budget.started for name, _ in budget.PHASES]
+            self.assertEqual([4.0, 6.0, 8.0, 10.0], [round(end, 6) for end in ends])
+            self.assertAlmostEqual(4.0, budget.remaining('drain'), delta=0.1)
+            self.assertAlmostEqual(10.0, budget.remaining(), delta=0.1)
+            # Time left by a phase passes to the next.
+            self.assertAlmostEqual(6.0, budget.remaining('term'), delta=0.1)
+        finally:
+            budget.finish()
+
+    def test_NoLimit(self):
+        budget = executor.ShutdownBudget(None, registry=MetricsRegistry()).start()
+        self.assertIsNone(budget.remaining('drain'))
+        self.assertIsNone(budget.remaining())
+        self.assertIsNone(budget._watchdog)
+
+    def test_PhaseOverrun(self):
+        registry = MetricsRegistry()
+        budget = executor.ShutdownBudget(0.05, registry=registry).start()
+        budget.finish()
+        with budget.phase('drain'):
+            time.sleep(0.03)
+        histogram = registry.histogram('mservice_shutdown_seconds', labels={'phase': 'drain'})
+        self.assertEqual(1, histogram.count)
+        self.assertGreaterEqual(histogram.max, 0.03)
+
+    def test_WatchdogFinished(self):
+        budget = executor.ShutdownBudget(0.1, registry=MetricsRegistry()).start()
+        budget.finish()
+        budget._watchdog.join(1)
+        self.assertFalse(budget._watchdog.is_alive())
+
+    def test_WatchdogExits(self):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(r)
+                budget = executor.ShutdownBudget(0.1, registry=MetricsRegistry(), exit_code=3,
+                                                 cleanup=lambda: os.write(w, b'x'))
+                with budget.start().phase('term'):
+                    time.sleep(10)
+            finally:
+                os._exit(0)
+        os.close(w)
+        try:
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(b'x', os.read(r, 1))
+        finally:
+            os.close(r)
+        self.assertTrue(os.WIFEXITED(status))
+        self.assertEqual(3, os.WEXITSTATUS(status))
+
+
+class TermExecutor(executor.ServiceExecutor):
+
+    def __init__(self):
+        super(TermExecutor, self).__init__(0.01, logging.getLogger('test'))
+        self.metrics = MetricsRegistry()
+        self.terms = []
+        self.add_periodic('job', 60, lambda: None)
+        self.job_shutdowns = 0
+        shutdown = self._jobs.shutdown
+
+        def count_shutdown(wait=True):
+            self.job_shutdowns += 1
+            shutdown(wait)
+        self._jobs.shutdown = count_shutdown
+
+    def on_wake(self):
+        self.force_terminate()
+
+    def on_term(self, graceful):
+        self.terms.append(graceful)
+
+
+class StuckExecutor(executor.ServiceExecutor):
+
+    def __init__(self, state):
+        super(StuckExecutor, self).__init__(0.01, state)
+
+    def on_wake(self):
+        self.force_terminate()
+        time.sleep(60)
+
+
+class NotifyExecutor(executor.ServiceExecutor):
+
+    def __init__(self, period):
+        schedule = WakeSchedule(period, WakeSchedule.FIXED_RATE, WakeSchedule.CATCH_UP)
+        super(NotifyExecutor, self).__init__(period, logging.getLogger('test'), schedule)
+        self.wakes = []
+
+    def on_wake(self):
+        self.wakes.append(executor.monotonic())
+        if len(self.wakes) == 1:
+            # Overrun so the next wake is due, and notify before it.
+            time.sleep(self.wakeup * 1.25)
+            self.notify()
+        elif len(self.wakes) == 3:
+            self.force_terminate()
+
+
+class RunLoopTest(unittest.TestCase):
+
+    def tearDown(self):
+        executor.terminate = False
+
+    def test_NotifyBeforeScheduledWake(self):
+        svc = NotifyExecutor(0.2)
+        svc._run_loop()
+        self.assertEqual(3, len(svc.wakes))
+        # The scheduled wake served the notify, so the third waits for its slot.
+        self.assertGreater(svc.wakes[2] - svc.wakes[1], 0.08)
+
+    def test_TermOnce(self):
+        svc = TermExecutor()
+        svc._run_loop()
+        # As run() does after the run loop returns.
+        svc._terminate(False)
+        self.assertEqual([True], svc.terms)
+        for name in ('drain', 'term'):
+            histogram = svc.metrics.histogram('mservice_shutdown_seconds', labels={'phase': name})
+            self.assertEqual(1, histogram.count)
+        self.assertEqual(1, svc.job_shutdowns)
+
+    def test_DrainDispatchedBeforeBatchers(self):
+        # Work still dispatched when TERM arrives can submit to a batcher.
+        svc = executor.ServiceExecutor(1.0, logging.getLogger('test'), dispatcher=WakeDispatcher(max_workers=1))
+        batcher = svc.batcher(lambda items: items, max_batch_size=1, max_latency_ms=0)
+        future = svc.dispatch(lambda: (time.sleep(0.1), batcher.submit('a').result(5))[1])
+        svc._terminate(True)
+        self.assertEqual('a', future.result(5))
+
+    def test_TermDuringStuckWake(self):
+        # The budget starts when TERM is requested, its watchdog ends a wake that never returns.
+        pid = os.fork()
+        if pid == 0:
+            try:
+                state = executor.DefaultServiceState(logger=logging.getLogger('test'), shutdown_timeout=0.3)
+                svc = StuckExecutor(state)
+                svc._run_loop()
+            finally:
+                os._exit(0)
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                break
+            time.sleep(0.01)
+        else:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            self.fail('stuck wake not ended')
+        self.assertTrue(os.WIFEXITED(status))
+        self.assertEqual(1, os.WEXITSTATUS(status))
+
+    def test_OffloadedWakeTiming(self):
+        svc = OffloadedExecutor()
+        overruns = svc.wake_overruns.value
+        svc._run_loop()
+        self.assertEqual(2, len(svc.threads))
+        self.assertNotIn(threading.current_thread().name, svc.threads)
+        # Timed in the pool, not the dispatch.
+        self.assertEqual(2, svc.wake_duration.count)
+        self.assertGreaterEqual(svc.wake_duration.max, 0.1)
+        self.assertEqual(2, svc.health.wakes)
+        self.assertEqual(overruns + 2, svc.wake_overruns.value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+from __future__ import unicode_literals, print_function
+import unittest
+import os
+import sys
+import json
+import socket
+import tempfile
+try:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import urlopen, HTTPError
+
+
+# Modify python path
+thisdir = os.path.dirname(os.path.abspath(__file__))
+srcdir = os.path.dirname(thisdir)
+sys.path.insert(0, srcdir)
+
+
+from mservice.health import HealthState, HealthServer, monotonic
+
+
+def get(port, path):
+    try:
+        response = urlopen('http://127.0.0.1:%d%s' % (port, path))
+        return response.getcode(), response.read().decode('utf-8')
+    except HTTPError as e:
+        return e.code, e.read().decode('utf-8')
+
+
+class HealthTest(unittest.TestCase):
+
+    def test_State(self):
+        health = HealthState(1.0, tolerance=3.0, min_timeout=0.5)
+        self.assertTrue(health.live())
+        self.assertFalse(health.ready())
+        health.started = True
+        health.running = True
+        health.tick()
+        self.assertTrue(health.ready())
+        health.reloading = True
+        self.assertTrue(health.live())
+        self.assertFalse(health.ready())
+        health.reloading = False
+        now = monotonic()
+        self.assertFalse(health.live(now + 4.0))
+        health.wake_begin(now)
+        self.assertTrue(health.live(now + 2.0))
+        self.assertFalse(health.live(now + 4.0))
+        health.wake_end(now + 0.25, 0.25)
+        self.assertEqual(0.25, health.report()['last_wake_duration'])
+        self.assertEqual(1, health.report()['wakes'])
+
+    def test_Server(self):
+        health = HealthState(1.0)
+        path = os.path.join(tempfile.mkdtemp(), 'health.sock')
+        server = HealthServer(health, port=0, host='127.0.0.1', path=path)
+        server.start()
+        try:
+            self.assertEqual(200, get(server.port, '/healthz')[0])
+            self.assertEqual(503, get(server.port, '/readyz')[0])
+            health.started = health.running = True
+            health.tick()
+            self.assertEqual((200, 'ok\n'), get(server.port, '/readyz'))
+            code, body = get(server.port, '/health')
+            self.assertEqual(200, code)
+            self.assertTrue(json.loads(body)['ready'])
+            self.assertEqual(404, get(server.port, '/nope')[0])
+
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(path)
+            sock.sendall(b'GET /readyz HTTP/1.0\r\n\r\n')
+            data = b''
+            while True:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+            sock.close()
+            self.assertTrue(data.startswith(b'HTTP/1.0 200'))
+        finally:
+            server.stop()
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,470 @@
+#!/usr/bin/env python
+"""Lifecycle benchmark and soak test for ServiceExecutor. Reports, as JSON:
+
+    wake_overhead: framework time between consecutive on_wake() calls.
+    wake_jitter: lateness of FIXED_RATE wakes relative to their slot.
+    signal_latency: time from SIGHUP/SIGTERM to on_hup()/on_term(), with an idle run loop, with a
+        busy on_wake(), and with a busy on_wake() offloaded to a WakeDispatcher.
+    memory: RSS growth over many wakes.
+    log_throughput: records per second through ExceptionRateLimitedLogAdaptor to a file.
+    subprocess: startup time, signal latencies and exit time of a service run as a child process.
+    soak: RSS of a child process sampled over time while it wakes as fast as it can.
+
+Latencies are in milliseconds. Logs go to temporary files, nothing leaves the machine.
+
+    python tests/lifecycle_bench.py [--quick] [--soak 60] [--output new.json] [--compare old.json]
+"""
+from __future__ import unicode_literals, print_function
+import os
+import sys
+import json
+import time
+import select
+import signal
+import logging
+import tempfile
+import threading
+import subprocess
+from optparse import OptionParser
+
+
+# Modify python path
+thisdir = os.path.dirname(os.path.abspath(__file__))
+srcdir = os.path.dirname(thisdir)
+sys.path.insert(0, srcdir)
+
+
+from mservice import executor
+from mservice.log import ExceptionRateLimitedLogAdaptor
+from startup_bench import percentile
+
+
+monotonic = executor.monotonic
+_PAGESIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def rss(pid=None):
+    """Resident set size in bytes of a process, defaults to this process."""
+    with open('/proc/%s/statm' % ('self' if pid is None else pid)) as f:
+        return int(f.read().split()[1]) * _PAGESIZE
+
+
+def summarize(seconds):
+    """Latency summary in milliseconds."""
+    if not seconds:
+        return {'count': 0}
+    return {
+        'count': len(seconds),
+        'mean': sum(seconds) * 1000 / len(seconds),
+        'p50': percentile(seconds, 0.5) * 1000,
+        'p90': percentile(seconds, 0.9) * 1000,
+        'p99': percentile(seconds, 0.99) * 1000,
+        'max': max(seconds) * 1000,
+    }
+
+
+def _bench_logger(name='marbles.bench'):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    if not logger.handlers:
+        logger.addHandler(logging.NullHandler())
+    return logger
+
+
+def _reset_signals():
+    # The executor keeps signal state in module globals.
+    executor.terminate = False
+    executor.hup_recv = 0
+
+
+def _spin(seconds):
+    end = monotonic() + seconds
+    while monotonic() < end:
+        pass
+
+
+class _WakeCounter(executor.ServiceExecutor):
+    """Runs on_wake() `wakes` times then terminates. Records the start and end of each wake."""
+
+    def __init__(self, wakes, schedule, sample_every=0):
+        super(_WakeCounter, self).__init__(schedule.period, _bench_logger(), schedule=schedule)
+        self.remaining = wakes
+        self.sample_every = sample_every
+        self.starts = []
+        self.ends = []
+        self.lateness = []
+        self.rss = []
+
+    def on_wake(self):
+        start = monotonic()
+        self.lateness.append(start - self.schedule.slot)
+        self.remaining -= 1
+        if self.sample_every and self.remaining % self.sample_every == 0:
+            self.rss.append(rss())
+        if self.remaining <= 0:
+            self.force_terminate()
+        self.starts.append(start)
+        self.ends.append(monotonic())
+
+
+def bench_wake_overhead(wakes):
+    _reset_signals()
+    svc = _WakeCounter(wakes, executor.WakeSchedule(0))
+    start = monotonic()
+    svc._run_loop()
+    elapsed = monotonic() - start
+    gaps = [svc.starts[i + 1] - svc.ends[i] for i in range(len(svc.starts) - 1)]
+    result = summarize(gaps)
+    result['wakes_per_second'] = len(svc.starts) / elapsed
+    return result
+
+
+def bench_wake_jitter(wakes, period):
+    _reset_signals()
+    svc = _WakeCounter(wakes, executor.WakeSchedule(period, mode=executor.WakeSchedule.FIXED_RATE))
+    svc._run_loop()
+    result = summarize(svc.lateness)
+    result['period_ms'] = period * 1000
+    return result
+
+
+def bench_memory(wakes, samples=20):
+    _reset_signals()
+    svc = _WakeCounter(wakes, executor.WakeSchedule(0), sample_every=max(wakes // samples, 1))
+    before = rss()
+    svc._run_loop()
+    after = rss()
+    return {
+        'wakes': wakes,
+        'rss_start_mb': before / 1048576.0,
+        'rss_end_mb': after / 1048576.0,
+        'growth_kb': (after - before) / 1024.0,
+        'samples_mb': [r / 1048576.0 for r in svc.rss],
+    }
+
+
+class _SignalTarget(executor.ServiceExecutor):
+    """Records when on_hup() and on_term() run. on_wake() spins for `wake_work` seconds."""
+
+    def __init__(self, wakeup, wake_work, offload):
+        dispatcher = executor.WakeDispatcher(max_workers=1) if offload else None
+        super(_SignalTarget, self).__init__(wakeup, _bench_logger(), dispatcher=dispatcher, offload_wake=offload)
+        self.wake_work = wake_work
+        self.hup = threading.Event()
+        self.hup_times = []
+        self.term_time = None
+
+    def on_wake(self):
+        if self.wake_work:
+            _spin(self.wake_work)
+
+    def on_hup(self):
+        self.hup_times.append(monotonic())
+        self.hup.set()
+
+    def on_term(self, graceful):
+        self.term_time = monotonic()
+
+
+def bench_signal_latency(hups, wakeup, wake_work=0.0, offload=False):
+    """Send signals to this process while the run loop runs on the main thread."""
+    _reset_signals()
+    svc = _SignalTarget(wakeup, wake_work, offload)
+    sent = []
+    term_sent = []
+
+    def sender():
+        time.sleep(0.05)
+        for i in range(hups):
+            svc.hup.clear()
+            # Spread the signals over the wake cycle.
+            time.sleep(0.001 + (i % 7) * max(wake_work, 0.001) / 7)
+            sent.append(monotonic())
+            os.kill(os.getpid(), signal.SIGHUP)
+            svc.hup.wait(5)
+        term_sent.append(monotonic())
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    prev_term = signal.signal(signal.SIGTERM, executor.term_handler)
+    prev_hup = signal.signal(signal.SIGHUP, executor.hup_handler)
+    thread = threading.Thread(target=sender)
+    thread.start()
+    try:
+        svc._run_loop()
+    finally:
+        thread.join()
+        signal.signal(signal.SIGTERM, prev_term)
+        signal.signal(signal.SIGHUP, prev_hup)
+        _reset_signals()
+    return {
+        'wake_work_ms': wake_work * 1000,
+        'offload': offload,
+        'hup': summarize([r - s for s, r in zip(sent, svc.hup_times)]),
+        'term_ms': (svc.term_time - term_sent[0]) * 1000,
+    }
+
+
+def bench_log_throughput(records):
+    path = os.path.join(tempfile.mkdtemp(), 'bench.log')
+    logger = logging.getLogger('marbles.bench.log')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = logging.FileHandler(path, mode='w')
+    executor.init_log_handler(handler, logging.INFO)
+    logger.addHandler(handler)
+    adaptor = ExceptionRateLimitedLogAdaptor(logger)
+    result = {}
+    try:
+        start = monotonic()
+        for i in range(records):
+            adaptor.info('Record %d', i)
+        result['info_per_second'] = records / (monotonic() - start)
+
+        start = monotonic()
+        for i in range(records):
+            adaptor.debug('Record %d', i)
+        result['filtered_per_second'] = records / (monotonic() - start)
+
+        try:
+            raise ValueError('bench')
+        except ValueError as e:
+            error = e
+        start = monotonic()
+        for i in range(records):
+            adaptor.exception('Exception %d', i, exc_info=error)
+        result['exception_per_second'] = records / (monotonic() - start)
+        result['exceptions_suppressed'] = adaptor.suppressed
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+        os.remove(path)
+    return result
+
+
+class _Child(object):
+    """A benchmark service run as a child process. It writes one event per line to stdout."""
+
+    def __init__(self, wakeup, wake_work=0.0, offload=False):
+        self.tmpdir = tempfile.mkdtemp()
+        args = [sys.executable, os.path.abspath(__file__), '--child',
+                '--log-file', os.path.join(self.tmpdir, 'child.log'),
+                '--pid-file', os.path.join(self.tmpdir, 'child.pid'),
+                '--wakeup', str(wakeup), '--wake-work', str(wake_work)]
+        if offload:
+            args.append('--offload')
+        self.spawned = monotonic()
+        self.proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+        self._buf = b''
+
+    @property
+    def pid(self):
+        return self.proc.pid
+
+    def expect(self, event, timeout=10.0):
+        """Wait for an event.
+
+        Returns:
+            The monotonic time the child recorded for it.
+        """
+        deadline = monotonic() + timeout
+        fd = self.proc.stdout.fileno()
+        while True:
+            while b'\n' in self._buf:
+                line, self._buf = self._buf.split(b'\n', 1)
+                name, stamp = line.decode('utf-8').split()
+                if name == event:
+                    return float(stamp)
+            remaining = deadline - monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise RuntimeError('child did not report %s' % event)
+            data = os.read(fd, 4096)
+            if not data:
+                raise RuntimeError('child exited before reporting %s' % event)
+            self._buf += data
+
+    def send(self, signum):
+        sent = monotonic()
+        os.kill(self.proc.pid, signum)
+        return sent
+
+    def kill(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+
+
+def bench_subprocess(hups, wakeup, wake_work=0.0, offload=False):
+    child = _Child(wakeup, wake_work, offload)
+    try:
+        ready = child.expect('ready')
+        rss_start = rss(child.pid)
+        latencies = []
+        for i in range(hups):
+            time.sleep(0.001 + (i % 7) * max(wake_work, 0.001) / 7)
+            sent = child.send(signal.SIGHUP)
+            latencies.append(child.expect('hup') - sent)
+        sent = child.send(signal.SIGTERM)
+        term = child.expect('term') - sent
+        child.proc.wait()
+        exited = monotonic() - sent
+        return {
+            'wake_work_ms': wake_work * 1000,
+            'offload': offload,
+            'startup_ms': (ready - child.spawned) * 1000,
+            'rss_mb': rss_start / 1048576.0,
+            'hup': summarize(latencies),
+            'term_ms': term * 1000,
+            'exit_ms': exited * 1000,
+            'returncode': child.proc.returncode,
+        }
+    finally:
+        child.kill()
+
+
+def bench_soak(duration, interval=1.0):
+    child = _Child(0.0001)
+    try:
+        child.expect('ready')
+        samples = []
+        start = monotonic()
+        while monotonic() - start < duration:
+            samples.append(rss(child.pid))
+            time.sleep(interval)
+        samples.append(rss(child.pid))
+        child.send(signal.SIGTERM)
+        child.expect('term')
+        wakes = int(child.expect('wakes'))
+        child.proc.wait()
+        return {
+            'seconds': duration,
+            'wakes': wakes,
+            'rss_start_mb': samples[0] / 1048576.0,
+            'rss_end_mb': samples[-1] / 1048576.0,
+            'growth_kb': (samples[-1] - samples[0]) / 1024.0,
+            'samples_mb': [s / 1048576.0 for s in samples],
+        }
+    finally:
+        child.kill()
+
+
+class _ChildService(executor.ServiceExecutor):
+
+    def __init__(self, state, wakeup, wake_work, offload):
+        dispatcher = executor.WakeDispatcher(max_workers=1) if offload else None
+        super(_ChildService, self).__init__(wakeup, state, dispatcher=dispatcher, offload_wake=offload)
+        self.wake_work = wake_work
+        self.wakes = 0
+
+    def _event(self, name, value=None):
+        sys.stdout.write('%s %r\n' % (name, monotonic() if value is None else value))
+        sys.stdout.flush()
+
+    def on_start(self, workdir):
+        self._event('ready')
+
+    def on_wake(self):
+        self.wakes += 1
+        if self.wake_work:
+            _spin(self.wake_work)
+
+    def on_hup(self):
+        self._event('hup')
+
+    def on_term(self, graceful):
+        self._event('term')
+        self._event('wakes', self.wakes)
+
+
+def run_child(options):
+    state = executor.process_parser_options(options, 'lifecycle_bench')
+    svc = _ChildService(state, options.wakeup, options.wake_work, options.offload)
+    svc.run(os.path.dirname(options.pid_file))
+
+
+def run_benchmarks(options):
+    scale = 10 if options.quick else 1
+    hups = 50 // scale * 2
+    results = {}
+    results['wake_overhead'] = bench_wake_overhead(options.wakes // scale)
+    results['wake_jitter'] = bench_wake_jitter(1000 // scale, 0.002)
+    results['memory'] = bench_memory(options.wakes // scale)
+    results['log_throughput'] = bench_log_throughput(100000 // scale)
+    results['signal_latency'] = {
+        'idle': bench_signal_latency(hups, 60),
+        'busy': bench_signal_latency(hups, 0.001, wake_work=0.05),
+        'offload': bench_signal_latency(hups, 0.001, wake_work=0.05, offload=True),
+    }
+    if not options.skip_subprocess:
+        results['subprocess'] = {
+            'idle': bench_subprocess(hups, 60),
+            'busy': bench_subprocess(hups, 0.001, wake_work=0.05),
+            'offload': bench_subprocess(hups, 0.001, wake_work=0.05, offload=True),
+        }
+    if options.soak > 0:
+        results['soak'] = bench_soak(options.soak)
+    return {
+        'benchmark': 'lifecycle',
+        'python': sys.version.split()[0],
+        'quick': options.quick,
+        'results': results,
+    }
+
+
+def _flatten(value, prefix=''):
+    if isinstance(value, dict):
+        for key in sorted(value):
+            for item in _flatten(value[key], prefix + '.' + key if prefix else key):
+                yield item
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+
+def compare(old, new):
+    """Print the change of each numeric result between two reports."""
+    old_values = dict(_flatten(old.get('results', {})))
+    for key, value in _flatten(new.get('results', {})):
+        prev = old_values.get(key)
+        if prev is None:
+            continue
+        change = (value - prev) * 100.0 / prev if prev else 0.0
+        print('%-50s %14.3f %14.3f %+8.1f%%' % (key, prev, value, change))
+
+
+if __name__ == '__main__':
+    usage = 'Usage: %prog [options]'
+    parser = OptionParser(usage)
+    parser.add_option('--quick', action='store_true', dest='quick', default=False,
+                      help='Run a tenth of the iterations.')
+    parser.add_option('--wakes', type='int', action='store', dest='wakes', default=200000,
+                      help='Wakes for the overhead and memory benchmarks, defaults to 200000.')
+    parser.add_option('--soak', type='float', action='store', dest='soak', default=0,
+                      help='Seconds to run the soak test, defaults to 0 (disabled).')
+    parser.add_option('--skip-subprocess', action='store_true', dest='skip_subprocess', default=False,
+                      help='Only run the in-process benchmarks.')
+    parser.add_option('-o', '--output', type='string', action='store', dest='output',
+                      help='Write the JSON report to this file, defaults to stdout.')
+    parser.add_option('--compare', type='string', action='store', dest='compare',
+                      help='Print the change from a previous JSON report.')
+    # Child process options.
+    parser.add_option('--child', action='store_true', dest='child', default=False, help='Internal.')
+    parser.add_option('--wakeup', type='float', action='store', dest='wakeup', default=60, help='Internal.')
+    parser.add_option('--wake-work', type='float', action='store', dest='wake_work', default=0, help='Internal.')
+    parser.add_option('--offload', action='store_true', dest='offload', default=False, help='Internal.')
+    executor.init_parser_options(parser)
+    (options, args) = parser.parse_args()
+
+    if options.child:
+        run_child(options)
+        sys.exit(0)
+
+    report = run_benchmarks(options)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if options.compare:
+        with open(options.compare) as f:
+            compare(json.load(f), report)
@@ -0,0 +1,453 @@
+from __future__ import unicode_literals, print_function
+import unittest
+import logging
+import threading
+import time
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+
+
+# Modify python path
+thisdir = os.path.dirname(os.path.abspath(__file__))
+srcdir = os.path.dirname(thisdir)
+sys.path.insert(0, srcdir)
+
+
+from mservice.log import BatchingLogHandler, LogRecordBuffer, ExceptionRateLimitedLogAdaptor, LogRateLimiter
+from mservice.log import RotatingFileLogHandler, RotatingFileSink, discard_inherited_records
+
+
+class StubSink(object):
+
+    def __init__(self, gate=None):
+        self.batches = []
+        self.records = []
+        self.closed = False
+        self.gate = gate
+
+    def __call__(self, records):
+        if self.gate is not None:
+            self.gate.wait()
+        self.records.extend(records)
+        self.batches.append([r.getMessage() for r in records])
+
+    def close(self):
+        self.closed = True
+
+
+def make_logger(name, handler):
+    logger = logging.getLogger('marbles.test.' + name)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.handlers = [handler]
+    return logger
+
+
+class BatchingLogHandlerTest(unittest.TestCase):
+
+    def test_BatchBySize(self):
+        sink = StubSink()
+        handler = BatchingLogHandler(sink, batch_size=10, max_age=60)
+        logger = make_logger('size', handler)
+        for i in range(25):
+            logger.info('msg %d', i)
+        handler.close(5)
+        self.assertEqual([10, 10, 5], [len(b) for b in sink.batches])
+        self.assertEqual('msg 0', sink.batches[0][0])
+        self.assertEqual('msg 24', sink.batches[2][-1])
+        self.assertTrue(sink.closed)
+        self.assertEqual(25, handler.stats()['written'])
+
+    def test_BatchByAge(self):
+        sink = StubSink()
+        handler = BatchingLogHandler(sink, batch_size=1000, max_age=0.05)
+        logger = make_logger('age', handler)
+        logger.info('one')
+        handler.flush(5)
+        self.assertEqual([['one']], sink.batches)
+        handler.close(5)
+
+    def test_DropOldest(self):
+        gate = threading.Event()
+        sink = StubSink(gate)
+        handler = BatchingLogHandler(sink, capacity=5, batch_size=1, max_age=0,
+                                     overflow=LogRecordBuffer.DROP_OLDEST)
+        logger = make_logger('drop', handler)
+        logger.info('first')
+        # Wait until the flusher holds 'first' so the queue contents are deterministic.
+        while len(handler.queue):
+            time.sleep(0.001)
+        for i in range(10):
+            logger.info('msg %d', i)
+        gate.set()
+        handler.close(5)
+        self.assertEqual(5, handler.dropped)
+        self.assertEqual(['first', 'msg 5', 'msg 6', 'msg 7', 'msg 8', 'msg 9'], [b[0] for b in sink.batches])
+
+    def test_ExceptionText(self):
+        sink = StubSink()
+        handler = BatchingLogHandler(sink, batch_size=1)
+        logger = make_logger('exc', handler)
+        try:
+            raise ValueError('bad')
+        except ValueError:
+            logger.exception('failed')
+        handler.close(5)
+        self.assertEqual([['failed']], sink.batches)
+        self.assertIsNone(sink.records[0].exc_info)
+        self.assertIn('ValueError: bad', sink.records[0].exc_text)
+
+    def test_Fork(self):
+        sink = StubSink()
+        handler = BatchingLogHandler(sink, batch_size=1000, max_age=60)
+        logger = make_logger('fork', handler)
+        logger.info('parent')
+        r, w = os.pipe()
+        for discard in (True, False):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    if discard:
+                        # A worker, the parent keeps running and writes its record.
+                        discard_inherited_records(logger)
+                    logger.info('child')
+                    handler.close(5)
+                    os.write(w, ('%s\n' % ','.join(m for b in sink.batches for m in b)).encode('utf-8'))
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+        os.close(w)
+        with os.fdopen(r) as f:
+            self.assertEqual(['child', 'parent,child'], f.read().splitlines())
+        handler.close(5)
+        self.assertEqual([['parent']], sink.batches)
+
+    def test_CloseWhileWriting(self):
+        gate = threading.Event()
+        sink = StubSink(gate)
+        handler = BatchingLogHandler(sink, max_age=0)
+        logger = make_logger('closing', handler)
+        logger.info('slow')
+        handler.close(0.05)
+        # The flusher is still writing, it closes the sink after its last write.
+        self.assertFalse(sink.closed)
+        gate.set()
+        handler._thread.join(5)
+        self.assertEqual([['slow']], sink.batches)
+        self.assertTrue(sink.closed)
+        # Without a flusher thread close() closes the sink.
+        sink = StubSink()
+        BatchingLogHandler(sink).close()
+        self.assertTrue(sink.closed)
+
+
+def make_records(n, size=50):
+    return [logging.makeLogRecord({'msg': '%03d %s' % (i, 'x' * size)}) for i in range(n)]
+
+
+class RotatingFileLogHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'svc.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def segments(self):
+        return sorted(n for n in os.listdir(self.dir) if n.startswith('svc.log.') and n != 'svc.log.lock')
+
+    def test_Handler(self):
+        handler = RotatingFileLogHandler(self.path)
+        handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        logger = make_logger('file', handler)
+        for i in range(100):
+            logger.info('msg %d', i)
+        try:
+            raise ValueError('bad')
+        except ValueError:
+            logger.exception('failed')
+        handler.close(5)
+        with open(self.path) as f:
+            text = f.read()
+        self.assertTrue(text.startswith('INFO msg 0\nINFO msg 1\n'))
+        self.assertIn('ERROR failed\nTraceback', text)
+        self.assertIn('ValueError: bad\n', text)
+        self.assertEqual(101, handler.stats()['written'])
+
+    def test_RotateBySize(self):
+        sink = RotatingFileSink(self.path, max_bytes=500, backup_count=2, compress=False)
+        for _ in range(5):
+            sink(make_records(5))
+        sink.close()
+        # Each batch is about 270 bytes so every batch after the first rotates.
+        self.assertEqual(4, sink.rotations)
+        segments = self.segments()
+        self.assertEqual(2, len(segments))
+        for name in segments + ['svc.log']:
+            self.assertLessEqual(os.path.getsize(os.path.join(self.dir, name)), 500)
+
+    def test_RotateByTime(self):
+        sink = RotatingFileSink(self.path, max_bytes=0, rotate_seconds=3600, compress=False)
+        sink(make_records(1))
+        sink._next_rotation = time.time() - 1
+        sink(make_records(1))
+        sink.close()
+        self.assertEqual(1, sink.rotations)
+        self.assertEqual(1, len(self.segments()))
+
+    def test_Compress(self):
+        sink = RotatingFileSink(self.path, max_bytes=100)
+        sink(make_records(2))
+        sink(make_records(2))
+        deadline = time.time() + 5
+        while not self.segments()[0].endswith('.gz') and time.time() < deadline:
+            time.sleep(0.01)
+        sink.close()
+        segment = self.segments()
+        self.assertEqual(1, len(segment))
+        with gzip.open(os.path.join(self.dir, segment[0])) as f:
+            self.assertTrue(f.read().decode('utf-8').startswith('000 x'))
+
+    def test_RotatedElsewhere(self):
+        sink = RotatingFileSink(self.path, compress=False)
+        sink(make_records(1))
+        # Another process sharing the file rotated it.
+        os.rename(self.path, self.path + '.20200101-000000')
+        sink(make_records(1))
+        sink.close()
+        with open(self.path) as f:
+            self.assertEqual(1, len(f.read().splitlines()))
+
+    def test_Fork(self):
+        sink = RotatingFileSink(self.path, compress=False)
+        sink(make_records(1))
+        # Bytes the parent's flusher was writing when it forked.
+        sink._file.write(b'parent\n')
+        inherited = sink._file
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                sink(make_records(1))
+                code = 0 if sink._file is not inherited and sink._pid == os.getpid() else 2
+                sink.close()
+            finally:
+                os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, status)
+        sink._file.flush()
+        sink(make_records(1))
+        sink.close()
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(4, len(lines))
+        self.assertEqual(1, lines.count('parent'))
+
+    def test_ForkDescriptorReused(self):
+        sink = RotatingFileSink(self.path, compress=False)
+        sink(make_records(1))
+        fd = sink._file.fileno()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                # Daemonizing closed the inherited descriptor, and the number was reused.
+                os.close(fd)
+                other = os.open(os.path.join(self.dir, 'other'), os.O_WRONLY | os.O_CREAT)
+                sink(make_records(1))
+                os.write(other, b'other\n')
+                code = 0 if other == fd else 2
+                sink.close()
+            finally:
+                os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, status)
+        sink.close()
+        with open(os.path.join(self.dir, 'other')) as f:
+            self.assertEqual('other\n', f.read())
+        with open(self.path) as f:
+            self.assertEqual(2, len(f.read().splitlines()))
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class ExceptionRateLimitedLogAdaptorTest(unittest.TestCase):
+
+    def raise_and_log(self, adaptor, exc_class=ValueError, **kwargs):
+        try:
+            raise exc_class('bad')
+        except Exception as e:
+            adaptor.exception('failed', exc_info=e, **kwargs)
+
+    def test_RateLimit(self):
+        handler = ListHandler()
+        adaptor = ExceptionRateLimitedLogAdaptor(make_logger('rlimit', handler), rlimit=60)
+        for i in range(100):
+            self.raise_and_log(adaptor)
+        self.raise_and_log(adaptor, KeyError)
+        self.raise_and_log(adaptor, rlimitby='other')
+        self.assertEqual(3, len(handler.records))
+        self.assertEqual(99, adaptor.suppressed)
+
+    def test_SuppressedCount(self):
+        handler = ListHandler()
+        adaptor = ExceptionRateLimitedLogAdaptor(make_logger('count', handler), rlimit=0.05)
+        for i in range(10):
+            self.raise_and_log(adaptor)
+        time.sleep(0.06)
+        self.raise_and_log(adaptor)
+        self.assertEqual(2, len(handler.records))
+        self.assertEqual('failed (9 similar suppressed)', handler.records[1].getMessage())
+
+    def test_QuietSourceSummary(self):
+        handler = ListHandler()
+        adaptor = ExceptionRateLimitedLogAdaptor(make_logger('quiet', handler), rlimit=0.05, summary_interval=0.05)
+        for i in range(5):
+            self.raise_and_log(adaptor)
+        # Reported by the summary once the window expired, the source never logs again.
+        adaptor.log_summary()
+        self.assertEqual(1, len(handler.records))
+        time.sleep(0.06)
+        adaptor.log_summary()
+        self.assertEqual(2, len(handler.records))
+        self.assertTrue(handler.records[1].getMessage().startswith(
+            'Exception rate limit suppressed 4 exceptions from 1 sources: ValueError log_test.py:'))
+        time.sleep(0.06)
+        adaptor.log_summary()
+        self.raise_and_log(adaptor)
+        self.assertEqual('failed', handler.records[2].getMessage())
+        # Pending counts are reported on shutdown.
+        self.raise_and_log(adaptor)
+        adaptor.log_summary(force=True)
+        self.assertIn('suppressed 1 exceptions', handler.records[3].getMessage())
+
+    def test_Threads(self):
+        adaptor = ExceptionRateLimitedLogAdaptor(make_logger('threads', ListHandler()), rlimit=1e-9,
+                                                 max_sources=20, summary_interval=0)
+        errors = []
+
+        def log(n):
+            try:
+                for i in range(5000):
+                    adaptor._suppress((ValueError, 'f', i % 50, n))
+                    if i % 100 == 0:
+                        adaptor.log_summary(force=True)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=log, args=(n % 2,)) for n in range(8)]
+        # Switch threads often so they interleave inside the cache updates.
+        if hasattr(sys, 'setswitchinterval'):
+            interval = sys.getswitchinterval()
+            sys.setswitchinterval(1e-6)
+        else:
+            interval = sys.getcheckinterval()
+            sys.setcheckinterval(1)
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            if hasattr(sys, 'setswitchinterval'):
+                sys.setswitchinterval(interval)
+            else:
+                sys.setcheckinterval(interval)
+        self.assertEqual([], errors)
+        self.assertLessEqual(len(adaptor.error_cache), 20)
+
+    def test_CallerAttribution(self):
+        handler = ListHandler()
+        logger = make_logger('caller', handler)
+        adaptors = [ExceptionRateLimitedLogAdaptor(logger, rlimit=60),
+                    ExceptionRateLimitedLogAdaptor(logger, limiter=LogRateLimiter(rate=100))]
+        lines = []
+        for adaptor in adaptors:
+            adaptor.info('info')
+            lines.append(sys._getframe().f_lineno - 1)
+            adaptor.log(logging.WARNING, 'log')
+            lines.append(sys._getframe().f_lineno - 1)
+            self.raise_and_log(adaptor, rlimitby=str(len(lines)))
+            lines.append(self.raise_and_log.__code__.co_firstlineno + 4)
+        if sys.version_info < (3, 8):
+            return
+        self.assertEqual(lines, [r.lineno for r in handler.records])
+        self.assertEqual(['test_CallerAttribution', 'test_CallerAttribution', 'raise_and_log'] * 2,
+                         [r.funcName for r in handler.records])
+        for record in handler.records:
+            self.assertEqual(os.path.splitext(__file__)[0], os.path.splitext(record.pathname)[0])
+
+    def test_MaxSources(self):
+        handler = ListHandler()
+        adaptor = ExceptionRateLimitedLogAdaptor(make_logger('lru', handler), rlimit=60, max_sources=8)
+        for i in range(100):
+            self.raise_and_log(adaptor, rlimitby=str(i))
+        self.assertEqual(100, len(handler.records))
+        self.assertEqual(8, len(adaptor.error_cache))
+
+    def test_CallerWithoutException(self):
+        handler = ListHandler()
+        adaptor = ExceptionRateLimitedLogAdaptor(make_logger('nocaller', handler), rlimit=60)
+        for i in range(3):
+            adaptor.exception('no exception')
+        self.assertEqual(1, len(handler.records))
+        key = next(iter(adaptor.error_cache))
+        self.assertEqual(os.path.splitext(__file__)[0], os.path.splitext(key[1])[0])
+
+
+class LogRateLimiterTest(unittest.TestCase):
+
+    def test_PerSourceBudget(self):
+        handler = ListHandler()
+        limiter = LogRateLimiter(rate=0.001, burst=3, summary_interval=3600)
+        adaptor = ExceptionRateLimitedLogAdaptor(make_logger('bucket', handler), limiter=limiter)
+        for i in range(10):
+            adaptor.warning('hot %d', i)
+        for i in range(10):
+            adaptor.info('other %d', i)
+        self.assertEqual(['hot 0', 'hot 1', 'hot 2', 'other 0', 'other 1', 'other 2'],
+                         [r.getMessage() for r in handler.records])
+        self.assertEqual(14, limiter.suppressed)
+
+    def test_GlobalCeiling(self):
+        handler = ListHandler()
+        limiter = LogRateLimiter(global_rate=0.001, global_burst=5, summary_interval=3600)
+        adaptor = ExceptionRateLimitedLogAdaptor(make_logger('global', handler), limiter=limiter)
+        for i in range(10):
+            adaptor.info('a')
+            adaptor.debug('b')
+        self.assertEqual(5, len(handler.records))
+
+    def test_Summary(self):
+        handler = ListHandler()
+        limiter = LogRateLimiter(rate=0.001, burst=1, summary_interval=0.05)
+        adaptor = ExceptionRateLimitedLogAdaptor(make_logger('summary', handler), limiter=limiter)
+
+        def hot():
+            adaptor.info('hot')
+
+        for i in range(5):
+            hot()
+        time.sleep(0.06)
+        adaptor.info('trigger')
+        self.assertEqual(['hot', 'trigger'], [r.getMessage() for r in handler.records if r.levelno == logging.INFO])
+        self.assertTrue(handler.records[1].getMessage().startswith('Log rate limit suppressed 4 records'))
+        hot()
+        adaptor.log_summary(force=True)
+        self.assertEqual(4, len(handler.records))
+        self.assertTrue(handler.records[3].getMessage().startswith('Log rate limit suppressed 1 records'))
+
+
+if __name__ == '__main__':
+    unittest.main()
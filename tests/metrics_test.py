@@ -0,0 +1,100 @@
+from __future__ import unicode_literals, print_function
+import unittest
+import os
+import sys
+import tempfile
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+
+# Modify python path
+thisdir = os.path.dirname(os.path.abspath(__file__))
+srcdir = os.path.dirname(thisdir)
+sys.path.insert(0, srcdir)
+
+
+from mservice.metrics import MetricsRegistry, MetricsExporter
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_Histogram(self):
+        registry = MetricsRegistry()
+        hist = registry.histogram('latency_seconds')
+        for i in range(1, 1001):
+            hist.record(i / 1000.0)
+        self.assertEqual(1000, hist.count)
+        self.assertAlmostEqual(500.5, hist.sum)
+        self.assertEqual(1.0, hist.max)
+        # Relative error is bounded by 1/sub_buckets.
+        self.assertAlmostEqual(0.5, hist.quantile(0.5), delta=0.5 / 16)
+        self.assertAlmostEqual(0.99, hist.quantile(0.99), delta=0.99 / 16)
+        self.assertAlmostEqual(500, hist.count_above(0.5), delta=500 / 16)
+        self.assertEqual(0, hist.count_above(2.0))
+        hist.record(0)
+        hist.record(1e9)
+        self.assertEqual(1e9, hist.max)
+
+    def test_SameMetric(self):
+        registry = MetricsRegistry()
+        self.assertIs(registry.counter('a', labels={'x': 1}), registry.counter('a', labels={'x': 1}))
+        self.assertIsNot(registry.counter('a', labels={'x': 1}), registry.counter('a', labels={'x': 2}))
+        self.assertRaises(TypeError, registry.gauge, 'a', labels={'x': 1})
+
+    def test_Prometheus(self):
+        registry = MetricsRegistry()
+        registry.counter('requests_total', 'Requests', labels={'op': 'get'}).inc(3)
+        registry.gauge('queued', fn=lambda: 7)
+
+        @registry.timed('call_seconds')
+        def call():
+            return 1
+
+        self.assertEqual(1, call())
+        with registry.timer('block_seconds'):
+            pass
+        text = registry.to_prometheus()
+        self.assertIn('# HELP requests_total Requests\n', text)
+        self.assertIn('# TYPE requests_total counter\n', text)
+        self.assertIn('requests_total{op="get"} 3\n', text)
+        self.assertIn('queued 7\n', text)
+        self.assertIn('call_seconds_count 1\n', text)
+        self.assertIn('block_seconds{quantile="0.99"}', text)
+
+    def test_Families(self):
+        registry = MetricsRegistry()
+        for op in ('get', 'put'):
+            registry.histogram('op_seconds', 'Operations', labels={'op': op}).record(0.5)
+        dropped = [4]
+        registry.counter('dropped_total', 'Dropped', fn=lambda: dropped[0])
+        text = registry.to_prometheus()
+        # One TYPE line per family, the max is a gauge family of its own.
+        self.assertEqual(1, text.count('# TYPE op_seconds summary\n'))
+        self.assertIn('# TYPE op_seconds_max gauge\nop_seconds_max{op="get"} 0.5\nop_seconds_max{op="put"} 0.5\n',
+                      text)
+        summary = text[text.index('# TYPE op_seconds summary'):text.index('# HELP op_seconds_max')]
+        self.assertNotIn('_max', summary)
+        self.assertIn('op_seconds_count{op="put"} 1\n', summary)
+        self.assertIn('# TYPE dropped_total counter\ndropped_total 4\n', text)
+        dropped[0] = 6
+        self.assertIn(('dropped_total', (), 6), registry.snapshot())
+
+    def test_Exporter(self):
+        registry = MetricsRegistry()
+        registry.counter('hits_total').inc()
+        path = os.path.join(tempfile.mkdtemp(), 'metrics.prom')
+        exporter = MetricsExporter(registry, port=0, host='127.0.0.1', path=path, interval=3600)
+        exporter.start()
+        try:
+            body = urlopen('http://127.0.0.1:%d/metrics' % exporter.port).read().decode('utf-8')
+            self.assertIn('hits_total 1\n', body)
+        finally:
+            exporter.stop()
+        with open(path) as f:
+            self.assertIn('hits_total 1\n', f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
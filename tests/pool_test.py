@@ -0,0 +1,102 @@
+from __future__ import unicode_literals, print_function
+import unittest
+import os
+import sys
+import gc
+import time
+
+
+# Modify python path
+thisdir = os.path.dirname(os.path.abspath(__file__))
+srcdir = os.path.dirname(thisdir)
+sys.path.insert(0, srcdir)
+
+
+from mservice.grpc_core.pool import ChannelPool
+
+
+class FakeChannel(object):
+    """Stands in for grpc.Channel, which is closed when garbage collected."""
+    released = []
+
+    def __init__(self, target, options, compression):
+        self.target = target
+        self.options = options
+        self.compression = compression
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def __del__(self):
+        FakeChannel.released.append(self.target)
+
+
+class FakeChannelPool(ChannelPool):
+
+    def _create(self, target, options, compression):
+        return FakeChannel(target, options, compression)
+
+
+class ChannelPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        del FakeChannel.released[:]
+
+    def test_Reuse(self):
+        pool = FakeChannelPool(keepalive_time_ms=1000)
+        channel = pool.get('localhost', 5000)
+        self.assertIs(channel, pool.get('localhost', 5000))
+        self.assertIn(('grpc.keepalive_time_ms', 1000), channel.options)
+        self.assertIsNot(channel, pool.get('localhost', 5001))
+        self.assertIsNot(channel, pool.get('localhost', 5000, options=[('grpc.primary_user_agent', 'x')]))
+        self.assertIsNot(channel, pool.get('localhost', 5000, compression=1))
+        self.assertEqual(4, len(pool))
+
+    def test_RoundRobin(self):
+        pool = FakeChannelPool(size=3)
+        channels = [pool.get('localhost', 5000) for _ in range(6)]
+        self.assertEqual(3, len(set(id(c) for c in channels)))
+        self.assertEqual(channels[:3], channels[3:])
+        self.assertIn(('grpc.use_local_subchannel_pool', 1), channels[0].options)
+
+    def test_Eviction(self):
+        pool = FakeChannelPool(idle_timeout=0.05)
+        held = pool.get('localhost', 5000)
+        pool.get('localhost', 5001)
+        time.sleep(0.06)
+        pool.get('localhost', 5002)
+        gc.collect()
+        self.assertEqual(1, len(pool))
+        # The channel a stub still holds stays open, the unreferenced one is released.
+        self.assertFalse(held.closed)
+        self.assertEqual(['localhost:5001'], FakeChannel.released)
+        # A dropped target gets a new channel.
+        self.assertIsNot(held, pool.get('localhost', 5000))
+        pool.close()
+        self.assertTrue(held.closed)
+
+    def test_NoEviction(self):
+        pool = FakeChannelPool(idle_timeout=None)
+        channel = pool.get('localhost', 5000)
+        pool.evict_idle()
+        self.assertIs(channel, pool.get('localhost', 5000))
+
+    def test_LazyExport(self):
+        from mservice import grpc_core
+        self.assertIs(ChannelPool, grpc_core.ChannelPool)
+        self.assertIn('ChannelPool', dir(grpc_core))
+        self.assertRaises(AttributeError, getattr, grpc_core, 'Missing')
+
+    def test_Close(self):
+        pool = FakeChannelPool(size=2)
+        channels = [pool.get('localhost', 5000), pool.get('localhost', 5000), pool.get('localhost', 5001)]
+        pool.close()
+        self.assertEqual(0, len(pool))
+        self.assertEqual([True] * 3, [c.closed for c in channels])
+        # Still usable.
+        self.assertNotIn(pool.get('localhost', 5000), channels)
+
+
+if __name__ == '__main__':
+    unittest.main()
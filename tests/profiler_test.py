@@ -0,0 +1,117 @@
+from __future__ import unicode_literals, print_function
+import unittest
+import os
+import sys
+import time
+import shutil
+import signal
+import tempfile
+import threading
+
+
+# Modify python path
+thisdir = os.path.dirname(os.path.abspath(__file__))
+srcdir = os.path.dirname(thisdir)
+sys.path.insert(0, srcdir)
+
+
+from mservice.profiler import format_stacks, SamplingProfiler, Diagnostics
+from mservice import executor
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def wait_for(test, timeout=5.0):
+    deadline = time.time() + timeout
+    while not test() and time.time() < deadline:
+        time.sleep(0.01)
+    return test()
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rundir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.rundir)
+
+    def test_FormatStacks(self):
+        stacks = format_stacks()
+        self.assertIn('MainThread', stacks)
+        self.assertIn('test_FormatStacks', stacks)
+
+    def test_SamplingProfiler(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=busy_loop, args=(stop,), name='busy worker')
+        thread.start()
+        path = os.path.join(self.rundir, 'out.folded')
+        try:
+            profiler = SamplingProfiler(path, duration=0.3, interval=0.005).start()
+            profiler._thread.join(5)
+        finally:
+            stop.set()
+            thread.join()
+        self.assertFalse(profiler.running)
+        self.assertGreater(profiler.samples, 10)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        busy = [l for l in lines if l.startswith('busy_worker;')]
+        self.assertTrue(busy)
+        stack, count = busy[0].rsplit(' ', 1)
+        self.assertIn('profiler_test:busy_loop', stack)
+        self.assertGreater(int(count), 0)
+        self.assertFalse([l for l in lines if l.startswith('mservice-profiler;')])
+
+    def test_SignalHandlers(self):
+        diagnostics = executor.diagnostics
+        diagnostics.configure(rundir=self.rundir, name='test', profile_seconds=0.2, profile_interval=0.01)
+        diagnostics.start()
+        prev = [signal.signal(signal.SIGUSR1, executor.usr1_handler),
+                signal.signal(signal.SIGUSR2, executor.usr2_handler)]
+        try:
+            os.kill(os.getpid(), signal.SIGUSR1)
+            stacks = os.path.join(self.rundir, 'test-%d.stacks' % os.getpid())
+            self.assertTrue(wait_for(lambda: os.path.exists(stacks)))
+            os.kill(os.getpid(), signal.SIGUSR2)
+            self.assertTrue(wait_for(lambda: diagnostics.profiler is not None))
+            diagnostics.profiler._thread.join(5)
+            self.assertTrue(os.path.exists(diagnostics.profiler.path))
+            self.assertTrue(diagnostics.profiler.path.endswith('.folded'))
+        finally:
+            signal.signal(signal.SIGUSR1, prev[0])
+            signal.signal(signal.SIGUSR2, prev[1])
+        with open(stacks) as f:
+            self.assertIn('test_SignalHandlers', f.read())
+
+    def test_Fork(self):
+        diagnostics = Diagnostics()
+        diagnostics.configure(rundir=self.rundir, name='test')
+        diagnostics.start()
+        pipe = (diagnostics._rfd, diagnostics._wfd)
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                # The parent's thread is not running here, the child gets its own pipe and thread.
+                diagnostics.start()
+                if (diagnostics._rfd, diagnostics._wfd) == pipe:
+                    code = 2
+                else:
+                    diagnostics.request_dump()
+                    path = os.path.join(self.rundir, 'test-%d.stacks' % os.getpid())
+                    code = 0 if wait_for(lambda: os.path.exists(path)) else 3
+            finally:
+                os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, status)
+        # The parent still serves requests.
+        diagnostics.request_dump()
+        self.assertTrue(wait_for(lambda: os.path.exists(os.path.join(self.rundir, 'test-%d.stacks' % os.getpid()))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,307 @@
+from __future__ import unicode_literals, print_function
+import unittest
+import os
+import sys
+import time
+import threading
+import collections
+try:
+    import grpc
+except ImportError:
+    grpc = None
+
+
+# Modify python path
+thisdir = os.path.dirname(os.path.abspath(__file__))
+srcdir = os.path.dirname(thisdir)
+sys.path.insert(0, srcdir)
+
+
+from mservice.grpc_core.resilience import AIMDLimit, GradientLimit, CircuitBreaker, ResiliencePolicy, \
+    CallRejected
+from mservice.metrics import MetricsRegistry
+
+
+CallDetails = collections.namedtuple('CallDetails', ['method', 'timeout', 'metadata', 'credentials',
+                                                     'wait_for_ready', 'compression'])
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class FakeCall(object):
+    """A pending unary call. Like a grpc future, a callback added once it is done runs at once."""
+
+    def __init__(self):
+        self._code = None
+        self._cancelled = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if self._code is None:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def finish(self, code, cancelled=False):
+        with self._lock:
+            if self._code is not None:
+                return False
+            self._code = code
+            self._cancelled = cancelled
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+        return True
+
+    def cancel(self):
+        return self.finish(grpc.StatusCode.CANCELLED, cancelled=True)
+
+    def cancelled(self):
+        return self._cancelled
+
+    def done(self):
+        return self._code is not None
+
+    def code(self):
+        return self._code
+
+
+class ResilienceTest(unittest.TestCase):
+
+    def test_AIMDLimit(self):
+        limit = AIMDLimit(initial=10, min_limit=2, max_limit=12)
+        limit.update(0.01, 2, False)
+        self.assertEqual(10, limit.limit)
+        limit.update(0.01, 5, False)
+        self.assertEqual(11, limit.limit)
+        for _ in range(5):
+            limit.update(0.01, 11, False)
+        self.assertEqual(12, limit.limit)
+        limit.update(1.0, 12, True)
+        self.assertAlmostEqual(12 * 0.9, limit.limit)
+        for _ in range(50):
+            limit.update(1.0, 12, True)
+        self.assertEqual(2, limit.limit)
+
+    def test_GradientLimit(self):
+        limit = GradientLimit(initial=20, max_limit=100)
+        for _ in range(50):
+            limit.update(0.01, 20, False)
+        grown = limit.limit
+        self.assertGreater(grown, 20)
+        for _ in range(50):
+            limit.update(0.1, int(limit.limit), False)
+        self.assertLess(limit.limit, grown)
+
+    def test_CircuitBreaker(self):
+        breaker = CircuitBreaker(failure_ratio=0.5, window=10, min_calls=4, open_seconds=5, probes=1)
+        for _ in range(3):
+            self.assertTrue(breaker.allow(0))
+            breaker.record(True, 0)
+        self.assertEqual(CircuitBreaker.CLOSED, breaker.state)
+        breaker.record(True, 1)
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+        self.assertFalse(breaker.allow(2))
+        # Half open admits one probe.
+        self.assertTrue(breaker.allow(6))
+        self.assertEqual(CircuitBreaker.HALF_OPEN, breaker.state)
+        self.assertFalse(breaker.allow(6))
+        breaker.record(True, 6)
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+        self.assertTrue(breaker.allow(12))
+        breaker.record(False, 12)
+        self.assertEqual(CircuitBreaker.CLOSED, breaker.state)
+        self.assertTrue(breaker.allow(12))
+
+    def test_GuardLimit(self):
+        registry = MetricsRegistry()
+        policy = ResiliencePolicy(initial_limit=2, min_limit=1, breaker=False, registry=registry)
+        guard = policy.guard('localhost:50051')
+        self.assertIs(guard, policy.guard('localhost:50051'))
+        a = guard.acquire()
+        b = guard.acquire()
+        with self.assertRaises(CallRejected) as cm:
+            guard.acquire()
+        self.assertEqual(CallRejected.LIMIT, cm.exception.reason)
+        self.assertEqual(1, guard.rejected_limit.value)
+        guard.release(a, failed=True, overload=True)
+        guard.release(b, sample=False)
+        self.assertEqual(0, guard.inflight)
+        self.assertEqual(1, int(guard.limit.limit))
+        self.assertEqual(1, guard.latency.count)
+
+    def test_GuardProbe(self):
+        policy = ResiliencePolicy(window=4, min_calls=2, open_seconds=0, probes=2, registry=MetricsRegistry())
+        guard = policy.guard('localhost:50051')
+        for _ in range(2):
+            guard.release(guard.acquire(), failed=True)
+        self.assertEqual(CircuitBreaker.OPEN, guard.breaker.state)
+        guard.limit.limit = 1
+        held = guard.acquire()
+        self.assertEqual(CircuitBreaker.HALF_OPEN, guard.breaker.state)
+        # Rejected by the limit, the probe is given back.
+        with self.assertRaises(CallRejected) as cm:
+            guard.acquire()
+        self.assertEqual(CallRejected.LIMIT, cm.exception.reason)
+        guard.release(held)
+        guard.release(guard.acquire())
+        self.assertEqual(CircuitBreaker.CLOSED, guard.breaker.state)
+
+    def test_GuardCancelledProbe(self):
+        policy = ResiliencePolicy(limit=None, window=4, min_calls=2, open_seconds=0, registry=MetricsRegistry())
+        guard = policy.guard('localhost:50051')
+        for _ in range(2):
+            guard.release(guard.acquire(), failed=True)
+        probe = guard.acquire()
+        with self.assertRaises(CallRejected):
+            guard.acquire()
+        # A cancelled probe says nothing about the target, another one is sent.
+        guard.release(probe, sample=False)
+        self.assertEqual(CircuitBreaker.HALF_OPEN, guard.breaker.state)
+        guard.release(guard.acquire())
+        self.assertEqual(CircuitBreaker.CLOSED, guard.breaker.state)
+
+    def test_GuardBreaker(self):
+        policy = ResiliencePolicy(limit=None, window=4, min_calls=2, open_seconds=60, registry=MetricsRegistry())
+        guard = policy.guard('localhost:50051')
+        for _ in range(2):
+            guard.release(guard.acquire(), failed=True)
+        with self.assertRaises(CallRejected) as cm:
+            guard.acquire()
+        self.assertEqual(CallRejected.CIRCUIT_OPEN, cm.exception.reason)
+        self.assertEqual(1, guard.rejected_open.value)
+
+    def test_HedgeDelay(self):
+        policy = ResiliencePolicy(registry=MetricsRegistry())
+        guard = policy.guard('localhost:50051')
+        self.assertIsNone(policy.hedge_after(guard))
+        for _ in range(100):
+            guard.latency.record(0.01)
+        self.assertAlmostEqual(0.01, policy.hedge_after(guard), delta=0.001)
+        self.assertEqual(0.2, ResiliencePolicy(hedge_delay=0.2, registry=MetricsRegistry()).hedge_after(guard))
+
+
+@unittest.skipUnless(grpc, 'grpc is not installed')
+class ResilienceInterceptorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = ResiliencePolicy(hedge_methods=('/test.Echo/Echo',), hedge_delay=0.01,
+                                       registry=MetricsRegistry())
+        self.interceptor = self.policy.interceptor('localhost:50051')
+        self.guard = self.interceptor.guard
+        self.calls = []
+
+    def continuation(self, details, request):
+        call = FakeCall()
+        self.calls.append(call)
+        return call
+
+    def intercept(self, continuation, method='/test.Echo/Echo'):
+        details = CallDetails(method, None, None, None, None, None)
+        return self.interceptor.intercept_unary_unary(continuation, details, b'ping')
+
+    def test_Release(self):
+        call = self.intercept(self.continuation, '/test.Echo/Other')
+        self.assertEqual(1, self.guard.inflight)
+        call.finish(grpc.StatusCode.OK)
+        self.assertEqual(0, self.guard.inflight)
+        self.assertEqual(1, self.guard.latency.count)
+        # A call cancelled by the caller releases its slot without a sample.
+        call = self.intercept(self.continuation, '/test.Echo/Other')
+        call.cancel()
+        self.assertEqual(0, self.guard.inflight)
+        self.assertEqual(1, self.guard.latency.count)
+        self.assertEqual(0, self.guard.hedged.value)
+
+    def hedged_continuation(self):
+        # A continuation for future() calls, with an Event set once the hedge is sent.
+        sent = threading.Event()
+
+        def continuation(details, request):
+            call = self.continuation(details, request)
+            if len(self.calls) == 2:
+                sent.set()
+            return call
+        return continuation, sent
+
+    def test_Hedge(self):
+        continuation, sent = self.hedged_continuation()
+        call = self.intercept(continuation)
+        # The caller is not blocked while the hedge is pending.
+        self.assertFalse(call.done())
+        self.assertTrue(sent.wait(5))
+        self.calls[1].finish(grpc.StatusCode.OK)
+        self.assertEqual(grpc.StatusCode.OK, call.code())
+        self.assertTrue(call.done())
+        self.assertTrue(self.calls[0].cancelled())
+        self.assertFalse(call.cancelled())
+        self.assertEqual(1, self.guard.hedged.value)
+        # The loser is released without a sample.
+        self.assertEqual(0, self.guard.inflight)
+        self.assertEqual(1, self.guard.latency.count)
+
+    def test_HedgeRace(self):
+        # The first call completes while the hedge is sent.
+        def continuation(details, request):
+            call = self.continuation(details, request)
+            if len(self.calls) == 2:
+                self.calls[0].finish(grpc.StatusCode.OK)
+            return call
+        call = self.intercept(continuation)
+        self.assertEqual(grpc.StatusCode.OK, call.code())
+        self.assertTrue(wait_for(lambda: len(self.calls) == 2 and self.calls[1].cancelled()))
+        self.assertFalse(self.calls[0].cancelled())
+        self.assertEqual(0, self.guard.inflight)
+        self.assertEqual(1, self.guard.latency.count)
+
+    def test_HedgeRejected(self):
+        # No hedge above the limit, the call completes with the first attempt.
+        self.guard.limit.limit = 1
+        call = self.intercept(self.continuation)
+        time.sleep(0.05)
+        self.assertEqual(1, len(self.calls))
+        self.assertFalse(call.done())
+        self.calls[0].finish(grpc.StatusCode.OK)
+        self.assertEqual(grpc.StatusCode.OK, call.code())
+        self.assertEqual(0, self.guard.hedged.value)
+        self.assertEqual(0, self.guard.inflight)
+
+    def test_HedgeBlocking(self):
+        # A blocking call returns from the continuation completed, it is not hedged.
+        def continuation(details, request):
+            time.sleep(0.05)
+            call = self.continuation(details, request)
+            call.finish(grpc.StatusCode.OK)
+            return call
+        call = self.intercept(continuation)
+        self.assertIs(self.calls[0], call)
+        time.sleep(0.05)
+        self.assertEqual(1, len(self.calls))
+        self.assertEqual(0, self.guard.hedged.value)
+        self.assertEqual(0, self.guard.inflight)
+        self.assertEqual(1, self.guard.latency.count)
+
+    def test_HedgeCancel(self):
+        continuation, sent = self.hedged_continuation()
+        call = self.intercept(continuation)
+        self.assertTrue(sent.wait(5))
+        done = []
+        call.add_done_callback(done.append)
+        self.assertTrue(call.cancel())
+        self.assertEqual([call], done)
+        self.assertTrue(call.cancelled())
+        self.assertTrue(all(attempt.cancelled() for attempt in self.calls))
+        self.assertEqual(0, self.guard.inflight)
+        self.assertEqual(0, self.guard.latency.count)
+
+if __name__ == '__main__':
+    unittest.main()
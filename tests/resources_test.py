@@ -0,0 +1,123 @@
+from __future__ import unicode_literals, print_function
+import unittest
+import os
+import sys
+import shutil
+import struct
+import tempfile
+
+
+# Modify python path
+thisdir = os.path.dirname(os.path.abspath(__file__))
+srcdir = os.path.dirname(thisdir)
+sys.path.insert(0, srcdir)
+
+
+from mservice.resources import ResourceStore
+from mservice.metrics import MetricsRegistry
+from mservice.executor import ServiceExecutor
+
+
+class ResourcesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.builds = []
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def build(self, f):
+        self.builds.append(os.getpid())
+        f.write(struct.pack('<4I', 1, 2, 3, 4))
+
+    def store(self, version=None):
+        store = ResourceStore(self.root, registry=MetricsRegistry())
+        store.register('table', self.build, version)
+        return store
+
+    def test_BuildOnce(self):
+        store = self.store()
+        resource = store.get('table')
+        self.assertIs(resource, store.get('table'))
+        self.assertEqual(16, len(resource))
+        self.assertEqual((1, 2, 3, 4), struct.unpack_from('<4I', resource.buffer))
+        self.assertTrue(resource.buffer.readonly)
+        # A restart maps the file without building.
+        again = self.store().get('table')
+        self.assertEqual(bytes(resource.buffer), bytes(again.buffer))
+        self.assertEqual(1, len(self.builds))
+        store.close()
+
+    def test_ReturnedData(self):
+        store = ResourceStore(self.root, registry=MetricsRegistry())
+        store.register('blob', lambda f: b'abc')
+        store.register('empty', lambda f: None)
+        self.assertEqual(b'abc', bytes(store.get('blob').buffer))
+        self.assertEqual(0, len(store.get('empty')))
+        self.assertRaises(KeyError, store.get, 'missing')
+        self.assertRaises(ValueError, store.register, '../x', lambda f: None)
+
+    def test_Reload(self):
+        version = ['1']
+        store = self.store(lambda: version[0])
+        first = store.get('table')
+        self.assertIsNone(store.prepare())
+        version[0] = '2'
+        prepared = store.prepare()
+        self.assertEqual(['table'], list(prepared))
+        # The current version stays in service until commit.
+        self.assertIs(first, store.get('table'))
+        old = store.commit(prepared)
+        self.assertEqual([first], old)
+        self.assertEqual('2', store.get('table').version)
+        store.release(old)
+        self.assertEqual(2, len(self.builds))
+        version[0] = '3'
+        store.commit(store.prepare())
+        files = sorted(os.listdir(os.path.join(self.root, 'table')))
+        self.assertEqual(['.lock', '2.bin', '3.bin'], files)
+
+    def test_Rollback(self):
+        version = ['1']
+        svc = ServiceExecutor(1.0)
+        svc._resources = store = self.store(lambda: version[0])
+        first = store.get('table')
+        version[0] = '2'
+        prepared = svc.prepare_reload()
+        svc.rollback_reload(None, prepared)
+        # The prepared version is unmapped, the current one stays in service.
+        self.assertRaises(ValueError, bytes, prepared['table'].buffer)
+        self.assertIs(first, store.get('table'))
+        self.assertEqual(16, len(bytes(first.buffer)))
+        svc.rollback_reload(RuntimeError('prepare failed'), None)
+        store.close()
+
+    def test_ForkedWorkers(self):
+        pids = []
+        for _ in range(4):
+            pid = os.fork()
+            if pid == 0:
+                code = 1
+                try:
+                    store = ResourceStore(self.root, registry=MetricsRegistry())
+                    marker = os.path.join(self.root, 'built.%d' % os.getpid())
+
+                    def build(f):
+                        open(marker, 'w').close()
+                        f.write(b'x' * 4096)
+
+                    store.register('shared', build)
+                    code = 0 if len(store.get('shared')) == 4096 else 1
+                finally:
+                    os._exit(code)
+            pids.append(pid)
+        for pid in pids:
+            _, status = os.waitpid(pid, 0)
+            self.assertEqual(0, status)
+        built = [f for f in os.listdir(self.root) if f.startswith('built.')]
+        self.assertEqual(1, len(built))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+from __future__ import unicode_literals, print_function
+import unittest
+import os
+import sys
+import time
+import logging
+import threading
+try:
+    import grpc
+except ImportError:
+    grpc = None
+
+
+# Modify python path
+thisdir = os.path.dirname(os.path.abspath(__file__))
+srcdir = os.path.dirname(thisdir)
+sys.path.insert(0, srcdir)
+
+
+def make_executor(use_aio):
+    from mservice.grpc_core.server import GrpcServiceExecutor
+
+    class EchoExecutor(GrpcServiceExecutor):
+        """Serves /test.Echo/Echo, which returns the request bytes after `delay` seconds."""
+
+        def __init__(self):
+            super(EchoExecutor, self).__init__(1.0, logging.getLogger('test'), port=0, host='127.0.0.1',
+                                               grace=5.0, use_aio=use_aio)
+            self.delay = 0
+            self.started = threading.Event()
+            self.terms = []
+
+        def echo(self, request, context):
+            self.started.set()
+            time.sleep(self.delay)
+            return request
+
+        def add_servicers(self, server):
+            handler = grpc.unary_unary_rpc_method_handler(self.echo)
+            server.add_generic_rpc_handlers((grpc.method_handlers_generic_handler('test.Echo', {'Echo': handler}),))
+
+        def on_term(self, graceful):
+            # The server is drained before on_term().
+            self.terms.append(self.server)
+
+    return EchoExecutor()
+
+
+@unittest.skipUnless(grpc, 'grpc is not installed')
+class GrpcServiceExecutorTest(unittest.TestCase):
+
+    def serve(self, use_aio):
+        svc = make_executor(use_aio)
+        svc._start('.')
+        self.assertGreater(svc.bound_port, 0)
+        channel = grpc.insecure_channel('127.0.0.1:%d' % svc.bound_port)
+        try:
+            echo = channel.unary_unary('/test.Echo/Echo')
+            self.assertEqual(b'ping', echo(b'ping', timeout=5))
+            # An RPC in flight when TERM arrives completes within the grace period.
+            svc.delay = 0.2
+            svc.started.clear()
+            future = echo.future(b'slow', timeout=5)
+            self.assertTrue(svc.started.wait(5))
+            svc._term(True)
+            self.assertEqual(b'slow', future.result())
+            self.assertEqual([None], svc.terms)
+            with self.assertRaises(grpc.RpcError) as e:
+                echo(b'late', timeout=1)
+            self.assertEqual(grpc.StatusCode.UNAVAILABLE, e.exception.code())
+        finally:
+            channel.close()
+            svc._shutdown()
+
+    def test_GraceWithinBudget(self):
+        # The server drain counts against the drain phase of the shutdown budget.
+        svc = make_executor(False)
+        svc.state.shutdown_timeout = 2.0
+        graces = []
+        stop_server = svc._stop_server
+        svc._stop_server = lambda grace: (graces.append(grace), stop_server(grace))
+        svc._start('.')
+        channel = grpc.insecure_channel('127.0.0.1:%d' % svc.bound_port)
+        try:
+            svc.delay = 3
+            future = channel.unary_unary('/test.Echo/Echo').future(b'slow', timeout=10)
+            self.assertTrue(svc.started.wait(5))
+            start = time.time()
+            svc._term(True)
+            self.assertLess(time.time() - start, 2.0)
+            self.assertLessEqual(graces[0], 0.8)
+            with self.assertRaises(grpc.RpcError):
+                future.result()
+        finally:
+            svc.shutdown_budget.finish()
+            channel.close()
+            svc._shutdown()
+
+    def test_Server(self):
+        self.serve(False)
+
+    def test_AioServer(self):
+        self.serve(True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""Startup benchmark. Imports a module in fresh interpreters and reports import time, RSS growth and
+which heavy optional dependencies were loaded, as JSON.
+
+    python tests/startup_bench.py [--module mservice.executor] [--repeat 10] [--output out.json]
+                                  [--max-import-ms N] [--max-rss-mb N]
+
+Exits with status 1 if a threshold is exceeded or a deferred dependency was imported, so it can gate
+a build.
+"""
+from __future__ import unicode_literals, print_function
+import os
+import sys
+import json
+import subprocess
+from optparse import OptionParser
+
+
+# Modify python path
+thisdir = os.path.dirname(os.path.abspath(__file__))
+srcdir = os.path.dirname(thisdir)
+
+
+# Loaded only by the code paths that need them, see executor.run() and process_parser_options().
+DEFERRED_MODULES = ('watchtower', 'boto3', 'botocore', 'daemon', 'grpc', 'google.protobuf')
+
+
+_PROBE = r'''
+import sys, time, json
+sys.path.insert(0, %(srcdir)r)
+
+def rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * %(pagesize)d
+    except (IOError, OSError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+before_modules = set(sys.modules)
+before_rss = rss()
+start = time.time()
+import importlib
+importlib.import_module(%(module)r)
+elapsed = time.time() - start
+loaded = set(sys.modules) - before_modules
+print(json.dumps({
+    'import_seconds': elapsed,
+    'rss_bytes': rss() - before_rss,
+    'modules_loaded': len(loaded),
+    'deferred_loaded': sorted(m for m in loaded if m.split('.')[0] in %(deferred)r or m in %(deferred)r),
+}))
+'''
+
+
+def run_probe(module):
+    """Import `module` in a new interpreter.
+
+    Returns:
+        A dict with import_seconds, rss_bytes, modules_loaded and deferred_loaded.
+    """
+    code = _PROBE % {
+        'srcdir': srcdir,
+        'module': module,
+        'deferred': DEFERRED_MODULES,
+        'pagesize': os.sysconf('SC_PAGE_SIZE'),
+    }
+    out = subprocess.check_output([sys.executable, '-c', code])
+    return json.loads(out.decode('utf-8').strip().splitlines()[-1])
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def run_benchmark(module, repeat):
+    samples = [run_probe(module) for _ in range(max(repeat, 1))]
+    times = [s['import_seconds'] for s in samples]
+    rss = [s['rss_bytes'] for s in samples]
+    deferred = sorted(set(m for s in samples for m in s['deferred_loaded']))
+    return {
+        'benchmark': 'startup',
+        'module': module,
+        'python': sys.version.split()[0],
+        'repeat': len(samples),
+        'import_ms': {
+            'min': min(times) * 1000,
+            'p50': percentile(times, 0.5) * 1000,
+            'max': max(times) * 1000,
+        },
+        'rss_mb': {
+            'min': min(rss) / 1048576.0,
+            'p50': percentile(rss, 0.5) / 1048576.0,
+            'max': max(rss) / 1048576.0,
+        },
+        'modules_loaded': samples[-1]['modules_loaded'],
+        'deferred_loaded': deferred,
+    }
+
+
+if __name__ == '__main__':
+    usage = 'Usage: %prog [options]'
+    parser = OptionParser(usage)
+    parser.add_option('-m', '--module', type='string', action='store', dest='module', default='mservice.executor',
+                      help='Module to import, defaults to mservice.executor.')
+    parser.add_option('-n', '--repeat', type='int', action='store', dest='repeat', default=10,
+                      help='Number of interpreters started, defaults to 10.')
+    parser.add_option('-o', '--output', type='string', action='store', dest='output',
+                      help='Write the JSON report to this file, defaults to stdout.')
+    parser.add_option('--max-import-ms', type='float', action='store', dest='max_import_ms',
+                      help='Fail if the median import time exceeds this.')
+    parser.add_option('--max-rss-mb', type='float', action='store', dest='max_rss_mb',
+                      help='Fail if the median RSS growth exceeds this.')
+    (options, args) = parser.parse_args()
+
+    report = run_benchmark(options.module, options.repeat)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    failed = False
+    if report['deferred_loaded']:
+        print('Deferred modules imported: %s' % ', '.join(report['deferred_loaded']), file=sys.stderr)
+        failed = True
+    if options.max_import_ms is not None and report['import_ms']['p50'] > options.max_import_ms:
+        print('Import took %.1f ms, limit is %.1f ms' % (report['import_ms']['p50'], options.max_import_ms),
+              file=sys.stderr)
+        failed = True
+    if options.max_rss_mb is not None and report['rss_mb']['p50'] > options.max_rss_mb:
+        print('RSS grew %.1f MB, limit is %.1f MB' % (report['rss_mb']['p50'], options.max_rss_mb),
+              file=sys.stderr)
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,126 @@
+from __future__ import unicode_literals, print_function
+import unittest
+import os
+import sys
+import time
+import shutil
+import signal
+import logging
+import tempfile
+
+
+# Modify python path
+thisdir = os.path.dirname(os.path.abspath(__file__))
+srcdir = os.path.dirname(thisdir)
+sys.path.insert(0, srcdir)
+
+
+from mservice import executor
+
+
+def wait_for(test, timeout=10.0):
+    deadline = time.time() + timeout
+    while not test() and time.time() < deadline:
+        time.sleep(0.01)
+    return test()
+
+
+class MarkerExecutor(executor.ServiceExecutor):
+    """Records its hooks as files named <hook>.<pid> in `rundir`."""
+
+    def __init__(self, rundir, crash=False):
+        super(MarkerExecutor, self).__init__(wakeup=0.05, state_or_logger=logging.getLogger('test'))
+        self.rundir = rundir
+        self.crash = crash
+
+    def mark(self, hook):
+        open(os.path.join(self.rundir, '%s.%d' % (hook, os.getpid())), 'w').close()
+
+    def markers(self, hook):
+        return [int(f.split('.')[1]) for f in os.listdir(self.rundir) if f.startswith(hook + '.')]
+
+    def on_start(self, workdir):
+        self.mark('start')
+        if self.crash:
+            raise RuntimeError('crash')
+
+    def on_hup(self):
+        self.mark('hup')
+
+    def on_term(self, graceful):
+        self.mark('term')
+
+
+class WorkerSupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rundir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.rundir)
+
+    def supervisor(self, workers, crash=False, **kwargs):
+        svc = MarkerExecutor(self.rundir, crash)
+        supervisor = executor.WorkerSupervisor(svc, self.rundir, workers, stop_timeout=5.0, **kwargs)
+        supervisor._recycle_r, supervisor._recycle_w = os.pipe()
+        self.addCleanup(os.close, supervisor._recycle_r)
+        self.addCleanup(os.close, supervisor._recycle_w)
+        return svc, supervisor
+
+    def test_SpawnAndStop(self):
+        svc, supervisor = self.supervisor(2)
+        try:
+            for slot in range(2):
+                supervisor._spawn(slot)
+            pids = list(supervisor.slot_pid)
+            self.assertEqual({pids[0]: 0, pids[1]: 1}, supervisor.pid_slot)
+            self.assertTrue(wait_for(lambda: sorted(svc.markers('start')) == sorted(pids)))
+        finally:
+            supervisor._stop_all()
+        self.assertEqual({}, supervisor.pid_slot)
+        self.assertEqual(sorted(pids), sorted(svc.markers('term')))
+
+    def test_CrashBackoff(self):
+        svc, supervisor = self.supervisor(1, crash=True, min_backoff=1.0, max_backoff=3.0, min_uptime=60)
+        delays = []
+        for _ in range(3):
+            supervisor._spawn(0)
+            self.assertTrue(wait_for(lambda: (supervisor._reap() or supervisor.slot_pid[0] is None)))
+            delays.append(supervisor.restart_at.pop(0) - executor.monotonic())
+        self.assertEqual(3, len(svc.markers('start')))
+        self.assertEqual([1, 2, 3], [int(round(d)) for d in delays])
+        # A worker that ran for min_uptime starts again from min_backoff.
+        supervisor.min_uptime = 0
+        supervisor._spawn(0)
+        self.assertTrue(wait_for(lambda: (supervisor._reap() or supervisor.slot_pid[0] is None)))
+        self.assertEqual(1, int(round(supervisor.restart_at.pop(0) - executor.monotonic())))
+
+    def test_ForwardSignals(self):
+        svc = MarkerExecutor(self.rundir)
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                signal.signal(signal.SIGTERM, executor.term_handler)
+                signal.signal(signal.SIGHUP, executor.hup_handler)
+                executor.WorkerSupervisor(svc, self.rundir, 2, stop_timeout=5.0).run()
+                code = 0
+            finally:
+                os._exit(code)
+        try:
+            self.assertTrue(wait_for(lambda: len(svc.markers('start')) == 2))
+            os.kill(pid, signal.SIGHUP)
+            self.assertTrue(wait_for(lambda: len(svc.markers('hup')) == 2))
+            self.assertEqual(sorted(svc.markers('start')), sorted(svc.markers('hup')))
+            os.kill(pid, signal.SIGTERM)
+            _, status = os.waitpid(pid, 0)
+        except Exception:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            raise
+        self.assertEqual(0, status)
+        self.assertEqual(sorted(svc.markers('start')), sorted(svc.markers('term')))
+
+
+if __name__ == '__main__':
+    unittest.main()
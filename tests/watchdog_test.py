@@ -0,0 +1,175 @@
+from __future__ import unicode_literals, print_function
+import unittest
+import os
+import sys
+import gc
+import time
+import struct
+import logging
+import subprocess
+
+
+# Modify python path
+thisdir = os.path.dirname(os.path.abspath(__file__))
+srcdir = os.path.dirname(thisdir)
+sys.path.insert(0, srcdir)
+
+
+from mservice import executor
+from mservice.health import HealthState
+from mservice.metrics import MetricsRegistry
+from mservice.watchdog import Watchdog, GCStats, rss_bytes, RECYCLE_EXIT_CODE
+
+
+class RecyclingExecutor(executor.ServiceExecutor):
+
+    def __init__(self):
+        super(RecyclingExecutor, self).__init__(wakeup=0.001, state_or_logger=logging.getLogger('test'))
+        self.wakes = 0
+
+    def on_wake(self):
+        self.wakes += 1
+        if self.wakes == 3:
+            self.recycle('test')
+
+
+class WatchdogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.health = HealthState(1.0)
+        self.wake_duration = self.registry.histogram('wake_seconds')
+        self.reasons = []
+
+    def start(self, watchdog):
+        return watchdog.start(self.health, self.wake_duration, self.reasons.append, self.registry)
+
+    def test_Rss(self):
+        self.assertGreater(rss_bytes(), 1 << 20)
+        watchdog = self.start(Watchdog(max_rss=1 << 40))
+        self.assertIsNone(watchdog.check())
+        watchdog.max_rss = 1 << 20
+        self.assertTrue(watchdog.check().startswith('rss'))
+        # Recycled once.
+        watchdog.check()
+        self.assertEqual(1, len(self.reasons))
+        watchdog.stop()
+
+    def test_SlowWakes(self):
+        self.wake_duration.record(5.0)
+        watchdog = self.start(Watchdog(max_wake_seconds=1.0, slow_wakes=2))
+        self.wake_duration.record(5.0)
+        self.wake_duration.record(0.1)
+        self.assertIsNone(watchdog.check())
+        self.wake_duration.record(5.0)
+        self.assertIsNone(watchdog.check())
+        self.wake_duration.record(5.0)
+        self.wake_duration.record(5.0)
+        self.assertEqual('2 wakes slower than 1.0 seconds', watchdog.check())
+        watchdog.stop()
+
+    def test_StuckWake(self):
+        watchdog = self.start(Watchdog(max_wake_seconds=1.0, slow_wakes=3))
+        now = executor.monotonic()
+        self.health.wake_begin(now)
+        self.assertIsNone(watchdog.check(now + 2))
+        self.assertEqual('wake running for 3 seconds', watchdog.check(now + 3.5))
+        watchdog.stop()
+
+    def test_CheckThread(self):
+        # Checked off the run loop, which may be stuck.
+        watchdog = self.start(Watchdog(max_wakes=1, jitter=0, interval=0.01))
+        self.health.wakes = 1
+        deadline = time.time() + 5
+        while not self.reasons and time.time() < deadline:
+            time.sleep(0.01)
+        watchdog.stop()
+        self.assertEqual(['1 wakes'], self.reasons)
+        watchdog._thread.join(5)
+        self.assertFalse(watchdog._thread.is_alive())
+
+    def test_WakesAndUptime(self):
+        watchdog = self.start(Watchdog(max_wakes=10, jitter=0.5))
+        self.assertTrue(10 <= watchdog.max_wakes <= 15)
+        self.health.wakes = 9
+        self.assertIsNone(watchdog.check())
+        self.health.wakes = 15
+        self.assertEqual('15 wakes', watchdog.check())
+        watchdog.stop()
+        watchdog = self.start(Watchdog(max_uptime=60, jitter=0))
+        self.assertIsNone(watchdog.check())
+        self.assertTrue(watchdog.check(watchdog._started + 61).startswith('uptime'))
+        watchdog.stop()
+        self.assertFalse(Watchdog().enabled)
+
+    def test_GCStats(self):
+        if not hasattr(gc, 'callbacks'):
+            return
+        stats = GCStats(self.registry).install()
+        try:
+            gc.collect()
+        finally:
+            stats.uninstall()
+        self.assertEqual(1, self.registry.histogram('mservice_gc_pause_seconds', labels={'generation': '2'}).count)
+        if hasattr(gc, 'get_stats'):
+            self.assertGreater(self.registry.counter('mservice_gc_collections_total', labels={'generation': '2'}).get(), 0)
+
+    def test_Recycle(self):
+        svc = RecyclingExecutor()
+        try:
+            svc._run_loop()
+        finally:
+            executor.terminate = False
+        self.assertEqual(3, svc.wakes)
+        self.assertEqual('test', svc.recycle_reason)
+
+    def test_SupervisorStagger(self):
+        svc = RecyclingExecutor()
+        supervisor = executor.WorkerSupervisor(svc, thisdir, 2, recycle_stagger=60)
+        supervisor._recycle_r, supervisor._recycle_w = os.pipe()
+        child = subprocess.Popen(['sleep', '30'])
+        try:
+            supervisor.slot_pid = [child.pid, 12345678]
+            for slot in (0, 1, 0, 7):
+                os.write(supervisor._recycle_w, struct.pack('!H', slot))
+            supervisor._read_recycle_requests()
+            self.assertEqual([0, 1], supervisor.recycle_queue)
+            supervisor._recycle_next(0)
+            self.assertEqual(0, supervisor.recycling)
+            self.assertEqual(-15, child.wait())
+            # One at a time, then staggered.
+            supervisor._recycle_next(0)
+            self.assertEqual([1], supervisor.recycle_queue)
+            supervisor.recycling = None
+            supervisor.next_recycle = 100
+            supervisor._recycle_next(50)
+            self.assertEqual([1], supervisor.recycle_queue)
+        finally:
+            if child.poll() is None:
+                child.kill()
+                child.wait()
+            os.close(supervisor._recycle_r)
+            os.close(supervisor._recycle_w)
+        self.assertEqual(75, RECYCLE_EXIT_CODE)
+
+    def test_SupervisorKillsStuckRecycle(self):
+        svc = RecyclingExecutor()
+        supervisor = executor.WorkerSupervisor(svc, thisdir, 1, stop_timeout=10)
+        child = subprocess.Popen(['sleep', '30'])
+        try:
+            supervisor.slot_pid = [child.pid]
+            supervisor.recycling = 0
+            supervisor.recycle_deadline = 100
+            supervisor._kill_recycling(99)
+            self.assertIsNone(child.poll())
+            supervisor._kill_recycling(100)
+            self.assertEqual(-9, child.wait())
+            self.assertIsNone(supervisor.recycle_deadline)
+        finally:
+            if child.poll() is None:
+                child.kill()
+                child.wait()
+
+
+if __name__ == '__main__':
+    unittest.main()